@@ -19,6 +19,7 @@ from tango.server import Device
 from tango.server import attribute, command
 from tango.server import device_property
 from tango import AttrQuality, DispLevel, DevState
+from tango import AutoTangoAllowThreads
 from tango import AttrWriteType, PipeWriteType
 import enum
 # Additional import
@@ -26,14 +27,32 @@ import enum
 import socket
 import time
 import threading
-from pyparsing import Word, Literal, nums, ParseException
+from concurrent.futures import ThreadPoolExecutor
 import logging as log
+import numpy as np
+from . import detectors
+from . import layout
+from . import pcap
+from . import session
+from .calibration import load_calibration
+from .eventbatch import EventBatcher
+from .ingest import IngestWorker
+from .lineingest import LineIngest
+from .linebuffer import POINT_DTYPE, RECORD_CHANNELS, LineEpochs, LineHistory
+from .linestats import ratio
+from .posmonitor import PositionMonitor
+from .preview import PreviewMap
+from .record import RecordCompression, pack_line
+from .scanmap import ScanMap
+from .trace import TraceLevel, Tracer
+from . import timeline
 log.basicConfig(level=log.INFO)
 
 
 class SoftwareTrigger(object):
     def __init__(self, state):
         self.lock = threading.Lock()
+        self.event = threading.Event()
         self.state = state
 
     @property
@@ -45,6 +64,16 @@ class SoftwareTrigger(object):
     def state(self, state):
         with self.lock:
             self._state = state
+            if state:
+                self.event.set()
+            else:
+                self.event.clear()
+
+    def wait(self, timeout=None):
+        """
+        Returns True once the trigger is set, False after the timeout.
+        """
+        return self.event.wait(timeout)
 
 # PROTECTED REGION END #    //  PandaPosTrig.additionnal_import
 
@@ -79,57 +108,227 @@ class PandaPosTrig(Device):
             - Type:'DevShort'
         PandaDataPort
             - Type:'DevShort'
+        ConnectTimeout
+            - Type:'DevDouble'
+        LayoutFile
+            - Type:'DevString'
+        HistoryLines
+            - Type:'DevLong'
+        HistoryMaxMB
+            - Type:'DevDouble'
+        PreviewSize
+            - Type:'DevShort'
+        PreviewMaxRate
+            - Type:'DevDouble'
+        DetectorChannels
+            - Type:'DevVarStringArray'
+        TraceBufferSize
+            - Type:'DevLong'
+        PositionMonitorDefaultRate
+            - Type:'DevDouble'
+        PositionHistorySize
+            - Type:'DevLong'
+        CalibrationFile
+            - Type:'DevString'
+        DetOutMaxRate
+            - Type:'DevDouble'
+        DetOutMaxBatch
+            - Type:'DevLong'
+        TimelineSize
+            - Type:'DevLong'
+        EfficiencyWindow
+            - Type:'DevDouble'
+        MapFile
+            - Type:'DevString'
+        MapDtype
+            - Type:'DevString'
     """
     # PROTECTED REGION ID(PandaPosTrig.class_variable) ENABLED START #
     def _get_panda_ctrl_socket(self):
         """
-        Returns PandABox control socket.
+        Returns PandABox control socket, raises if the connection is not
+        established within ConnectTimeout.
         """
         try:
-            panda_ctrl_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            panda_ctrl_sock = socket.create_connection((self.PandaHost, self.PandaPort),
+                                                       timeout=self.ConnectTimeout)
             panda_ctrl_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
             panda_ctrl_sock.settimeout(1)
-            panda_ctrl_sock.connect((self.PandaHost, self.PandaPort))
             return panda_ctrl_sock
         except Exception as e:
-            print('Problem connecting to the PandABox control port: ', e)
+            log.error(f'Problem connecting to the PandABox control port: {e}')
+            raise
 
     def _get_panda_data_socket(self):
         """
-        Returns PandABox data socket.
+        Returns PandABox data socket, raises if the connection is not
+        established within ConnectTimeout.
         """
         try:
-            panda_data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            panda_data_sock = socket.create_connection((self.PandaHost, self.PandaDataPort),
+                                                       timeout=self.ConnectTimeout)
             panda_data_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
             panda_data_sock.settimeout(None)
-            panda_data_sock.connect((self.PandaHost, self.PandaDataPort))
             return panda_data_sock
         except Exception as e:
-            print('Problem connecting to the PandaBox data port: ', e)
+            log.error(f'Problem connecting to the PandaBox data port: {e}')
+            raise
+
+    def _connect_panda(self, stop_event):
+        """
+        Opens the control and data sockets concurrently, applies the deferred
+        hardware configuration and starts the acquisition threads.
+        Switches the device from INIT to ON, or to FAULT if the PandABox is not reachable.
+        """
+        connectors = [self._get_panda_ctrl_socket,
+                      self._get_panda_ctrl_socket]
+        if not self.IngestProcess:
+            # The ingest worker opens the data connection itself
+            connectors.append(self._get_panda_data_socket)
+        with ThreadPoolExecutor(max_workers=len(connectors)) as executor:
+            futures = [executor.submit(connector) for connector in connectors]
+        socks, errors = [], []
+        for future in futures:
+            try:
+                socks.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        if errors or stop_event.is_set():
+            for sock in socks:
+                sock.close()
+            if errors:
+                self.set_state(DevState.FAULT)
+                self.set_status(f'Cannot connect to the PandABox {self.PandaHost}: {errors[0]}')
+            return
+
+        self.panda_ctrl_sock, self.panda_det_ctrl_sock, *data_sock = socks
+        self.panda_det_data_sock = data_sock[0] if data_sock else None
+        self._configure_panda()
+
+        try:
+            self.t_zerod_acq = threading.Thread(target=self._read_zerod_det,
+                                                args=(self.panda_det_ctrl_sock,
+                                                self.__det_trig,
+                                                stop_event))
+            self.t_zerod_acq.setDaemon(True)
+            self.t_zerod_acq.start()
+        except Exception as e:
+            log.error(f'Problem starting the _read_zerod_det thread: {e}')
+
+        try:
+            self.t_det_out = threading.Thread(target=self._det_out.run,
+                                              args=(stop_event,))
+            self.t_det_out.setDaemon(True)
+            self.t_det_out.start()
+        except Exception as e:
+            log.error(f'Problem starting the DetOut publisher thread: {e}')
+
+        if self.IngestProcess:
+            try:
+                self._ingest_worker = IngestWorker(self.PandaHost, self.PandaDataPort,
+                                                   timeout=self.ConnectTimeout,
+                                                   size_mb=self.IngestBufferMB)
+                self._ingest_worker.start()
+                self.t_data_acq = threading.Thread(target=self._ingest_worker.run,
+                                                   args=(self._ingest.add_points, self._ingest.end,
+                                                         self._data_port_lost, stop_event,
+                                                         self._tracer))
+                self.t_data_acq.setDaemon(True)
+                self.t_data_acq.start()
+            except Exception as e:
+                log.error(f'Problem starting the data port worker process: {e}')
+        else:
+            try:
+                self.t_data_acq = threading.Thread(
+                                                target=self._panda_dataline_read,
+                                                args=(self.panda_det_data_sock, stop_event)
+                )
+                self.t_data_acq.setDaemon(True)
+                self.t_data_acq.start()
+            except Exception as e:
+                log.error(f'Problem starting the _panda_dataline_read thread: {e}')
+
+        try:
+            self.t_pos_monitor = threading.Thread(target=self._pos_monitor.run,
+                                                  args=(stop_event,))
+            self.t_pos_monitor.setDaemon(True)
+            self.t_pos_monitor.start()
+        except Exception as e:
+            log.error(f'Problem starting the position monitor thread: {e}')
+
+        self.set_state(DevState.ON)
+        self.set_status(f'Connected to the PandABox {self.PandaHost}')
+
+    def _configure_panda(self):
+        """
+        Hardware configuration deferred from init_device, applied once connected.
+        """
+        try:
+            self._sel_trig_axis(axis=self.__trig_axis,
+                                ctrl_socket=self.panda_ctrl_sock)
+        except Exception as e:
+            log.debug(f'Problem selecting the trigger axis: {e}')
+
+        # Setting the detector dwell in the hardware
+        try:
+            self._set_det_dwell(self.__det_dwell, self.panda_ctrl_sock)
+        except Exception as e:
+            log.debug(f'Problem setting the initial detector dwell: {e}')
+
+        try:
+            self._det_time_pulse_switch(self.__time_pulses_enable, self.panda_ctrl_sock)
+        except Exception as e:
+            log.debug(f'Problem with the initialization of time-based block: {e}')
+
+        # The points per line complete the lines, see LineIngest
+        try:
+            self.read_DetTimePulseN()
+        except Exception as e:
+            log.debug(f'Problem reading the number of points per line: {e}')
+
+        # The additional detector channels are captured like the PMT and photodiode counters
+        try:
+            self._panda_batch_write([(f'{column}.CAPTURE', 'Diff') for column in self.__extra_columns],
+                                    self.panda_ctrl_sock)
+        except Exception as e:
+            log.debug(f'Problem enabling the capture of the detector channels: {e}')
 
     def _panda_block_write(self, argin, ctrl_socket=None):
         """
         Sends 'argin' value to the panda control soket and receives the output.
+        Without ctrl_socket a connection of its own is opened and closed, if
+        the device is connected.
         """
+        panda_ctrl_sock = None
         try:
-            if not ctrl_socket:
-                panda_ctrl_sock = self._get_panda_ctrl_socket()
-            else:
+            if ctrl_socket:
                 panda_ctrl_sock = ctrl_socket
-            panda_ctrl_sock.sendall(bytes(argin + '\n', 'ascii'))
-            argout = panda_ctrl_sock.recv(4096).decode()
-            #log.debug(f'argout in _panda_block_write is: {argout}')
+            elif self.panda_ctrl_sock is None:
+                raise ConnectionError(f'Not connected to the PandABox {self.PandaHost}')
+            else:
+                panda_ctrl_sock = self._get_panda_ctrl_socket()
+            # The control socket is shared by the Tango and the data threads
+            with self._ctrl_lock:
+                request = bytes(argin + '\n', 'ascii')
+                panda_ctrl_sock.sendall(request)
+                self._record_session(session.CTRL_TX, request)
+                raw = panda_ctrl_sock.recv(4096)
+                self._record_session(session.CTRL_RX, raw)
+                argout = raw.decode()
+            self._tracer.debug('ctrl %s -> %r', argin, argout)
             return argout
         except Exception as e:
-            log.debug('A problem when sending a query to the PandaBox occured: {e}')
+            log.debug(f'A problem when sending a query to the PandaBox occured: {e}')
         finally:
-            if not ctrl_socket:
+            if not ctrl_socket and panda_ctrl_sock is not None:
                 log.debug(f'Closing panda_ctrl_sock, {panda_ctrl_sock}')
+                panda_ctrl_sock.close()
 
     def _read_data_port(self, argin='', data_socket=None):
         """
         Receives the data socket output.
         """
+        panda_data_sock = None
         try:
             if data_socket is None:
                 panda_data_sock = self._get_panda_data_socket()
@@ -140,42 +339,108 @@ class PandaPosTrig(Device):
             else:
                 log.debug(f'argin in _read_data_port is: {argin}')
                 panda_data_sock.sendall(bytes(argin+'\n', 'ascii'))
-            argout = panda_data_sock.recv(4096).decode()
-            log.debug(f'argout in _read_data_port is: {argout}')
+            raw = panda_data_sock.recv(4096)
+            self._record_session(session.DATA_RX, raw)
+            argout = raw.decode()
+            self._tracer.sampled('data', 'data %r', argout)
             return argout
         except Exception as e:
             log.debug(f'A problem when reading the PandaBox data port occured: {e}')
         finally:
-            if not data_socket:
+            if not data_socket and panda_data_sock is not None:
                 log.debug(f'Closing panda_data_sock, {panda_data_sock}')
+                panda_data_sock.close()
+
+    def _record_session(self, channel, data):
+        """
+        Adds the raw bytes sent or received on a socket to the session
+        recording, if one is running.
+        """
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.record(channel, data)
+
+    def _panda_recv_lines(self, ctrl_socket, n_lines=None, terminator=None):
+        """
+        Receives reply lines from the control socket until either n_lines lines
+        or the terminator line have been received.
+        """
+        buff = b''
+        lines = []
+        while True:
+            chunk = ctrl_socket.recv(65536)
+            if not chunk:
+                raise ConnectionError('PandABox closed the control connection')
+            self._record_session(session.CTRL_RX, chunk)
+            buff += chunk
+            *complete, buff = buff.split(b'\n')
+            for line in complete:
+                line = line.decode()
+                if terminator is not None and line == terminator:
+                    return lines
+                lines.append(line)
+            if n_lines is not None and len(lines) >= n_lines:
+                return lines
+
+    def _panda_multiline_query(self, query, ctrl_socket):
+        """
+        Sends a query with a multi-line reply, e.g. *CHANGES?, and returns the
+        reply lines without the closing '.'.
+        """
+        request = bytes(query + '\n', 'ascii')
+        ctrl_socket.sendall(request)
+        self._record_session(session.CTRL_TX, request)
+        return self._panda_recv_lines(ctrl_socket, terminator='.')
+
+    def _panda_batch_query(self, requests, ctrl_socket):
+        """
+        Sends all requests, e.g. 'FIELD?' queries, in a single pipelined batch
+        and returns the replies in the same order.
+        """
+        if not requests:
+            return []
+        with self._ctrl_lock:
+            payload = bytes(''.join(f'{request}\n' for request in requests), 'ascii')
+            ctrl_socket.sendall(payload)
+            self._record_session(session.CTRL_TX, payload)
+            return self._panda_recv_lines(ctrl_socket, n_lines=len(requests))
+
+    def _panda_batch_write(self, assignments, ctrl_socket):
+        """
+        Sends all (field, value) assignments in a single pipelined batch and
+        returns the replies in the same order.
+        """
+        if not assignments:
+            return []
+        with self._ctrl_lock:
+            payload = bytes(''.join(f'{field}={value}\n' for field, value in assignments), 'ascii')
+            ctrl_socket.sendall(payload)
+            self._record_session(session.CTRL_TX, payload)
+            return self._panda_recv_lines(ctrl_socket, n_lines=len(assignments))
 
     def _enable_panda_block(self, name, ctrl_socket):
         """
         Enables the selected panda block.
         """
-        resp = self._panda_block_write(f'{name}.ENABLE=ONE', ctrl_socket=ctrl_socket)
-        log.debug(f'{name}.ENABLE=ONE, resp: {resp}')
+        self._panda_block_write(f'{name}.ENABLE=ONE', ctrl_socket=ctrl_socket)
 
     def _disable_panda_block(self, name, ctrl_socket):
         """
         Disables the selected panda block.
         """
-        resp = self._panda_block_write(f'{name}.ENABLE=ZERO', ctrl_socket=ctrl_socket)
-        log.debug(f'{name}.ENABLE=ZERO, resp: {resp}')
+        self._panda_block_write(f'{name}.ENABLE=ZERO', ctrl_socket=ctrl_socket)
 
     def _arm_pos_capt(self, ctrl_socket):
         """
         Armes the PCAP panda block.
         """
-        resp = self._panda_block_write(f'*PCAP.ARM=', ctrl_socket=ctrl_socket)
-        log.debug(f'*PCAP.ARM=, resp: {resp}')
+        self._panda_block_write(f'*PCAP.ARM=', ctrl_socket=ctrl_socket)
 
     def _disarm_pos_capt(self, ctrl_socket):
         """
         Disarms the PCAP panda block.
         """
-        resp = self._panda_block_write(f'*PCAP.DISARM=', ctrl_socket=ctrl_socket)
-        log.debug(f'*PCAP.DISARM=, resp: {resp}')
+        self._panda_block_write(f'*PCAP.DISARM=', ctrl_socket=ctrl_socket)
 
     def _read_abs_pos(self, ctrl_socket):
         """ Reads incremental encoder FPGA blocks directly via the control socket """
@@ -199,17 +464,9 @@ class PandaPosTrig(Device):
         """
         try:
             if axis == TrigAxis.X:
-                resp = self._panda_block_write(
-                                                'PCOMP1.INP=INENC1.VAL',
-                                                ctrl_socket=ctrl_socket
-                                                )
-                log.debug(f'PCOMP1.INP=INENC1.VAL, resp: {resp}')
+                self._panda_block_write('PCOMP1.INP=INENC1.VAL', ctrl_socket=ctrl_socket)
             elif axis == TrigAxis.Y:
-                resp = self._panda_block_write(
-                                                'PCOMP1.INP=INENC2.VAL',
-                                                ctrl_socket=ctrl_socket
-                                                )
-                log.debug(f'PCOMP1.INP=INENC2.VAL, resp: {resp}')
+                self._panda_block_write('PCOMP1.INP=INENC2.VAL', ctrl_socket=ctrl_socket)
         except Exception as e:
             log.debug(f'A problem in _sel_trig_axis occured: {e}')
 
@@ -218,8 +475,9 @@ class PandaPosTrig(Device):
         Sequentially disables and enables the choosen axis, which arms the selected axis for triggering.
         """
         try:
-            self._disable_panda_block('PCOMP1', ctrl_socket=ctrl_socket)
-            self._enable_panda_block('PCOMP1', ctrl_socket=ctrl_socket)
+            with self._timeline.span('_arm_axis', 'pcomp'):
+                self._disable_panda_block('PCOMP1', ctrl_socket=ctrl_socket)
+                self._enable_panda_block('PCOMP1', ctrl_socket=ctrl_socket)
         except Exception as e:
             log.debug(f'A problem in _arm_axis occured: {e}')
 
@@ -260,24 +518,33 @@ class PandaPosTrig(Device):
                             "PULSES": int(pulses),
                             "DIR": pcmp_dir}
         try:
-            for parameter in send_parameters.items():
-                field_name, value = parameter
-                field = pcomp_name + '.' + field_name
-                resp = self._panda_block_write(f'{field}={value}',
-                                        ctrl_socket=ctrl_socket)
-                log.debug(f'The {field}={value} has been sent, response: {resp}')
+            with self._timeline.span('_prepare_pcomp', 'pcomp'):
+                for parameter in send_parameters.items():
+                    field_name, value = parameter
+                    field = pcomp_name + '.' + field_name
+                    self._panda_block_write(f'{field}={value}',
+                                            ctrl_socket=ctrl_socket)
         except Exception as e:
-            print(e)
+            self._tracer.error('A problem in _prepare_pcomp occured: %s', e)
 
     def _set_axis_trig(self, trig_pos, axis=TrigAxis.Y, axis_sign=1, ctrl_socket=None):
         """
         Sets the PCOMP blocks parameters according to the requested
         position and axis.
         """
-        start = int(trig_pos * 1000) * axis_sign # convert to nm
+        target = trig_pos * axis_sign # position of the encoder, in microns
+        if self._calibration is not None:
+            # PCOMP compares the raw encoder position, the calibrated trigger
+            # position is mapped back once per line, at the current position
+            # of the other axis
+            if axis == TrigAxis.X:
+                target, _ = self._calibration.inverse(target, self.__abs_y * self.AbsYSign)
+            else:
+                _, target = self._calibration.inverse(self.__abs_x * self.AbsXSign, target)
+        start = int(target * 1000) # convert to nm
         pcomp_name = 'PCOMP1'
         self._prepare_pcomp(
-                        pre_start=100,
+                        pre_start=self.__trig_pre_start * 1000,
                         start=start,
                         width=20,
                         step=21,
@@ -287,67 +554,58 @@ class PandaPosTrig(Device):
                         ctrl_socket=ctrl_socket)
 
     def _set_time_pulse_block(self, ctrl_socket):
-        # Setting the number of pulses
-        resp = self._panda_block_write(f'PULSE1.PULSES={self.__det_time_pulse_n}', ctrl_socket=ctrl_socket)
-        log.debug(f'PULSE1.PULSES={self.__det_time_pulse_n}, resp: {resp}')
+        # Setting the number of pulses, unless still unknown
+        if self._ingest.n_points > 0:
+            self._panda_block_write(f'PULSE1.PULSES={self._ingest.n_points}', ctrl_socket=ctrl_socket)
         # Setting the pulse width in ms
-        resp = self._panda_block_write(f'PULSE1.WIDTH={self.__det_time_pulse_width}', ctrl_socket=ctrl_socket)
-        log.debug(f'PULSE1.WIDTH={self.__det_time_pulse_width}, resp: {resp}')
+        self._panda_block_write(f'PULSE1.WIDTH={self.__det_time_pulse_width}', ctrl_socket=ctrl_socket)
         # Setting the pulse step in ms
-        resp = self._panda_block_write(f'PULSE1.STEP={self.__det_time_pulse_step}', ctrl_socket=ctrl_socket)
-        log.debug(f'PULSE1.STEP={self.__det_time_pulse_step}, resp: {resp}')
+        self._panda_block_write(f'PULSE1.STEP={self.__det_time_pulse_step}', ctrl_socket=ctrl_socket)
 
     def _read_zerod_counters(self, ctrl_socket):
+        """
+        Gates the counters of all detector channels for one dwell and returns
+        their values by channel name.
+        """
         try:
             resp_buff = None
             resp_buff = self._panda_block_write('PULSE2.TRIG=ONE',
                                                     ctrl_socket=ctrl_socket)
             time.sleep(self.__det_dwell/1000)
-            resp_buff = self._panda_block_write('PULSE2.TRIG=ZERO',
-                                                    ctrl_socket=ctrl_socket)
-
-            counter5 = self._panda_block_write('COUNTER5.OUT?',
-                                                    ctrl_socket=ctrl_socket)
-            counter6 = self._panda_block_write('COUNTER6.OUT?',
-                                                    ctrl_socket=ctrl_socket)
-
-            _, ret_PD = counter5.split('=')
-            _, ret_PMT = counter6.split('=')
-
-            return (int(ret_PD), int(ret_PMT))
+            # Closing the gate and reading all the counters in one round trip
+            queries = ['PULSE2.TRIG=ZERO'] + [f'{channel.counter}.OUT?' for channel in self._detectors]
+            replies = self._panda_batch_query(queries, ctrl_socket)
+            return {channel.name: int(reply.split('=')[1])
+                    for channel, reply in zip(self._detectors, replies[1:])}
         except Exception as e:
             log.debug(f'A problem in _read_zerod_counters ocuured: {e}')
 
-    def _read_zerod_det(self, ctrl_socket, trigger=None, ph_diode_var=None, pmt_var=None):
+    def _read_zerod_det(self, ctrl_socket, trigger=None, stop_event=None):
         log.debug(f'Started _read_zerod_det thread')
         try:
-            while True:
+            while not stop_event.is_set():
                 if self.__det_trig_src == DetTrigSrc.INTERNAL:
-                    ret_PD, ret_PMT = self._read_zerod_counters(ctrl_socket)
-                    self.__int_ph_diode = ret_PD
-                    self.__int_pmt = ret_PMT
-                    #log.debug(f'Detector readings: {self.__int_ph_diode}, {self.__int_pmt}')
+                    self.__zerod_values = self._read_zerod_counters(ctrl_socket) or self.__zerod_values
+                    #log.debug(f'Detector readings: {self.__zerod_values}')
                 elif self.__det_trig_src == DetTrigSrc.EXT_SOFT:
-                    if trigger.state:
+                    # Waits for the trigger instead of polling its state
+                    if trigger.wait(.1):
                         self.set_state(DevState.RUNNING)
                         start_time = time.time()
-                        ret_PD, ret_PMT = self._read_zerod_counters(ctrl_socket)
-                        self.__int_ph_diode = ret_PD
-                        self.__int_pmt = ret_PMT
+                        self.__zerod_values = self._read_zerod_counters(ctrl_socket) or self.__zerod_values
                         if self.get_state() not in [
                                                     DevState.MOVING,
                                                     DevState.FAULT,
                                                     DevState.OFF]:
                             log.debug('Switching from RUNNING to ON state after EXT_SOFT trigger.')
                             self.set_state(DevState.ON)
-                        self.push_change_event("DetOut", (
-                                                        self.__det_trig_cntr,
-                                                        self.__int_ph_diode,
-                                                        self.__int_pmt))
+                        # Queued only, the events are pushed by the DetOut publisher thread
+                        values = self.__zerod_values
+                        self._det_out.add((self.__det_trig_cntr,
+                                           *(values.get(channel.name, 0) for channel in self._detectors)))
                         trigger.state = False
-                        log.debug(f'The EXT_SOFT triggered measurement took: {time.time()-start_time}s')
-                    else:
-                        continue
+                        self._tracer.debug('The EXT_SOFT triggered measurement took: %.6f s',
+                                           time.time() - start_time)
 
         except Exception as e:
             log.debug(f'There is a problem in _read_zerod_det(): {e} ')
@@ -356,55 +614,220 @@ class PandaPosTrig(Device):
 
     def _set_det_dwell(self, value, ctrl_socket):
         # Sets detector dwell in ms
-        resp = self._panda_block_write(f'PULSE2.WIDTH={value}', ctrl_socket=ctrl_socket)
-        log.debug(f'PULSE2.WIDTH={value}, resp: {resp}')
+        self._panda_block_write(f'PULSE2.WIDTH={value}', ctrl_socket=ctrl_socket)
+
+    def _panda_dataline_read(self, data_socket, stop_event):
+        stream = pcap.DataPortStream(None, self._ingest.end, tracer=self._tracer,
+                                     on_points=self._ingest.add_points)
+        # The data port options are sent once, the header of every acquisition
+        # gives the order of the captured fields
+        data_socket.sendall(b'ASCII\n')
+        self._record_session(session.DATA_TX, b'ASCII\n')
+        log.debug('Inside _panda_dataline_read')
+        try:
+            while not stop_event.is_set():
+                repl = self._read_data_port(data_socket=data_socket)
+                if not repl:
+                    if not stop_event.is_set():
+                        self._data_port_lost('The PandABox data port connection has been lost')
+                    break
+                try:
+                    stream.feed(repl)
+                except Exception as e:
+                    # A failing chunk does not end the acquisition
+                    self._tracer.warning('Problem processing a data port chunk: %s', e)
+        except Exception as e:
+            log.debug(f'A problem within _panda_dataline_read(): {e}')
+        finally:
+            log.debug('Exiting the _panda_dataline_read()')
 
-    def _panda_dataline_read(self, data_socket):
-        while True:
-            try:
-                new_data_line = True
-                log.debug('Inside _panda_dataline_read')
-                while True:
-                    repl = self._read_data_port('NO_HEADER', data_socket=data_socket)
-                    repl = repl.strip()
-                    resp = repl.strip().split('\n')
-
-                    for line in resp:
-                        try:
-                            res = self.panda_line_repl.parseString(line)
-                            print(f'Result is: {res}, type is: {type(res)}')
-                        except ValueError as val_err:
-                            print('Value conversion error during panda reply parsing: ', val_err)
-                        except ParseException as pe:
-                            print('An error in async_panda_line_read(), cannot parse the input', pe)
-
-                        if isinstance(res[0], int) and isinstance(res[5], int):
-                            parsed_data_line = list(res)
-                            log.debug(f'New data line received: {parsed_data_line}')
-                            self._x_pos_out.append(parsed_data_line[0]/1000)
-                            self._y_pos_out.append(parsed_data_line[1]/1000)
-                            self.__dwell_out.append(parsed_data_line[2]/1000)
-                            self._pmt_out.append(parsed_data_line[3])
-                            self._p_diode_out.append(parsed_data_line[4])
-                            self.__point_n_out.append(parsed_data_line[5])
-                        elif res[0] == 'END':
-                            log.debug('END message on the data port.')
-                            new_data_line = False
-                        else:
-                            print('Not an array element: ', res)
-                    if new_data_line is False:
-                        log.debug('Braking the point loop.')
-                        self.__det_point_cntr = 0
-                        break
-            except Exception as e:
-                log.debug('A problem within _panda_dataline_read(): ', e)
-            finally:
-                log.debug('Exiting the _panda_dataline_read()')
+    def _data_port_lost(self, reason):
+        self.set_state(DevState.FAULT)
+        self.set_status(reason)
+
+    def _push_event(self, name, value):
+        """
+        Pushes a change event from the data thread, which keeps running if
+        the event cannot be pushed, e.g. on a monitor timeout.
+        """
+        try:
+            self.push_change_event(name, value)
+        except Exception as e:
+            self._tracer.warning('Cannot push the %s event: %s', name, e)
+
+    def _complete_line(self, line):
+        """
+        Publishes a completed line to the history, the on-disk map and the
+        PrevLineIndex event.
+        """
+        self._history.add(line)
+        scan_map = self._map
+        if scan_map is not None:
+            row, column = self._ingest.map_position(line.index, self.__map_first_line)
+            scan_map.add_line(row, line, column)
+        if self._ingest.continuous:
+            # The continuous capture arms the lines by itself
+            self.__det_trig_cntr = self._lines.armed + 1
+        # The waiting commands are woken up before the event is pushed
+        self._notify_line()
+        # Clients wait on this event instead of polling the point count
+        self._push_event('PrevLineIndex', line.index)
+
+    def _line_end(self, rearm):
+        """
+        Called by the data thread at the end of every line.
+        """
+        self.__det_point_cntr = 0
+        if rearm:
+            self._end_of_line()
+
+    def _next_pass(self):
+        """
+        Arms the same line again for the next pass of a multi-pass line.
+        """
+        try:
+            self._arm_line()
+        except Exception as e:
+            log.debug(f'A problem when arming the next pass occured: {e}')
+
+    def _close_map(self):
+        """
+        Flushes and closes the on-disk map, returns its path, empty if there
+        was none.
+        """
+        scan_map, self._map = self._map, None
+        if scan_map is None:
+            return ''
+        scan_map.close()
+        return scan_map.path
+
+    def _notify_line(self):
+        """
+        Wakes up the WaitLineComplete and WaitArmed commands, called after the
+        line state has changed.
+        """
+        with self._line_cond:
+            self._line_cond.notify_all()
+
+    def _wait_line(self, predicate, timeout):
+        # The device monitor is released while waiting, the data thread
+        # needs it to push its events
+        with AutoTangoAllowThreads(self):
+            with self._line_cond:
+                return self._line_cond.wait_for(predicate, timeout=max(timeout, 0.))
+
+    def _line_trig(self):
+        """
+        Returns the trigger position, axis, axis sign and PCOMP pre-start of
+        the next line.
+        """
+        if self.__trig_axis == TrigAxis.X:
+            trig_pos = self.__trig_x_pos + self.__abs_x_offset
+            axis_sign = self.AbsXSign
+        elif self.__trig_axis == TrigAxis.Y:
+            trig_pos = self.__trig_y_pos + self.__abs_y_offset
+            axis_sign = self.AbsYSign
+        return (trig_pos, self.__trig_axis, axis_sign, self.__trig_pre_start)
+
+    def _arm_line(self):
+        """
+        Programs PCOMP1 for the next line and arms it. The data thread arms
+        the lines as well, the writes are not interleaved with others.
+        """
+        with self._ctrl_lock:
+            trig = self._line_trig()
+            trig_pos, axis, axis_sign, _ = trig
+            self._set_axis_trig(trig_pos,
+                                axis=axis,
+                                axis_sign=axis_sign,
+                                ctrl_socket=self.panda_ctrl_sock)
+            self._arm_axis(ctrl_socket=self.panda_ctrl_sock)
+            self._ingest.armed_at = time.perf_counter()
+        return trig
+
+    def _next_line(self):
+        """
+        Returns the index of the line armed by the next ArmSingle, which the
+        double-buffered mode may have armed already.
+        """
+        if self.__double_buffer and self.__pre_armed is not None:
+            return self.__det_trig_cntr - 1
+        return self.__det_trig_cntr
+
+    def _end_of_line(self):
+        """
+        Called by the data thread on END. In the double-buffered mode the
+        next line is armed straight away, without waiting for the client,
+        while the completed line stays readable as the previous line.
+        """
+        if not self.__double_buffer:
+            return
+        try:
+            self.__pre_armed = self._arm_line()
+            self.__det_trig_cntr += 1
+            self._lines.arm(self.__det_trig_cntr - 1)
+        except Exception as e:
+            self.__pre_armed = None
+            log.debug(f'A problem when arming the next line occured: {e}')
+
+    def _on_position(self, timestamp, abs_x, abs_y):
+        """
+        Called by the position monitor for every sample. Tango only sends the
+        events passing the abs/rel change and archive criteria of AbsX/AbsY.
+        """
+        self._set_abs_pos(abs_x, abs_y)
+        try:
+            for name, value in (('AbsX', self.__abs_x - self.__abs_x_offset),
+                                ('AbsY', self.__abs_y - self.__abs_y_offset)):
+                self.push_change_event(name, value, timestamp, AttrQuality.ATTR_VALID)
+                self.push_archive_event(name, value, timestamp, AttrQuality.ATTR_VALID)
+        except Exception as e:
+            self._tracer.sampled('position', 'Cannot push the position events: %s', e)
+
+    def _set_abs_pos(self, abs_x, abs_y):
+        """
+        Sets the positions from the raw encoder values.
+        """
+        abs_x, abs_y = abs_x/1000, abs_y/1000 # all values in microns
+        if self._calibration is not None:
+            abs_x, abs_y = (float(value) for value in self._calibration.apply(abs_x, abs_y))
+        self.__abs_x, self.__abs_y = abs_x*self.AbsXSign, abs_y*self.AbsYSign
+        self.__abs_pos_at = time.monotonic()
+
+    def _update_abs_pos(self):
+        """
+        Returns True if the positions are up to date. They are read from the
+        PandABox if the position monitor has no sample of the last two
+        sampling periods, when it is paused or reconnecting.
+        """
+        rate = self.__pos_monitor_rate
+        if rate > 0 and self.__abs_pos_at is not None and time.monotonic() - self.__abs_pos_at < 2. / rate:
+            return True
+        pos = self._read_abs_pos(self.panda_ctrl_sock)
+        if pos is None:
+            return False
+        self._set_abs_pos(*pos)
+        return True
 
     def read_attr_hardware(self, data):
         """Method always executed to read the hardware."""
-        abs_x, abs_y = self._read_abs_pos(self.panda_ctrl_sock)
-        self.__abs_x, self.__abs_y = abs_x*self.AbsXSign/1000, abs_y*self.AbsYSign/1000 # all values in microns
+        # The positions are sampled by the position monitor, polled here
+        # only while it has no recent sample
+        multi_attr = self.get_device_attr()
+        if any(multi_attr.get_attr_by_ind(ind).get_name() in ('AbsX', 'AbsY') for ind in data):
+            self.__abs_pos_valid = self._update_abs_pos()
+
+    def _abs_pos_quality(self):
+        return AttrQuality.ATTR_VALID if self.__abs_pos_valid else AttrQuality.ATTR_INVALID
+
+    def _check_abs_pos(self, origin):
+        """
+        Throws if the current positions cannot be read.
+        """
+        if not self._update_abs_pos():
+            tango.Except.throw_exception('PositionNotRead',
+                                         'The current position cannot be read from the PandABox',
+                                         origin)
 
     # PROTECTED REGION END #    //  PandaPosTrig.class_variable
 
@@ -437,6 +860,101 @@ class PandaPosTrig(Device):
         default_value=8889
     )
 
+    ConnectTimeout = device_property(
+        dtype='DevDouble',
+        default_value=1.0
+    )
+
+    LayoutFile = device_property(
+        dtype='DevString',
+        default_value=""
+    )
+
+    HistoryLines = device_property(
+        dtype='DevLong',
+        default_value=100
+    )
+
+    HistoryMaxMB = device_property(
+        dtype='DevDouble',
+        default_value=256.0
+    )
+
+    PreviewSize = device_property(
+        dtype='DevShort',
+        default_value=256
+    )
+
+    PreviewMaxRate = device_property(
+        dtype='DevDouble',
+        default_value=5.0
+    )
+
+    DetectorChannels = device_property(
+        dtype='DevVarStringArray',
+        default_value=list(detectors.DEFAULT_CHANNELS)
+    )
+
+    TraceBufferSize = device_property(
+        dtype='DevLong',
+        default_value=10000
+    )
+
+    PositionMonitorDefaultRate = device_property(
+        dtype='DevDouble',
+        default_value=100.0
+    )
+
+    PositionHistorySize = device_property(
+        dtype='DevLong',
+        default_value=10000
+    )
+
+    CalibrationFile = device_property(
+        dtype='DevString',
+        default_value=""
+    )
+
+    DetOutMaxRate = device_property(
+        dtype='DevDouble',
+        default_value=20.0
+    )
+
+    DetOutMaxBatch = device_property(
+        dtype='DevLong',
+        default_value=1000
+    )
+
+    TimelineSize = device_property(
+        dtype='DevLong',
+        default_value=100000
+    )
+
+    EfficiencyWindow = device_property(
+        dtype='DevDouble',
+        default_value=60.0
+    )
+
+    MapFile = device_property(
+        dtype='DevString',
+        default_value=""
+    )
+
+    MapDtype = device_property(
+        dtype='DevString',
+        default_value="<f4"
+    )
+
+    IngestProcess = device_property(
+        dtype='DevBoolean',
+        default_value=False
+    )
+
+    IngestBufferMB = device_property(
+        dtype='DevDouble',
+        default_value=64.0
+    )
+
     # ----------
     # Attributes
     # ----------
@@ -445,6 +963,8 @@ class PandaPosTrig(Device):
         dtype='DevDouble',
         access=AttrWriteType.READ_WRITE,
         unit="microns",
+        abs_change="0.01",
+        archive_abs_change="0.1",
         doc="Absolute sample X position",
     )
 
@@ -459,6 +979,8 @@ class PandaPosTrig(Device):
         dtype='DevDouble',
         access=AttrWriteType.READ_WRITE,
         unit="microns",
+        abs_change="0.01",
+        archive_abs_change="0.1",
         doc="Absolute sample Y position",
     )
 
@@ -540,6 +1062,13 @@ class PandaPosTrig(Device):
         doc="Position for X axis triggerring",
     )
 
+    TrigPreStart = attribute(
+        dtype='DevDouble',
+        access=AttrWriteType.READ_WRITE,
+        unit="microns",
+        doc="PCOMP1 PRE_START, distance from the trigger position before waiting for it",
+    )
+
     TrigYPos = attribute(
         dtype='DevDouble',
         access=AttrWriteType.READ_WRITE,
@@ -555,6 +1084,18 @@ class PandaPosTrig(Device):
         dtype='DevLong64',
     )
 
+    DetOut = attribute(
+        dtype=(('DevULong64',),),
+        max_dim_x=64,
+        max_dim_y=10000,
+        doc="EXT_SOFT samples of the last event, one row of DetTrigCntr and the DetectorChannels counts each",
+    )
+
+    DetOutBacklog = attribute(
+        dtype='DevLong',
+        doc="EXT_SOFT samples waiting for their DetOut event",
+    )
+
     XPosOut = attribute(
         dtype=('DevDouble',),
         max_dim_x=1000,
@@ -585,6 +1126,267 @@ class PandaPosTrig(Device):
         max_dim_x=1000,
     )
 
+    PreviewNLines = attribute(
+        dtype='DevLong',
+        access=AttrWriteType.READ_WRITE,
+        doc="Number of lines of the map shown in the preview",
+    )
+
+    PreviewImage = attribute(
+        dtype=(('DevDouble',),),
+        max_dim_x=1024,
+        max_dim_y=1024,
+        doc="Decimated PMT preview of the running map",
+    )
+
+    SegmentOffset = attribute(
+        dtype=('DevLong',),
+        access=AttrWriteType.READ_WRITE,
+        max_dim_x=2,
+        doc="Map row and column of the first point of the following lines, the segments of a sparse scan",
+    )
+
+    PMTSum = attribute(
+        dtype='DevULong64',
+        doc="Sum of the PMT counts of the current line",
+    )
+
+    PMTMean = attribute(
+        dtype='DevDouble',
+        doc="Mean of the PMT counts of the current line",
+    )
+
+    PMTMin = attribute(
+        dtype='DevULong64',
+        doc="Minimum of the PMT counts of the current line",
+    )
+
+    PMTMax = attribute(
+        dtype='DevULong64',
+        doc="Maximum of the PMT counts of the current line",
+    )
+
+    PDiodeSum = attribute(
+        dtype='DevULong64',
+        doc="Sum of the photodiode counts of the current line",
+    )
+
+    PDiodeMean = attribute(
+        dtype='DevDouble',
+        doc="Mean of the photodiode counts of the current line",
+    )
+
+    PDiodeMin = attribute(
+        dtype='DevULong64',
+        doc="Minimum of the photodiode counts of the current line",
+    )
+
+    PDiodeMax = attribute(
+        dtype='DevULong64',
+        doc="Maximum of the photodiode counts of the current line",
+    )
+
+    PMTPDiodeRatio = attribute(
+        dtype='DevDouble',
+        doc="Ratio of the PMT and photodiode sums of the current line",
+    )
+
+    TransmissionOut = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+        doc="PMT counts normalised by the photodiode counts",
+    )
+
+    DoubleBuffer = attribute(
+        dtype='DevBoolean',
+        access=AttrWriteType.READ_WRITE,
+        doc="Arm the next line at the end of the current one, keeping it in the Prev* buffers",
+    )
+
+    PrevLineIndex = attribute(
+        dtype='DevLong64',
+        doc="DetTrigCntr index of the line in the Prev* buffers",
+    )
+
+    TimestampCapt = attribute(
+        dtype='DevBoolean',
+        access=AttrWriteType.READ_WRITE,
+        doc="Capture the PCAP TS_START and TS_TRIG timestamps with every point",
+    )
+
+    TimestampOut = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+        unit="s",
+        doc="PCAP TS_TRIG timestamp of every point of the current line",
+    )
+
+    FirstPointGateOffset = attribute(
+        dtype='DevDouble',
+        unit="s",
+        doc="Time from the start of the capture gate (TS_START) to the capture (TS_TRIG) of the first point",
+    )
+
+    PointIntervalMean = attribute(
+        dtype='DevDouble',
+        unit="s",
+        doc="Mean interval between the points of the current line",
+    )
+
+    PointIntervalJitter = attribute(
+        dtype='DevDouble',
+        unit="s",
+        doc="Standard deviation of the interval between the points of the current line",
+    )
+
+    PointIntervalMin = attribute(
+        dtype='DevDouble',
+        unit="s",
+    )
+
+    PointIntervalMax = attribute(
+        dtype='DevDouble',
+        unit="s",
+    )
+
+    LineRecord = attribute(
+        dtype='DevEncoded',
+        doc="All channels of the current line packed in one binary record",
+    )
+
+    LineRecordCompression = attribute(
+        dtype=RecordCompression,
+        access=AttrWriteType.READ_WRITE,
+        doc="Compression of the LineRecord data",
+    )
+
+    HistoryIndices = attribute(
+        dtype=('DevLong64',),
+        max_dim_x=10000,
+        doc="Indices of the completed lines that can be read with ReadLine",
+    )
+
+    TraceLevel = attribute(
+        dtype=TraceLevel,
+        access=AttrWriteType.READ_WRITE,
+        doc="Level of the messages recorded in the trace buffer",
+    )
+
+    TraceSample = attribute(
+        dtype='DevLong',
+        access=AttrWriteType.READ_WRITE,
+        doc="Only every n-th message of the per-point trace sites is recorded",
+    )
+
+    SessionRecordFile = attribute(
+        dtype='DevString',
+        access=AttrWriteType.READ_WRITE,
+        doc="File the socket traffic is recorded to, empty to stop the recording",
+    )
+
+    MapLinesWritten = attribute(
+        dtype='DevLong',
+        doc="Number of lines written to the current on-disk map",
+    )
+
+    PassesPerLine = attribute(
+        dtype='DevLong',
+        access=AttrWriteType.READ_WRITE,
+        doc="Passes of every line, re-armed on END and accumulated into one line",
+    )
+
+    PrevLinePasses = attribute(
+        dtype='DevLong',
+        doc="Passes summed into the line in the Prev* buffers",
+    )
+
+    PMTPassVariance = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+        doc="Variance of the PMT counts over the passes of the last accumulated line",
+    )
+
+    PDiodePassVariance = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+        doc="Variance of the photodiode counts over the passes of the last accumulated line",
+    )
+
+    AcquisitionEfficiency = attribute(
+        dtype='DevDouble',
+        doc="Fraction of the last EfficiencyWindow seconds spent streaming the points of the lines",
+    )
+
+    PositionMonitorRate = attribute(
+        dtype='DevDouble',
+        access=AttrWriteType.READ_WRITE,
+        unit="Hz",
+        doc="Sampling rate of AbsX and AbsY, 0 pauses the sampling",
+    )
+
+    PositionHistory = attribute(
+        dtype=(('DevDouble',),),
+        max_dim_x=3,
+        max_dim_y=100000,
+        doc="Last samples of the position monitor, one (time, AbsX, AbsY) row each",
+    )
+
+    ContinuousCapture = attribute(
+        dtype='DevBoolean',
+        access=AttrWriteType.READ_WRITE,
+        doc="Capture the whole raster in one acquisition and split it into lines in software",
+    )
+
+    SegmentSlowStep = attribute(
+        dtype='DevDouble',
+        access=AttrWriteType.READ_WRITE,
+        unit="microns",
+        doc="Move of the slow axis starting a new line in the continuous capture",
+    )
+
+    SegmentDeadband = attribute(
+        dtype='DevDouble',
+        access=AttrWriteType.READ_WRITE,
+        unit="microns",
+        doc="Moves of the fast axis below it do not change its direction in the continuous capture",
+    )
+
+    SegmentDirection = attribute(
+        dtype='DevShort',
+        access=AttrWriteType.READ_WRITE,
+        doc="Fast axis direction of the kept lines, 1 or -1, 0 keeps both",
+    )
+
+    PrevXPosOut = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+    )
+
+    PrevYPosOut = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+    )
+
+    PrevDwellOut = attribute(
+        dtype=('DevDouble',),
+        max_dim_x=1000,
+    )
+
+    PrevPMTOut = attribute(
+        dtype=('DevULong64',),
+        max_dim_x=1000,
+    )
+
+    PrevPDiodeOut = attribute(
+        dtype=('DevULong64',),
+        max_dim_x=1000,
+    )
+
+    PrevPointNOut = attribute(
+        dtype=('DevULong64',),
+        max_dim_x=1000,
+    )
+
     # ---------------
     # General methods
     # ---------------
@@ -593,14 +1395,44 @@ class PandaPosTrig(Device):
         """Initialises the attributes and properties of the PandaPosTrig."""
         Device.init_device(self)
         # PROTECTED REGION ID(PandaPosTrig.init_device) ENABLED START #
+        self._tracer = Tracer(size=self.TraceBufferSize, logger=log)
+        self._timeline = timeline.Timeline(size=self.TimelineSize)
+        self._recorder = None
+        self._map = None
+        self.__map_first_line = 0
+        self.__map_index = 0
         self.__abs_x = 0
         self.__abs_y = 0
+        # monotonic time of the last position, valid if it could be read
+        self.__abs_pos_at = None
+        self.__abs_pos_valid = False
         self.__abs_x_offset = 0
         self.__abs_y_offset = 0
-        self.__int_ph_diode = 0
-        self.__int_pmt = 0
+        self._calibration = None
+        if self.CalibrationFile:
+            try:
+                self._calibration = load_calibration(self.CalibrationFile)
+            except (OSError, ValueError) as e:
+                log.error(f'Cannot load the calibration {self.CalibrationFile}, positions are not corrected: {e}')
+        try:
+            self._detectors = detectors.parse_channels(self.DetectorChannels,
+                                                       reserved=POINT_DTYPE.names)
+        except ValueError as e:
+            log.error(f'{e}, using the default detector channels')
+            self._detectors = detectors.parse_channels(detectors.DEFAULT_CHANNELS)
+        self.__zerod_values = {channel.name: 0 for channel in self._detectors}
+        self._det_out = EventBatcher(lambda batch: self.push_change_event('DetOut', batch),
+                                     1 + len(self._detectors),
+                                     max_rate=self.DetOutMaxRate,
+                                     max_batch=min(self.DetOutMaxBatch, 10000),
+                                     tracer=self._tracer)
+        self.set_change_event('DetOut', True, False)
+        columns = {channel.field: channel.capture_column for channel in self._detectors}
+        extra = detectors.extra_channels(self._detectors)
+        self.__extra_columns = [channel.capture_column for channel in extra]
         self.__trig_x_pos = 0.0
         self.__trig_y_pos = 0.0
+        self.__trig_pre_start = 0.1
         self.__trig_state = 'NEVER ARMED'
         self.__trig_axis = TrigAxis.Y
         self.__det_trig_src = DetTrigSrc.INTERNAL
@@ -608,67 +1440,89 @@ class PandaPosTrig(Device):
         self.__det_dwell = 10  # Detector dwell = 10 ms
         self.__det_trig_cntr = 0
         self.__det_point_cntr = 0
-        self.__det_time_pulse_n = 1
         self.__det_time_pulse_width = 1
         self.__det_time_pulse_step = 1
         self.__det_pos_capt = False
 
-        self._x_pos_out = []
-        self._y_pos_out = []
-        self.__dwell_out = []
-        self._pmt_out = []
-        self._p_diode_out = []
-        self.__point_n_out = []
-
-        # Parsing expressions
-        num_value = Word(nums+'-').setParseAction(lambda val: int(val[0]))
-        panda_OK_reply = Literal('OK')
-        panda_END_reply = Literal('END')
-        pcap_point_values = (num_value + num_value + num_value + num_value + num_value + num_value)
-        self.panda_line_repl = panda_OK_reply | pcap_point_values | panda_END_reply
-
-        try:
-            self.panda_ctrl_sock = self._get_panda_ctrl_socket()
-            self.panda_det_ctrl_sock = self._get_panda_ctrl_socket()
-            self.panda_det_data_sock = self._get_panda_data_socket()
-            self._sel_trig_axis(axis=self.__trig_axis,
-                                ctrl_socket=self.panda_ctrl_sock)
-        except Exception as e:
-            log.debug(f'Problem obtaining panda_ctrl_sock: {e}')
-
-        # Setting the detector dwell in the hardware
-        try:
-            self._set_det_dwell(self.__det_dwell, self.panda_ctrl_sock)
-        except Exception as e:
-            log.debug(f'Problem setting the initial detector dwell: {e}')
-
-        try:
-            self.__time_pulses_enable = False
-            self._det_time_pulse_switch(self.__time_pulses_enable, self.panda_ctrl_sock)
-        except Exception as e:
-            log.debug(f'Problem with the initialization of time-based block: {e}')
-
-        try:
-            self.t_zerod_acq = threading.Thread(target=self._read_zerod_det,
-                                                args=(self.panda_det_ctrl_sock,
-                                                self.__det_trig))
-            self.t_zerod_acq.setDaemon(True)
-            self.t_zerod_acq.start()
-        except Exception as e:
-            print(e)
-
-        try:
-            self.t_data_acq = threading.Thread(
-                                            target=self._panda_dataline_read,
-                                            args=(self.panda_det_data_sock,)
-            )
-            self.t_data_acq.setDaemon(True)
-            self.t_data_acq.start()
-        except Exception as e:
-            print(e)
-        self.set_state(DevState.ON)
+        self._lines = LineEpochs(extra=[channel.field for channel in extra])
+        self._history = LineHistory(max_lines=self.HistoryLines,
+                                    max_bytes=int(self.HistoryMaxMB * 2**20))
+        self.__timestamp_capt = False
+
+        self.__line_record_compression = RecordCompression.NONE
+
+        self.__double_buffer = False
+        self.__pre_armed = None
+        self._ctrl_lock = threading.RLock()
+        self._line_cond = threading.Condition()
+
+        self._preview = PreviewMap(size=self.PreviewSize, max_rate=self.PreviewMaxRate)
+        self.__preview_n_lines = self.PreviewSize
+        # The points per line are unknown until read from the PandABox
+        self._ingest = LineIngest(self._lines, self._complete_line,
+                                  line_end=self._line_end,
+                                  next_pass=self._next_pass,
+                                  notify=self._notify_line,
+                                  push_event=self._push_event,
+                                  preview=self._preview,
+                                  tracer=self._tracer,
+                                  timeline=self._timeline,
+                                  calibration=self._calibration,
+                                  pmt_column=columns.get('pmt') or pcap.PMT,
+                                  p_diode_column=columns.get('p_diode') or pcap.P_DIODE,
+                                  extra_columns=self.__extra_columns)
+        self._ingest.fast_x = self.__trig_axis == TrigAxis.X
+        self._ingest.point_period = self.__det_time_pulse_step / 1000
+        self._passes = self._ingest.passes
+        self._segmenter = self._ingest.segmenter
+        self.set_change_event('PreviewImage', True, False)
+        self.set_change_event('PrevLineIndex', True, False)
+        # Tango checks the change and archive criteria of the positions
+        for name in ('AbsX', 'AbsY'):
+            self.set_change_event(name, True, True)
+            self.set_archive_event(name, True, True)
+        # The current rate, set by the PositionMonitorRate attribute
+        self.__pos_monitor_rate = max(float(self.PositionMonitorDefaultRate), 0.)
+        self._pos_monitor = PositionMonitor(self._get_panda_ctrl_socket, self._on_position,
+                                            rate=self.__pos_monitor_rate,
+                                            size=self.PositionHistorySize)
+
+        self.__time_pulses_enable = False
+
+        # The sockets are opened and the hardware is configured in the background,
+        # the device stays in INIT until the PandABox answers.
+        self.panda_ctrl_sock = None
+        self.panda_det_ctrl_sock = None
+        self.panda_det_data_sock = None
+        self.t_data_acq = None
+        self._ingest_worker = None
+        self._stop_event = threading.Event()
+        self.set_state(DevState.INIT)
+        self.set_status(f'Connecting to the PandABox {self.PandaHost}')
+        self.t_connect = threading.Thread(target=self._connect_panda,
+                                          args=(self._stop_event,))
+        self.t_connect.setDaemon(True)
+        self.t_connect.start()
         # PROTECTED REGION END #    //  PandaPosTrig.init_device
 
+    def initialize_dynamic_attributes(self):
+        """Creates the attributes of the additional detector channels."""
+        # PROTECTED REGION ID(PandaPosTrig.initialize_dynamic_attributes) ENABLED START #
+        for channel in self._detectors:
+            if channel.builtin:
+                continue
+            self.add_attribute(attribute(name=f'Int{channel.name}',
+                                         dtype='DevULong64',
+                                         fget=self.read_IntChannel,
+                                         doc=f'{channel.name} counts of {channel.counter}'))
+            if channel.capture:
+                self.add_attribute(attribute(name=f'{channel.name}Out',
+                                             dtype=('DevULong64',),
+                                             max_dim_x=1000,
+                                             fget=self.read_ChannelOut,
+                                             doc=f'{channel.name} counts of {channel.capture} for every point'))
+        # PROTECTED REGION END #    //  PandaPosTrig.initialize_dynamic_attributes
+
     def always_executed_hook(self):
         """Method always executed before any TANGO command is executed."""
         # PROTECTED REGION ID(PandaPosTrig.always_executed_hook) ENABLED START #
@@ -682,6 +1536,29 @@ class PandaPosTrig(Device):
         destructor and by the device Init command.
         """
         # PROTECTED REGION ID(PandaPosTrig.delete_device) ENABLED START #
+        self._stop_event.set()
+        if self._ingest_worker is not None:
+            # The reader thread stops the worker and releases the shared memory
+            if self.t_data_acq is not None:
+                self.t_data_acq.join(5.)
+            self._ingest_worker = None
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        self._close_map()
+        for sock in (self.panda_ctrl_sock,
+                     self.panda_det_ctrl_sock,
+                     self.panda_det_data_sock):
+            if sock is not None:
+                try:
+                    # Wakes up a thread blocked in recv
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                try:
+                    sock.close()
+                except Exception as e:
+                    log.debug(f'Problem closing a PandABox socket: {e}')
         # PROTECTED REGION END #    //  PandaPosTrig.delete_device
     # ------------------
     # Attributes methods
@@ -690,7 +1567,7 @@ class PandaPosTrig(Device):
     def read_AbsX(self):
         # PROTECTED REGION ID(PandaPosTrig.AbsX_read) ENABLED START #
         """Return the AbsX attribute."""
-        return self.__abs_x - self.__abs_x_offset
+        return self.__abs_x - self.__abs_x_offset, time.time(), self._abs_pos_quality()
         # PROTECTED REGION END #    //  PandaPosTrig.AbsX_read
 
     def write_AbsX(self, value):
@@ -714,7 +1591,7 @@ class PandaPosTrig(Device):
     def read_AbsY(self):
         # PROTECTED REGION ID(PandaPosTrig.AbsY_read) ENABLED START #
         """Return the AbsY attribute."""
-        return self.__abs_y - self.__abs_y_offset
+        return self.__abs_y - self.__abs_y_offset, time.time(), self._abs_pos_quality()
         # PROTECTED REGION END #    //  PandaPosTrig.AbsY_read
 
     def write_AbsY(self, value):
@@ -783,7 +1660,8 @@ class PandaPosTrig(Device):
             resp = self._panda_block_write('PULSE1.PULSES?',
                                                     ctrl_socket=self.panda_ctrl_sock)
             _, pulses_N = resp.split('=')
-            return int(pulses_N)
+            self._ingest.n_points = int(pulses_N)
+            return self._ingest.n_points
         except Exception as e:
             log.debug(f'A problem in read_DetTimePulseN occured: {e}') 
         # PROTECTED REGION END #    //  PandaPosTrig.DetTimePulseN_read
@@ -793,8 +1671,13 @@ class PandaPosTrig(Device):
         """Set the DetTimePulseN attribute."""
         try:
             resp = self._panda_block_write(f'PULSE1.PULSES={value}', ctrl_socket=self.panda_ctrl_sock)
-            self.__det_time_pulse_n = value
+            self._ingest.n_points = value
             log.debug(f'PULSE1.PULSES={value}, resp: {resp}')
+            if self._ingest.segment_offset is None and value != self._preview.n_points:
+                # The preview columns follow the points per line, not the
+                # points per segment of a sparse scan
+                self._preview.reset(self.__preview_n_lines, value)
+                self.push_change_event('PreviewImage', self._preview.image())
         except Exception as e:
             log.debug(f'A problem in write_DetTimePulseN occured: {e}')
         # PROTECTED REGION END #    //  PandaPosTrig.DetTimePulseN_write
@@ -806,7 +1689,9 @@ class PandaPosTrig(Device):
             resp = self._panda_block_write('PULSE1.STEP?',
                                                     ctrl_socket=self.panda_ctrl_sock)
             _, det_time_pulse_step = resp.split('=')
-            return float(det_time_pulse_step)
+            self.__det_time_pulse_step = float(det_time_pulse_step)
+            self._ingest.point_period = self.__det_time_pulse_step / 1000
+            return self.__det_time_pulse_step
         except Exception as e:
             log.debug(f'A problem in read_DetTimePulseStep occured: {e}')
         # PROTECTED REGION END #    //  PandaPosTrig.DetTimePulseStep_read
@@ -817,6 +1702,7 @@ class PandaPosTrig(Device):
         try:
             resp = self._panda_block_write(f'PULSE1.STEP={value}', ctrl_socket=self.panda_ctrl_sock)
             self.__det_time_pulse_step = value
+            self._ingest.point_period = value / 1000
             log.debug(f'PULSE1.STEP={value}, resp: {resp}')
         except Exception as e:
             log.debug(f'A problem in write_DetTimePulseN occured: {e}')
@@ -918,13 +1804,25 @@ class PandaPosTrig(Device):
     def read_IntPMT(self):
         # PROTECTED REGION ID(PandaPosTrig.IntPMT_read) ENABLED START #
         """Return the IntPMT attribute."""
-        return self.__int_pmt
+        return self.__zerod_values.get('PMT', 0)
         # PROTECTED REGION END #    //  PandaPosTrig.IntPMT_read
 
+    def read_IntChannel(self, attr):
+        # PROTECTED REGION ID(PandaPosTrig.IntChannel_read) ENABLED START #
+        """Return the Int<name> attribute of a detector channel."""
+        return self.__zerod_values.get(attr.get_name()[len('Int'):], 0)
+        # PROTECTED REGION END #    //  PandaPosTrig.IntChannel_read
+
+    def read_ChannelOut(self, attr):
+        # PROTECTED REGION ID(PandaPosTrig.ChannelOut_read) ENABLED START #
+        """Return the <name>Out attribute of a detector channel."""
+        return self._lines.armed_line()[attr.get_name()[:-len('Out')]]
+        # PROTECTED REGION END #    //  PandaPosTrig.ChannelOut_read
+
     def read_IntPhDiode(self):
         # PROTECTED REGION ID(PandaPosTrig.IntPhDiode_read) ENABLED START #
         """Return the IntPhDiode attribute."""
-        return self.__int_ph_diode
+        return self.__zerod_values.get('PhDiode', 0)
         # PROTECTED REGION END #    //  PandaPosTrig.IntPhDiode_read
 
     def read_TrigAxis(self):
@@ -937,6 +1835,7 @@ class PandaPosTrig(Device):
         # PROTECTED REGION ID(PandaPosTrig.TrigAxis_write) ENABLED START #
         """Set the TrigAxis attribute."""
         self.__trig_axis = TrigAxis(value)
+        self._ingest.fast_x = self.__trig_axis == TrigAxis.X
         self._sel_trig_axis(axis=self.__trig_axis, ctrl_socket=self.panda_ctrl_sock)
         if self.__trig_axis == TrigAxis.X:
             trig_pos = self.__trig_x_pos + self.__abs_x_offset
@@ -962,6 +1861,22 @@ class PandaPosTrig(Device):
         self.__trig_x_pos = value
         # PROTECTED REGION END #    //  PandaPosTrig.TrigXPos_write
 
+    def read_TrigPreStart(self):
+        # PROTECTED REGION ID(PandaPosTrig.TrigPreStart_read) ENABLED START #
+        """Return the TrigPreStart attribute."""
+        return self.__trig_pre_start
+        # PROTECTED REGION END #    //  PandaPosTrig.TrigPreStart_read
+
+    def write_TrigPreStart(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.TrigPreStart_write) ENABLED START #
+        """Set the TrigPreStart attribute."""
+        if value <= 0:
+            tango.Except.throw_exception('InvalidValue',
+                                         'TrigPreStart has to be positive',
+                                         'PandaPosTrig.write_TrigPreStart')
+        self.__trig_pre_start = value
+        # PROTECTED REGION END #    //  PandaPosTrig.TrigPreStart_write
+
     def read_TrigYPos(self):
         # PROTECTED REGION ID(PandaPosTrig.TrigYPos_read) ENABLED START #
         """Return the TrigYPos attribute."""
@@ -1001,39 +1916,459 @@ class PandaPosTrig(Device):
     def read_XPosOut(self):
         # PROTECTED REGION ID(PandaPosTrig.XPosOut_read) ENABLED START #
         """Return the XPosOut attribute."""
-        return self._x_pos_out
+        with self._timeline.span('read XPosOut', 'read'):
+            return self._lines.armed_line()['x']
         # PROTECTED REGION END #    //  PandaPosTrig.XPosOut_read
 
     def read_YPosOut(self):
         # PROTECTED REGION ID(PandaPosTrig.YPosOut_read) ENABLED START #
         """Return the YPosOut attribute."""
-        return self._y_pos_out
+        with self._timeline.span('read YPosOut', 'read'):
+            return self._lines.armed_line()['y']
         # PROTECTED REGION END #    //  PandaPosTrig.YPosOut_read
 
     def read_DwellOut(self):
         # PROTECTED REGION ID(PandaPosTrig.DwellOut_read) ENABLED START #
         """Return the DwellOut attribute."""
-        return self.__dwell_out
+        with self._timeline.span('read DwellOut', 'read'):
+            return self._lines.armed_line()['dwell']
         # PROTECTED REGION END #    //  PandaPosTrig.DwellOut_read
 
     def read_PMTOut(self):
         # PROTECTED REGION ID(PandaPosTrig.PMTOut_read) ENABLED START #
         """Return the PMTOut attribute."""
-        return self._pmt_out
+        with self._timeline.span('read PMTOut', 'read'):
+            return self._lines.armed_line()['pmt']
         # PROTECTED REGION END #    //  PandaPosTrig.PMTOut_read
 
     def read_PDiodeOut(self):
         # PROTECTED REGION ID(PandaPosTrig.PDiodeOut_read) ENABLED START #
         """Return the PDiodeOut attribute."""
-        return self._p_diode_out
+        with self._timeline.span('read PDiodeOut', 'read'):
+            return self._lines.armed_line()['p_diode']
         # PROTECTED REGION END #    //  PandaPosTrig.PDiodeOut_read
 
     def read_PointNOut(self):
         # PROTECTED REGION ID(PandaPosTrig.PointNOut_read) ENABLED START #
         """Return the PointNOut attribute."""
-        return self.__point_n_out
+        with self._timeline.span('read PointNOut', 'read'):
+            return self._lines.armed_line()['point_n']
         # PROTECTED REGION END #    //  PandaPosTrig.PointNOut_read
 
+    def read_PreviewNLines(self):
+        # PROTECTED REGION ID(PandaPosTrig.PreviewNLines_read) ENABLED START #
+        """Return the PreviewNLines attribute."""
+        return self.__preview_n_lines
+        # PROTECTED REGION END #    //  PandaPosTrig.PreviewNLines_read
+
+    def write_PreviewNLines(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.PreviewNLines_write) ENABLED START #
+        """Set the PreviewNLines attribute."""
+        self.__preview_n_lines = value
+        self._preview.reset(self.__preview_n_lines, self._ingest.n_points)
+        # PROTECTED REGION END #    //  PandaPosTrig.PreviewNLines_write
+
+    def read_PreviewImage(self):
+        # PROTECTED REGION ID(PandaPosTrig.PreviewImage_read) ENABLED START #
+        """Return the PreviewImage attribute."""
+        with self._timeline.span('read PreviewImage', 'read'):
+            return self._preview.image()
+        # PROTECTED REGION END #    //  PandaPosTrig.PreviewImage_read
+
+    def read_SegmentOffset(self):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentOffset_read) ENABLED START #
+        """Return the SegmentOffset attribute."""
+        if self._ingest.segment_offset is None:
+            return []
+        return list(self._ingest.segment_offset[1:])
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentOffset_read
+
+    def write_SegmentOffset(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentOffset_write) ENABLED START #
+        """Set the SegmentOffset attribute."""
+        if len(value) != 2:
+            tango.Except.throw_exception('InvalidSegmentOffset',
+                                         'SegmentOffset takes the map row and column',
+                                         'PandaPosTrig.write_SegmentOffset')
+        row, column = (int(v) for v in value)
+        # The offset holds from the next armed line on, until ResetTrigCntr
+        self._ingest.segment_offset = (self._next_line(), row, column)
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentOffset_write
+
+    def read_PMTSum(self):
+        # PROTECTED REGION ID(PandaPosTrig.PMTSum_read) ENABLED START #
+        """Return the PMTSum attribute."""
+        return self._lines.armed_line().pmt_stats.sum
+        # PROTECTED REGION END #    //  PandaPosTrig.PMTSum_read
+
+    def read_PMTMean(self):
+        # PROTECTED REGION ID(PandaPosTrig.PMTMean_read) ENABLED START #
+        """Return the PMTMean attribute."""
+        return self._lines.armed_line().pmt_stats.mean
+        # PROTECTED REGION END #    //  PandaPosTrig.PMTMean_read
+
+    def read_PMTMin(self):
+        # PROTECTED REGION ID(PandaPosTrig.PMTMin_read) ENABLED START #
+        """Return the PMTMin attribute."""
+        return self._lines.armed_line().pmt_stats.min or 0
+        # PROTECTED REGION END #    //  PandaPosTrig.PMTMin_read
+
+    def read_PMTMax(self):
+        # PROTECTED REGION ID(PandaPosTrig.PMTMax_read) ENABLED START #
+        """Return the PMTMax attribute."""
+        return self._lines.armed_line().pmt_stats.max or 0
+        # PROTECTED REGION END #    //  PandaPosTrig.PMTMax_read
+
+    def read_PDiodeSum(self):
+        # PROTECTED REGION ID(PandaPosTrig.PDiodeSum_read) ENABLED START #
+        """Return the PDiodeSum attribute."""
+        return self._lines.armed_line().p_diode_stats.sum
+        # PROTECTED REGION END #    //  PandaPosTrig.PDiodeSum_read
+
+    def read_PDiodeMean(self):
+        # PROTECTED REGION ID(PandaPosTrig.PDiodeMean_read) ENABLED START #
+        """Return the PDiodeMean attribute."""
+        return self._lines.armed_line().p_diode_stats.mean
+        # PROTECTED REGION END #    //  PandaPosTrig.PDiodeMean_read
+
+    def read_PDiodeMin(self):
+        # PROTECTED REGION ID(PandaPosTrig.PDiodeMin_read) ENABLED START #
+        """Return the PDiodeMin attribute."""
+        return self._lines.armed_line().p_diode_stats.min or 0
+        # PROTECTED REGION END #    //  PandaPosTrig.PDiodeMin_read
+
+    def read_PDiodeMax(self):
+        # PROTECTED REGION ID(PandaPosTrig.PDiodeMax_read) ENABLED START #
+        """Return the PDiodeMax attribute."""
+        return self._lines.armed_line().p_diode_stats.max or 0
+        # PROTECTED REGION END #    //  PandaPosTrig.PDiodeMax_read
+
+    def read_PMTPDiodeRatio(self):
+        # PROTECTED REGION ID(PandaPosTrig.PMTPDiodeRatio_read) ENABLED START #
+        """Return the PMTPDiodeRatio attribute."""
+        line = self._lines.armed_line()
+        return ratio(line.pmt_stats.sum, line.p_diode_stats.sum)
+        # PROTECTED REGION END #    //  PandaPosTrig.PMTPDiodeRatio_read
+
+    def read_TransmissionOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.TransmissionOut_read) ENABLED START #
+        """Return the TransmissionOut attribute."""
+        with self._timeline.span('read TransmissionOut', 'read'):
+            return self._lines.armed_line()['transmission']
+        # PROTECTED REGION END #    //  PandaPosTrig.TransmissionOut_read
+
+    def read_DoubleBuffer(self):
+        # PROTECTED REGION ID(PandaPosTrig.DoubleBuffer_read) ENABLED START #
+        """Return the DoubleBuffer attribute."""
+        return self.__double_buffer
+        # PROTECTED REGION END #    //  PandaPosTrig.DoubleBuffer_read
+
+    def write_DoubleBuffer(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.DoubleBuffer_write) ENABLED START #
+        """Set the DoubleBuffer attribute."""
+        self.__double_buffer = value
+        self.__pre_armed = None
+        # PROTECTED REGION END #    //  PandaPosTrig.DoubleBuffer_write
+
+    def read_PrevLineIndex(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevLineIndex_read) ENABLED START #
+        """Return the PrevLineIndex attribute."""
+        return self._lines.completed.index
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevLineIndex_read
+
+    def read_PrevXPosOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevXPosOut_read) ENABLED START #
+        """Return the PrevXPosOut attribute."""
+        with self._timeline.span('read PrevXPosOut', 'read'):
+            return self._lines.completed['x']
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevXPosOut_read
+
+    def read_PrevYPosOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevYPosOut_read) ENABLED START #
+        """Return the PrevYPosOut attribute."""
+        with self._timeline.span('read PrevYPosOut', 'read'):
+            return self._lines.completed['y']
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevYPosOut_read
+
+    def read_PrevDwellOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevDwellOut_read) ENABLED START #
+        """Return the PrevDwellOut attribute."""
+        with self._timeline.span('read PrevDwellOut', 'read'):
+            return self._lines.completed['dwell']
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevDwellOut_read
+
+    def read_PrevPMTOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevPMTOut_read) ENABLED START #
+        """Return the PrevPMTOut attribute."""
+        with self._timeline.span('read PrevPMTOut', 'read'):
+            return self._lines.completed['pmt']
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevPMTOut_read
+
+    def read_PrevPDiodeOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevPDiodeOut_read) ENABLED START #
+        """Return the PrevPDiodeOut attribute."""
+        with self._timeline.span('read PrevPDiodeOut', 'read'):
+            return self._lines.completed['p_diode']
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevPDiodeOut_read
+
+    def read_PrevPointNOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevPointNOut_read) ENABLED START #
+        """Return the PrevPointNOut attribute."""
+        with self._timeline.span('read PrevPointNOut', 'read'):
+            return self._lines.completed['point_n']
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevPointNOut_read
+
+    def read_HistoryIndices(self):
+        # PROTECTED REGION ID(PandaPosTrig.HistoryIndices_read) ENABLED START #
+        """Return the HistoryIndices attribute."""
+        return self._history.indices()
+        # PROTECTED REGION END #    //  PandaPosTrig.HistoryIndices_read
+
+    def read_TraceLevel(self):
+        # PROTECTED REGION ID(PandaPosTrig.TraceLevel_read) ENABLED START #
+        """Return the TraceLevel attribute."""
+        return self._tracer.level
+        # PROTECTED REGION END #    //  PandaPosTrig.TraceLevel_read
+
+    def write_TraceLevel(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.TraceLevel_write) ENABLED START #
+        """Set the TraceLevel attribute."""
+        self._tracer.level = TraceLevel(value)
+        # PROTECTED REGION END #    //  PandaPosTrig.TraceLevel_write
+
+    def read_TraceSample(self):
+        # PROTECTED REGION ID(PandaPosTrig.TraceSample_read) ENABLED START #
+        """Return the TraceSample attribute."""
+        return self._tracer.sample
+        # PROTECTED REGION END #    //  PandaPosTrig.TraceSample_read
+
+    def write_TraceSample(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.TraceSample_write) ENABLED START #
+        """Set the TraceSample attribute."""
+        self._tracer.sample = max(int(value), 1)
+        # PROTECTED REGION END #    //  PandaPosTrig.TraceSample_write
+
+    def read_SessionRecordFile(self):
+        # PROTECTED REGION ID(PandaPosTrig.SessionRecordFile_read) ENABLED START #
+        """Return the SessionRecordFile attribute."""
+        recorder = self._recorder
+        return recorder.path if recorder is not None else ''
+        # PROTECTED REGION END #    //  PandaPosTrig.SessionRecordFile_read
+
+    def write_SessionRecordFile(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.SessionRecordFile_write) ENABLED START #
+        """Set the SessionRecordFile attribute."""
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.close()
+            log.info(f'Session recording to {recorder.path} stopped')
+        if value:
+            self._recorder = session.SessionRecorder(value)
+            log.info(f'Session recording to {value} started')
+        # PROTECTED REGION END #    //  PandaPosTrig.SessionRecordFile_write
+
+    def read_MapLinesWritten(self):
+        # PROTECTED REGION ID(PandaPosTrig.MapLinesWritten_read) ENABLED START #
+        """Return the MapLinesWritten attribute."""
+        scan_map = self._map
+        return scan_map.lines_written if scan_map is not None else 0
+        # PROTECTED REGION END #    //  PandaPosTrig.MapLinesWritten_read
+
+    def read_PassesPerLine(self):
+        # PROTECTED REGION ID(PandaPosTrig.PassesPerLine_read) ENABLED START #
+        """Return the PassesPerLine attribute."""
+        return self._passes.passes
+        # PROTECTED REGION END #    //  PandaPosTrig.PassesPerLine_read
+
+    def write_PassesPerLine(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.PassesPerLine_write) ENABLED START #
+        """Set the PassesPerLine attribute."""
+        self._passes.passes = max(value, 1)
+        # PROTECTED REGION END #    //  PandaPosTrig.PassesPerLine_write
+
+    def read_PrevLinePasses(self):
+        # PROTECTED REGION ID(PandaPosTrig.PrevLinePasses_read) ENABLED START #
+        """Return the PrevLinePasses attribute."""
+        return self._lines.completed.passes
+        # PROTECTED REGION END #    //  PandaPosTrig.PrevLinePasses_read
+
+    def read_PMTPassVariance(self):
+        # PROTECTED REGION ID(PandaPosTrig.PMTPassVariance_read) ENABLED START #
+        """Return the PMTPassVariance attribute."""
+        return self._ingest.pass_variance.get('pmt', [])
+        # PROTECTED REGION END #    //  PandaPosTrig.PMTPassVariance_read
+
+    def read_PDiodePassVariance(self):
+        # PROTECTED REGION ID(PandaPosTrig.PDiodePassVariance_read) ENABLED START #
+        """Return the PDiodePassVariance attribute."""
+        return self._ingest.pass_variance.get('p_diode', [])
+        # PROTECTED REGION END #    //  PandaPosTrig.PDiodePassVariance_read
+
+    def read_AcquisitionEfficiency(self):
+        # PROTECTED REGION ID(PandaPosTrig.AcquisitionEfficiency_read) ENABLED START #
+        """Return the AcquisitionEfficiency attribute."""
+        return self._timeline.efficiency(self.EfficiencyWindow)
+        # PROTECTED REGION END #    //  PandaPosTrig.AcquisitionEfficiency_read
+
+    def read_LineRecord(self):
+        # PROTECTED REGION ID(PandaPosTrig.LineRecord_read) ENABLED START #
+        """Return the LineRecord attribute."""
+        with self._timeline.span('read LineRecord', 'read'):
+            line = self._lines.armed_line()
+            return pack_line(line.index, line.channels(), self.__line_record_compression)
+        # PROTECTED REGION END #    //  PandaPosTrig.LineRecord_read
+
+    def read_LineRecordCompression(self):
+        # PROTECTED REGION ID(PandaPosTrig.LineRecordCompression_read) ENABLED START #
+        """Return the LineRecordCompression attribute."""
+        return self.__line_record_compression
+        # PROTECTED REGION END #    //  PandaPosTrig.LineRecordCompression_read
+
+    def write_LineRecordCompression(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.LineRecordCompression_write) ENABLED START #
+        """Set the LineRecordCompression attribute."""
+        self.__line_record_compression = RecordCompression(value)
+        # PROTECTED REGION END #    //  PandaPosTrig.LineRecordCompression_write
+
+    def read_TimestampCapt(self):
+        # PROTECTED REGION ID(PandaPosTrig.TimestampCapt_read) ENABLED START #
+        """Return the TimestampCapt attribute."""
+        return self.__timestamp_capt
+        # PROTECTED REGION END #    //  PandaPosTrig.TimestampCapt_read
+
+    def write_TimestampCapt(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.TimestampCapt_write) ENABLED START #
+        """Set the TimestampCapt attribute."""
+        capture = 'Value' if value else 'No'
+        for field in (pcap.TS_START, pcap.TS_TRIG):
+            resp = self._panda_block_write(f'{field}.CAPTURE={capture}', ctrl_socket=self.panda_ctrl_sock)
+            log.debug(f'{field}.CAPTURE={capture}, resp: {resp}')
+        self.__timestamp_capt = value
+        # PROTECTED REGION END #    //  PandaPosTrig.TimestampCapt_write
+
+    def read_TimestampOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.TimestampOut_read) ENABLED START #
+        """Return the TimestampOut attribute."""
+        with self._timeline.span('read TimestampOut', 'read'):
+            return self._lines.armed_line()['timestamp']
+        # PROTECTED REGION END #    //  PandaPosTrig.TimestampOut_read
+
+    def read_FirstPointGateOffset(self):
+        # PROTECTED REGION ID(PandaPosTrig.FirstPointGateOffset_read) ENABLED START #
+        """Return the FirstPointGateOffset attribute."""
+        return self._lines.armed_line().gate_offset
+        # PROTECTED REGION END #    //  PandaPosTrig.FirstPointGateOffset_read
+
+    def read_PointIntervalMean(self):
+        # PROTECTED REGION ID(PandaPosTrig.PointIntervalMean_read) ENABLED START #
+        """Return the PointIntervalMean attribute."""
+        return self._lines.armed_line().interval_stats.mean
+        # PROTECTED REGION END #    //  PandaPosTrig.PointIntervalMean_read
+
+    def read_PointIntervalJitter(self):
+        # PROTECTED REGION ID(PandaPosTrig.PointIntervalJitter_read) ENABLED START #
+        """Return the PointIntervalJitter attribute."""
+        return self._lines.armed_line().interval_stats.std
+        # PROTECTED REGION END #    //  PandaPosTrig.PointIntervalJitter_read
+
+    def read_PointIntervalMin(self):
+        # PROTECTED REGION ID(PandaPosTrig.PointIntervalMin_read) ENABLED START #
+        """Return the PointIntervalMin attribute."""
+        return self._lines.armed_line().interval_stats.min or 0.
+        # PROTECTED REGION END #    //  PandaPosTrig.PointIntervalMin_read
+
+    def read_PointIntervalMax(self):
+        # PROTECTED REGION ID(PandaPosTrig.PointIntervalMax_read) ENABLED START #
+        """Return the PointIntervalMax attribute."""
+        return self._lines.armed_line().interval_stats.max or 0.
+        # PROTECTED REGION END #    //  PandaPosTrig.PointIntervalMax_read
+
+    def read_DetOut(self):
+        # PROTECTED REGION ID(PandaPosTrig.DetOut_read) ENABLED START #
+        """Return the DetOut attribute."""
+        return self._det_out.last
+        # PROTECTED REGION END #    //  PandaPosTrig.DetOut_read
+
+    def read_DetOutBacklog(self):
+        # PROTECTED REGION ID(PandaPosTrig.DetOutBacklog_read) ENABLED START #
+        """Return the DetOutBacklog attribute."""
+        return self._det_out.backlog
+        # PROTECTED REGION END #    //  PandaPosTrig.DetOutBacklog_read
+
+    def read_PositionMonitorRate(self):
+        # PROTECTED REGION ID(PandaPosTrig.PositionMonitorRate_read) ENABLED START #
+        """Return the PositionMonitorRate attribute."""
+        return self.__pos_monitor_rate
+        # PROTECTED REGION END #    //  PandaPosTrig.PositionMonitorRate_read
+
+    def write_PositionMonitorRate(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.PositionMonitorRate_write) ENABLED START #
+        """Set the PositionMonitorRate attribute."""
+        self.__pos_monitor_rate = max(float(value), 0.)
+        self._pos_monitor.rate = self.__pos_monitor_rate
+        # PROTECTED REGION END #    //  PandaPosTrig.PositionMonitorRate_write
+
+    def read_PositionHistory(self):
+        # PROTECTED REGION ID(PandaPosTrig.PositionHistory_read) ENABLED START #
+        """Return the PositionHistory attribute."""
+        history = self._pos_monitor.history()
+        abs_x, abs_y = history[:, 1] / 1000, history[:, 2] / 1000
+        if self._calibration is not None:
+            abs_x, abs_y = self._calibration.apply(abs_x, abs_y)
+        history[:, 1] = abs_x * self.AbsXSign - self.__abs_x_offset
+        history[:, 2] = abs_y * self.AbsYSign - self.__abs_y_offset
+        return history
+        # PROTECTED REGION END #    //  PandaPosTrig.PositionHistory_read
+
+    def read_ContinuousCapture(self):
+        # PROTECTED REGION ID(PandaPosTrig.ContinuousCapture_read) ENABLED START #
+        """Return the ContinuousCapture attribute."""
+        return self._ingest.continuous
+        # PROTECTED REGION END #    //  PandaPosTrig.ContinuousCapture_read
+
+    def write_ContinuousCapture(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.ContinuousCapture_write) ENABLED START #
+        """Set the ContinuousCapture attribute."""
+        self._segmenter.reset()
+        self._ingest.continuous = value
+        # PROTECTED REGION END #    //  PandaPosTrig.ContinuousCapture_write
+
+    def read_SegmentSlowStep(self):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentSlowStep_read) ENABLED START #
+        """Return the SegmentSlowStep attribute."""
+        return self._segmenter.slow_step
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentSlowStep_read
+
+    def write_SegmentSlowStep(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentSlowStep_write) ENABLED START #
+        """Set the SegmentSlowStep attribute."""
+        self._segmenter.slow_step = value
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentSlowStep_write
+
+    def read_SegmentDeadband(self):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentDeadband_read) ENABLED START #
+        """Return the SegmentDeadband attribute."""
+        return self._segmenter.deadband
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentDeadband_read
+
+    def write_SegmentDeadband(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentDeadband_write) ENABLED START #
+        """Set the SegmentDeadband attribute."""
+        self._segmenter.deadband = value
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentDeadband_write
+
+    def read_SegmentDirection(self):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentDirection_read) ENABLED START #
+        """Return the SegmentDirection attribute."""
+        return self._ingest.segment_direction
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentDirection_read
+
+    def write_SegmentDirection(self, value):
+        # PROTECTED REGION ID(PandaPosTrig.SegmentDirection_write) ENABLED START #
+        """Set the SegmentDirection attribute."""
+        self._ingest.segment_direction = (value > 0) - (value < 0)
+        # PROTECTED REGION END #    //  PandaPosTrig.SegmentDirection_write
+
     # --------
     # Commands
     # --------
@@ -1048,35 +2383,33 @@ class PandaPosTrig(Device):
 
         :return:None
         """
-        if self.__trig_axis == TrigAxis.X:
-            trig_pos = self.__trig_x_pos + self.__abs_x_offset
-            axis_sign = self.AbsXSign
-        elif self.__trig_axis == TrigAxis.Y:
-            trig_pos = self.__trig_y_pos + self.__abs_y_offset
-            axis_sign = self.AbsYSign
-        
-        self._set_axis_trig(trig_pos,
-                            axis=self.__trig_axis,
-                            axis_sign=axis_sign,
-                            ctrl_socket=self.panda_ctrl_sock)
-        self.set_state(DevState.RUNNING)
-        self._arm_axis(ctrl_socket=self.panda_ctrl_sock)
-        if self.get_state() not in [DevState.FAULT, ]:
-            self.set_state(DevState.ON)
-        
-        self.__det_trig_cntr += 1
-        
-        self._x_pos_out = []
-        self._y_pos_out = []
-        self.__dwell_out = []
-        self._pmt_out = []
-        self._p_diode_out = []
-        self.__point_n_out = []
+        with self._timeline.span('ArmSingle', 'command'):
+            if self.__double_buffer and self.__pre_armed is not None:
+                # The line has already been armed at the end of the previous one,
+                # only a changed trigger position or pre-start has to be reprogrammed.
+                if self.__pre_armed != self._line_trig():
+                    self.set_state(DevState.RUNNING)
+                    self._arm_line()
+                    if self.get_state() not in [DevState.FAULT, ]:
+                        self.set_state(DevState.ON)
+                self.__pre_armed = None
+                return
+
+            self.set_state(DevState.RUNNING)
+            self._arm_line()
+            if self.get_state() not in [DevState.FAULT, ]:
+                self.set_state(DevState.ON)
+
+            self.__det_trig_cntr += 1
+            # Points arriving from now on belong to the new line, the data
+            # thread completes the previous one if it is still open
+            self._lines.arm(self.__det_trig_cntr - 1)
+            self._notify_line()
         # PROTECTED REGION END #    //  PandaPosTrig.ArmSingle
 
     def is_ArmSingle_allowed(self):
         # PROTECTED REGION ID(PandaPosTrig.is_ArmSingle_allowed) ENABLED START #
-        return self.get_state() not in [DevState.FAULT,DevState.RUNNING]
+        return self.get_state() not in [DevState.FAULT,DevState.RUNNING,DevState.INIT]
         # PROTECTED REGION END #    //  PandaPosTrig.is_ArmSingle_allowed
 
     @command(
@@ -1101,7 +2434,9 @@ class PandaPosTrig(Device):
 
         :return:None
         """
+        self._check_abs_pos('PandaPosTrig.SetXTrigToCurr')
         self.__trig_axis = TrigAxis.X
+        self._ingest.fast_x = self.__trig_axis == TrigAxis.X
         self.__trig_x_pos = self.__abs_x - self.__abs_x_offset
         self._sel_trig_axis(axis=self.__trig_axis,
                             ctrl_socket=self.panda_ctrl_sock)
@@ -1121,8 +2456,10 @@ class PandaPosTrig(Device):
 
         :return:None
         """
+        self._check_abs_pos('PandaPosTrig.SetYTrigToCurr')
         self.__trig_y_pos = self.__abs_y - self.__abs_y_offset
         self.__trig_axis = TrigAxis.Y
+        self._ingest.fast_x = self.__trig_axis == TrigAxis.X
         self._sel_trig_axis(axis=self.__trig_axis,
                             ctrl_socket=self.panda_ctrl_sock)
         self._set_axis_trig(self.__trig_y_pos + self.__abs_y_offset,
@@ -1193,11 +2530,300 @@ class PandaPosTrig(Device):
             Resets trigger counter, counts the number of times ArmSingle is called,
             supposed to be equivalent to the number of lines acquired
 
+            The lines are indexed by the counter, the lines and the
+            SegmentOffset of the previous scan are forgotten and PrevLineIndex
+            is -1 again.
+
         :return:None
         """
         self.__det_trig_cntr = 0
+        self.__det_point_cntr = 0
+        self.__pre_armed = None
+        self._ingest.reset()
+        self._history.clear()
+        self._notify_line()
+        self._push_event('PrevLineIndex', self._lines.completed.index)
         # PROTECTED REGION END #    //  PandaPosTrig.ResetTrigCntr
 
+    @command(
+    )
+    @DebugIt()
+    def ResetPreview(self):
+        # PROTECTED REGION ID(PandaPosTrig.ResetPreview) ENABLED START #
+        """
+        Clears the live preview, the preview shape follows PreviewNLines and DetTimePulseN
+
+        :return:None
+        """
+        self._preview.reset(self.__preview_n_lines, self._ingest.n_points)
+        self.push_change_event('PreviewImage', self._preview.image())
+        # PROTECTED REGION END #    //  PandaPosTrig.ResetPreview
+
+    @command(
+        dtype_in='DevLong',
+        doc_in="Number of lines of the map",
+        dtype_out='DevString',
+        doc_out="Path of the map file",
+    )
+    @DebugIt()
+    def StartMap(self, argin):
+        # PROTECTED REGION ID(PandaPosTrig.StartMap) ENABLED START #
+        """
+        Starts writing the following lines, of DetTimePulseN points each, into a
+        memory-mapped .npy file given by the MapFile property, in which {index}
+        is replaced by the number of the map, e.g. for energy stacks. The
+        segments of a sparse scan are written at their SegmentOffset.
+
+        :param argin: 'DevLong'
+        Number of lines of the map
+
+        :return:'DevString'
+        Path of the map file
+        """
+        if not self.MapFile:
+            tango.Except.throw_exception('MapFileNotSet',
+                                         'The MapFile property is not set',
+                                         'PandaPosTrig.StartMap')
+        if argin <= 0:
+            tango.Except.throw_exception('InvalidMapLines',
+                                         f'The number of map lines must be positive, not {argin}',
+                                         'PandaPosTrig.StartMap')
+        if self._ingest.n_points <= 0:
+            tango.Except.throw_exception('MapPointsNotSet',
+                                         'DetTimePulseN, the points per map line, is not set',
+                                         'PandaPosTrig.StartMap')
+        self._close_map()
+        self.__map_index += 1
+        path = self.MapFile.format(index=self.__map_index)
+        channels = RECORD_CHANNELS + self._lines.dtype.names[len(POINT_DTYPE.names):]
+        dtype = np.dtype([(name, self._lines.dtype[name]) for name in channels])
+        self._map = ScanMap(path, argin, self._ingest.n_points, dtype,
+                            float_dtype=self.MapDtype or None)
+        # The next armed line is the first line of the map
+        self.__map_first_line = self._next_line()
+        log.info(f'Writing a {argin}x{self._ingest.n_points} map to {path}')
+        return path
+        # PROTECTED REGION END #    //  PandaPosTrig.StartMap
+
+    def is_StartMap_allowed(self):
+        # PROTECTED REGION ID(PandaPosTrig.is_StartMap_allowed) ENABLED START #
+        return self.get_state() not in [DevState.FAULT,DevState.RUNNING,DevState.INIT]
+        # PROTECTED REGION END #    //  PandaPosTrig.is_StartMap_allowed
+
+    @command(
+        dtype_out='DevString',
+        doc_out="Path of the closed map file, empty if there was none",
+    )
+    @DebugIt()
+    def StopMap(self):
+        # PROTECTED REGION ID(PandaPosTrig.StopMap) ENABLED START #
+        """
+        Flushes and closes the on-disk map, which can then be opened with
+        numpy.load(path, mmap_mode='r').
+
+        :return:'DevString'
+        Path of the closed map file, empty if there was none
+        """
+        return self._close_map()
+        # PROTECTED REGION END #    //  PandaPosTrig.StopMap
+
+    @command(
+        dtype_in='DevLong',
+        doc_in="Number of the last records, 0 for all",
+        dtype_out='DevVarStringArray',
+        doc_out="Formatted trace records, oldest first",
+    )
+    @DebugIt()
+    def DumpTrace(self, argin):
+        # PROTECTED REGION ID(PandaPosTrig.DumpTrace) ENABLED START #
+        """
+        Returns the last records of the trace buffer, the messages are only
+        formatted now.
+
+        :param argin: 'DevLong'
+        Number of the last records, 0 for all
+
+        :return:'DevVarStringArray'
+        Formatted trace records, oldest first
+        """
+        return self._tracer.dump(argin)
+        # PROTECTED REGION END #    //  PandaPosTrig.DumpTrace
+
+    @command(
+    )
+    @DebugIt()
+    def ClearTrace(self):
+        # PROTECTED REGION ID(PandaPosTrig.ClearTrace) ENABLED START #
+        """
+        Clears the trace buffer.
+
+        :return:None
+        """
+        self._tracer.clear()
+        # PROTECTED REGION END #    //  PandaPosTrig.ClearTrace
+
+    @command(
+        dtype_in='DevDouble',
+        doc_in="Seconds of the timeline to export, 0 for all",
+        dtype_out='DevString',
+        doc_out="Chrome/Perfetto trace JSON",
+    )
+    @DebugIt()
+    def ExportTimeline(self, argin):
+        # PROTECTED REGION ID(PandaPosTrig.ExportTimeline) ENABLED START #
+        """
+        Returns the spans of the scan timeline recorded in the last seconds,
+        to be opened with chrome://tracing or ui.perfetto.dev.
+
+        :param argin: 'DevDouble'
+        Seconds of the timeline to export, 0 for all
+
+        :return:'DevString'
+        Chrome/Perfetto trace JSON
+        """
+        return self._timeline.export(argin)
+        # PROTECTED REGION END #    //  PandaPosTrig.ExportTimeline
+
+    @command(
+    )
+    @DebugIt()
+    def ClearTimeline(self):
+        # PROTECTED REGION ID(PandaPosTrig.ClearTimeline) ENABLED START #
+        """
+        Clears the scan timeline.
+
+        :return:None
+        """
+        self._timeline.clear()
+        # PROTECTED REGION END #    //  PandaPosTrig.ClearTimeline
+
+    @command(
+        dtype_out='DevString',
+        doc_out="Summary of the written fields",
+    )
+    @DebugIt()
+    def ProvisionLayout(self):
+        # PROTECTED REGION ID(PandaPosTrig.ProvisionLayout) ENABLED START #
+        """
+        Loads the pos_trig_stxm_ctrl design (or LayoutFile) into the PandABox, only the
+        fields that differ from the current state are written, in one batch
+
+        :return:'DevString'
+        Summary of the written fields
+        """
+        desired = layout.load_design(self.LayoutFile or None)
+        # A fresh connection, so that the first *CHANGES? reports the full state
+        ctrl_sock = self._get_panda_ctrl_socket()
+        try:
+            current = layout.parse_changes(self._panda_multiline_query('*CHANGES?', ctrl_sock))
+            changed = layout.diff_fields(desired, current)
+            replies = self._panda_batch_write(changed, ctrl_sock)
+        finally:
+            ctrl_sock.close()
+
+        errors = [f'{field}: {reply}' for (field, _), reply in zip(changed, replies)
+                  if not reply.startswith('OK')]
+        for error in errors:
+            log.warning(f'ProvisionLayout could not write {error}')
+        summary = f'{len(changed)} of {len(desired)} fields written, {len(errors)} errors'
+        log.info(f'ProvisionLayout: {summary}')
+        if errors:
+            summary += ': ' + '; '.join(errors)
+        return summary
+        # PROTECTED REGION END #    //  PandaPosTrig.ProvisionLayout
+
+    @command(
+        dtype_in='DevLong64',
+        doc_in="DetTrigCntr index of the line",
+        dtype_out='DevEncoded',
+        doc_out="All channels of the line packed in one binary record",
+    )
+    @DebugIt()
+    def ReadLine(self, argin):
+        # PROTECTED REGION ID(PandaPosTrig.ReadLine) ENABLED START #
+        """
+        Returns the current line or any completed line retained in the history,
+        packed in the same way as the LineRecord attribute
+
+        :param argin: 'DevLong64'
+        DetTrigCntr index of the line
+
+        :return:'DevEncoded'
+        All channels of the line packed in one binary record
+        """
+        line = self._lines.armed_line()
+        if line.index != argin:
+            line = self._history.get(argin)
+        if line is None:
+            tango.Except.throw_exception('LineNotAvailable',
+                                         f'Line {argin} is no longer available',
+                                         'PandaPosTrig.ReadLine')
+        with self._timeline.span('ReadLine', 'read'):
+            return pack_line(argin, line.channels(), self.__line_record_compression)
+        # PROTECTED REGION END #    //  PandaPosTrig.ReadLine
+
+    @command(
+        dtype_in='DevDouble',
+        doc_in="Timeout in seconds",
+        dtype_out='DevBoolean',
+        doc_out="True if the line is complete, False on timeout",
+    )
+    @DebugIt()
+    def WaitLineComplete(self, argin):
+        # PROTECTED REGION ID(PandaPosTrig.WaitLineComplete) ENABLED START #
+        """
+        Blocks until the armed line has ended or DetTimePulseN points are in,
+        or until the timeout has expired. The timeout has to stay below the
+        client timeout of the device proxy.
+
+        :param argin: 'DevDouble'
+        Timeout in seconds
+
+        :return:'DevBoolean'
+        True if the line is complete, False on timeout
+        """
+        index = self._lines.armed
+        return self._wait_line(lambda: self._ingest.line_done(index), argin)
+        # PROTECTED REGION END #    //  PandaPosTrig.WaitLineComplete
+
+    def is_WaitLineComplete_allowed(self):
+        # PROTECTED REGION ID(PandaPosTrig.is_WaitLineComplete_allowed) ENABLED START #
+        return self.get_state() not in [DevState.FAULT,DevState.INIT]
+        # PROTECTED REGION END #    //  PandaPosTrig.is_WaitLineComplete_allowed
+
+    @command(
+        dtype_in='DevDouble',
+        doc_in="Timeout in seconds",
+        dtype_out='DevBoolean',
+        doc_out="True if a line is armed, False on timeout",
+    )
+    @DebugIt()
+    def WaitArmed(self, argin):
+        # PROTECTED REGION ID(PandaPosTrig.WaitArmed) ENABLED START #
+        """
+        Blocks until a line is armed that has not been acquired yet, e.g. by
+        the end of the previous line in the double-buffered mode, or until the
+        timeout has expired.
+
+        :param argin: 'DevDouble'
+        Timeout in seconds
+
+        :return:'DevBoolean'
+        True if a line is armed, False on timeout
+        """
+        return self._wait_line(lambda: not self._ingest.line_done(self._lines.armed), argin)
+        # PROTECTED REGION END #    //  PandaPosTrig.WaitArmed
+
+    def is_WaitArmed_allowed(self):
+        # PROTECTED REGION ID(PandaPosTrig.is_WaitArmed_allowed) ENABLED START #
+        return self.get_state() not in [DevState.FAULT,DevState.INIT]
+        # PROTECTED REGION END #    //  PandaPosTrig.is_WaitArmed_allowed
+
+    def is_ProvisionLayout_allowed(self):
+        # PROTECTED REGION ID(PandaPosTrig.is_ProvisionLayout_allowed) ENABLED START #
+        return self.get_state() not in [DevState.RUNNING,DevState.INIT]
+        # PROTECTED REGION END #    //  PandaPosTrig.is_ProvisionLayout_allowed
+
 # ----------
 # Run server
 # ----------
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Linearity correction of the encoder positions.
+
+A calibration file gives, all parts optional, a piecewise-linear correction
+per axis, as (raw, corrected) points in microns, and a coupling matrix
+applied to the corrected positions:
+
+    {
+        "x": [[-50.0, -50.012], [0.0, 0.0], [50.0, 49.995]],
+        "y": [[-50.0, -49.990], [50.0, 50.004]],
+        "coupling": [[1.0, 0.0012], [-0.0008, 1.0]]
+    }
+
+    [x', y'] = coupling @ [x(x_raw), y(y_raw)]
+
+The positions are in the frame of the encoders, before AbsXSign/AbsYSign.
+Beyond the table the first and last segments are extrapolated. Both the
+tables and the coupling have to be invertible, so that the trigger positions
+are mapped back to raw encoder positions exactly.
+"""
+
+import json
+
+import numpy as np
+
+
+class PiecewiseLinear(object):
+    """
+    Piecewise-linear map through the (raw, corrected) points, both strictly
+    increasing.
+    """
+    def __init__(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) < 2:
+            raise ValueError('A correction table needs at least two (raw, corrected) points')
+        self.raw, self.corrected = points[:, 0], points[:, 1]
+        if np.any(np.diff(self.raw) <= 0) or np.any(np.diff(self.corrected) <= 0):
+            raise ValueError('The raw and corrected positions of a correction table must increase')
+
+    @staticmethod
+    def _interp(values, xp, fp):
+        values = np.asarray(values, dtype=np.float64)
+        below = fp[0] + (values - xp[0]) * (fp[1] - fp[0]) / (xp[1] - xp[0])
+        above = fp[-1] + (values - xp[-1]) * (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+        return np.where(values < xp[0], below,
+                        np.where(values > xp[-1], above, np.interp(values, xp, fp)))
+
+    def __call__(self, raw):
+        return self._interp(raw, self.raw, self.corrected)
+
+    def inverse(self, corrected):
+        return self._interp(corrected, self.corrected, self.raw)
+
+
+class PositionCalibration(object):
+    """
+    Maps raw (x, y) encoder positions to corrected ones and back, on whole
+    arrays of positions.
+    """
+    def __init__(self, x=None, y=None, coupling=None):
+        self.x = None if x is None else PiecewiseLinear(x)
+        self.y = None if y is None else PiecewiseLinear(y)
+        self.coupling = None
+        if coupling is not None:
+            self.coupling = np.asarray(coupling, dtype=np.float64)
+            if self.coupling.shape != (2, 2):
+                raise ValueError('The coupling matrix must be 2x2')
+            self._decoupling = np.linalg.inv(self.coupling)
+
+    def apply(self, x, y):
+        """
+        Returns the corrected positions of the raw ones.
+        """
+        x = np.asarray(x, dtype=np.float64) if self.x is None else self.x(x)
+        y = np.asarray(y, dtype=np.float64) if self.y is None else self.y(y)
+        if self.coupling is not None:
+            (a, b), (c, d) = self.coupling
+            x, y = a * x + b * y, c * x + d * y
+        return x, y
+
+    def inverse(self, x, y):
+        """
+        Returns the raw positions of the corrected ones.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if self.coupling is not None:
+            (a, b), (c, d) = self._decoupling
+            x, y = a * x + b * y, c * x + d * y
+        if self.x is not None:
+            x = self.x.inverse(x)
+        if self.y is not None:
+            y = self.y.inverse(y)
+        return x, y
+
+
+def load_calibration(path):
+    """
+    Returns the PositionCalibration of a calibration file.
+    """
+    with open(path) as fp:
+        table = json.load(fp)
+    unknown = set(table) - {'x', 'y', 'coupling'}
+    if unknown:
+        raise ValueError(f'Unknown entries in the calibration file {path}: {", ".join(sorted(unknown))}')
+    return PositionCalibration(table.get('x'), table.get('y'), table.get('coupling'))
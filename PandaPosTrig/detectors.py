@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Registry of the 0D detector channels.
+
+Every channel is a detector input counted by PandABox COUNTER blocks, given in
+the DetectorChannels property as 'name:counter[:capture]':
+
+    counter  the COUNTER gated by PULSE2, read for the Int<name> attribute
+    capture  the COUNTER gated by PULSE1, captured by PCAP with every point
+             of a line and published as <name>Out
+
+The counters have to be wired to the detector inputs in the layout. The PMT
+and PhDiode channels are served by the built-in attributes, any other channel
+gets its attributes created when the device starts.
+"""
+
+# Built-in channels and the line fields they are captured into
+BUILTIN_FIELDS = {'PMT': 'pmt', 'PhDiode': 'p_diode'}
+
+# The pos_trig_stxm_ctrl layout, in the order of the DetOut event
+DEFAULT_CHANNELS = ('PhDiode:COUNTER5:COUNTER3', 'PMT:COUNTER6:COUNTER2')
+
+# Length limit of the channel names in the line records
+MAX_NAME_LENGTH = 16
+
+
+class DetectorChannel(object):
+    """
+    A named detector channel and the counter blocks it is read from.
+    """
+    __slots__ = ('name', 'counter', 'capture')
+
+    def __init__(self, name, counter, capture=None):
+        self.name = name
+        self.counter = counter
+        self.capture = capture
+
+    @property
+    def builtin(self):
+        return self.name in BUILTIN_FIELDS
+
+    @property
+    def field(self):
+        """
+        Name of the line field the captured values are stored in.
+        """
+        return BUILTIN_FIELDS.get(self.name, self.name)
+
+    @property
+    def capture_column(self):
+        """
+        Name of the captured PCAP field, None if the channel is not captured.
+        """
+        if self.capture is None:
+            return None
+        return f'{self.capture}.OUT'
+
+    def __repr__(self):
+        return f'DetectorChannel({self.name!r}, {self.counter!r}, {self.capture!r})'
+
+
+def parse_channels(specs, reserved=()):
+    """
+    Returns the channels of the 'name:counter[:capture]' specs. The names in
+    reserved, e.g. the fields of the line buffers, cannot be used.
+    """
+    channels = []
+    names = set()
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        parts = [part.strip() for part in spec.split(':')]
+        if len(parts) not in (2, 3) or not parts[0].isidentifier() or not parts[1]:
+            raise ValueError(f'Invalid detector channel "{spec}", expected name:counter[:capture]')
+        name = parts[0]
+        if name in names or name in reserved or len(name) > MAX_NAME_LENGTH:
+            raise ValueError(f'Detector channel name "{name}" is duplicated, reserved or too long')
+        names.add(name)
+        capture = parts[2].upper() if len(parts) == 3 and parts[2] else None
+        channels.append(DetectorChannel(name, parts[1].upper(), capture))
+    return channels
+
+
+def extra_channels(channels):
+    """
+    Returns the captured channels that are not stored in built-in line fields.
+    """
+    return [channel for channel in channels if channel.capture and not channel.builtin]
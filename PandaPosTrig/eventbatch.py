@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Coalescing of per-trigger samples into rate-limited events.
+
+The acquisition thread only appends its samples to a queue. A publisher
+thread pushes them, up to max_batch samples per event, at most max_rate
+events per second, so that the time spent serialising the events for the
+subscribers is taken out of the trigger loop. No sample is ever dropped: if
+the samples arrive faster than max_rate * max_batch, the backlog grows and is
+sent at the full event rate until it has been caught up. A batch that cannot
+be published, e.g. on a timeout of the device monitor, is reported to the
+tracer and the publisher thread goes on with the next one.
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class EventBatcher(object):
+    """
+    Queues samples of width values and passes them in batches, as a (samples,
+    width) array, to publish(batch).
+    """
+    def __init__(self, publish, width, max_rate=20., max_batch=1000, dtype=np.uint64, tracer=None):
+        self.publish = publish
+        self.tracer = tracer
+        self.width = width
+        self.max_rate = max_rate
+        self.max_batch = max_batch
+        self.dtype = dtype
+        self.cond = threading.Condition()
+        self.last = np.zeros((0, width), dtype=dtype)
+        self._pending = deque()
+        self._last_push = 0.
+
+    def add(self, sample):
+        with self.cond:
+            self._pending.append(sample)
+            self.cond.notify()
+
+    @property
+    def backlog(self):
+        return len(self._pending)
+
+    def _take(self):
+        n = min(len(self._pending), max(self.max_batch, 1))
+        return [self._pending.popleft() for _ in range(n)]
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            with self.cond:
+                if not self.cond.wait_for(lambda: self._pending, timeout=.1):
+                    continue
+            if self.max_rate > 0:
+                # Samples keep coming in while waiting, they join the batch
+                delay = self._last_push + 1. / self.max_rate - time.monotonic()
+                if delay > 0 and stop_event.wait(delay):
+                    break
+            with self.cond:
+                samples = self._take()
+            batch = np.array(samples, dtype=self.dtype).reshape(len(samples), self.width)
+            self.last = batch
+            self._last_push = time.monotonic()
+            try:
+                self.publish(batch)
+            except Exception as e:
+                if self.tracer is not None:
+                    self.tracer.warning('Cannot publish a batch of %d samples: %s', len(batch), e)
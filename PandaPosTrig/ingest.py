@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Reading and decoding of the data port in a worker process.
+
+The worker process opens the data connection and parses the ASCII stream, so
+that the parsing does not hold the GIL of the device server while the Tango
+clients are served. The decoded points of every chunk are written as float64
+rows into a ring in shared memory, a pipe carries the small control messages:
+
+    ('header', index)          the columns of the captured fields that follow
+    ('points', start, n, end)  n rows from value start of the ring
+    ('end',)                   an END message of the data port
+    ('log', level, text)       a warning of the parser
+    ('closed', reason)         the data connection is lost
+
+The device acknowledges the ring values it has consumed, end, through a
+shared counter. The worker waits for free room rather than overwriting rows
+not yet read, so no point is dropped.
+"""
+
+import multiprocessing
+import socket
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import pcap
+
+
+class _PipeTracer(object):
+    """
+    Passes the messages of the parser to the device.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def warning(self, fmt, *args):
+        self.conn.send(('log', 'warning', fmt % args))
+
+    def info(self, fmt, *args):
+        self.conn.send(('log', 'info', fmt % args))
+
+
+class _RingWriter(object):
+    """
+    Worker side of the ring, every chunk is written contiguously.
+    """
+    def __init__(self, shm_name, capacity, consumed, conn, stop_event):
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.ring = np.ndarray((capacity,), dtype=np.float64, buffer=self.shm.buf)
+        self.capacity = capacity
+        self.consumed = consumed
+        self.conn = conn
+        self.stop_event = stop_event
+        self.written = 0
+        self.index = None
+
+    def _reserve(self, size):
+        """
+        Returns the start of size free values, None if stopped meanwhile.
+        """
+        start = self.written % self.capacity
+        if start + size > self.capacity:
+            # The tail of the ring is skipped
+            self.written += self.capacity - start
+            start = 0
+        while self.written + size - self.consumed.value > self.capacity:
+            if self.stop_event.is_set():
+                return None
+            time.sleep(.001)
+        return start
+
+    def add(self, rows, index):
+        width = len(index)
+        if any(len(row) != width for row in rows):
+            self.conn.send(('log', 'warning', f'Data port lines without {width} values dropped'))
+            rows = [row for row in rows if len(row) == width]
+        if not rows or not width:
+            return
+        if index != self.index:
+            self.index = index
+            self.conn.send(('header', dict(index)))
+        data = np.array(rows, dtype=np.float64)
+        step = max(self.capacity // (2 * width), 1)
+        for first in range(0, len(data), step):
+            block = data[first:first + step].ravel()
+            start = self._reserve(len(block))
+            if start is None:
+                return
+            self.ring[start:start + len(block)] = block
+            self.written += len(block)
+            self.conn.send(('points', start, len(block) // width, self.written))
+
+    def close(self):
+        self.ring = None
+        self.shm.close()
+
+
+def _worker(host, port, timeout, shm_name, capacity, consumed, conn, stop_event):
+    """
+    Entry point of the worker process.
+    """
+    writer = _RingWriter(shm_name, capacity, consumed, conn, stop_event)
+    sock = None
+    reason = 'The PandABox data port connection has been lost'
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        # Short timeouts, so that the stop is noticed while no data comes in
+        sock.settimeout(.5)
+        stream = pcap.DataPortStream(None, lambda: conn.send(('end',)),
+                                     tracer=_PipeTracer(conn), on_points=writer.add)
+        sock.sendall(b'ASCII\n')
+        while not stop_event.is_set():
+            try:
+                raw = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not raw:
+                break
+            stream.feed(raw.decode())
+    except Exception as e:
+        reason = f'Problem in the data port worker: {e}'
+    finally:
+        if sock is not None:
+            sock.close()
+        writer.close()
+        if not stop_event.is_set():
+            try:
+                conn.send(('closed', reason))
+            except (OSError, ValueError):
+                pass
+        conn.close()
+
+
+class IngestWorker(object):
+    """
+    Device side of the worker process, with a ring of size_mb MB. The worker
+    is started by start() and its messages are handled by run(stop_event),
+    in a thread of the device.
+    """
+    def __init__(self, host, port, timeout=5., size_mb=64.):
+        # Forking a process with running threads is unsafe, the worker is spawned
+        context = multiprocessing.get_context('spawn')
+        self.capacity = max(int(size_mb * 2**20) // 8, 1024)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.capacity * 8)
+        self.ring = np.ndarray((self.capacity,), dtype=np.float64, buffer=self.shm.buf)
+        self.consumed = context.Value('q', 0, lock=False)
+        self.stop_event = context.Event()
+        self.conn, child_conn = context.Pipe(duplex=False)
+        self.process = context.Process(target=_worker, name='PandaDataIngest', daemon=True,
+                                       args=(host, port, timeout, self.shm.name, self.capacity,
+                                             self.consumed, child_conn, self.stop_event))
+        self._child_conn = child_conn
+
+    def start(self):
+        self.process.start()
+        # The write end belongs to the worker, recv fails once it has exited
+        self._child_conn.close()
+
+    def run(self, on_points, on_end, on_closed, stop_event, tracer=None):
+        """
+        Passes the points of every chunk, as a (n, len(index)) view of the
+        ring only valid during the call, to on_points(rows, index), every
+        END to on_end() and the loss of the connection to on_closed(reason).
+        """
+        index = {}
+        try:
+            while not stop_event.is_set():
+                if not self.conn.poll(.1):
+                    continue
+                message = self.conn.recv()
+                kind = message[0]
+                if kind == 'points':
+                    _, start, n, end = message
+                    width = len(index)
+                    try:
+                        on_points(self.ring[start:start + n * width].reshape(n, width), index)
+                    finally:
+                        self.consumed.value = end
+                elif kind == 'header':
+                    index = message[1]
+                elif kind == 'end':
+                    on_end()
+                elif kind == 'log':
+                    if tracer is not None:
+                        getattr(tracer, message[1])('%s', message[2])
+                elif kind == 'closed':
+                    on_closed(message[1])
+                    break
+        except EOFError:
+            if not stop_event.is_set():
+                on_closed('The data port worker process has exited')
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop_event.set()
+        if self.process.pid is not None:
+            self.process.join(2.)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(1.)
+        if self.ring is not None:
+            self.ring = None
+            self.conn.close()
+            self.shm.close()
+            self.shm.unlink()
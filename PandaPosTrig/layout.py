@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" PandABox layout provisioning from a saved design file.
+
+A design file, such as designs/pos_trig_stxm_ctrl.json, is converted into the
+PandABox field assignments it stands for, which are compared with the current
+state of the box so that only the differing fields have to be written.
+"""
+
+import json
+import math
+import re
+from collections import OrderedDict
+from importlib import resources
+
+# The pos_trig_stxm_ctrl design, installed with the package
+DEFAULT_DESIGN = 'pos_trig_stxm_ctrl.json'
+
+# Design keys which are not PandABox fields
+_SKIP_KEYS = ('label',)
+# Design key suffixes which are field attributes, e.g. widthUnits -> WIDTH.UNITS
+_ATTR_SUFFIXES = ('Delay', 'Units', 'Capture')
+# Field attributes of the positions table
+_POSITION_ATTRS = (('units', 'UNITS'), ('scale', 'SCALE'), ('offset', 'OFFSET'), ('capture', 'CAPTURE'))
+
+
+def _snake(key):
+    return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', key).upper()
+
+
+def field_name(block, key):
+    """
+    Returns the PandABox field name of the design key of a block.
+    """
+    for suffix in _ATTR_SUFFIXES:
+        if key.endswith(suffix) and key != suffix.lower():
+            return f'{block}.{_snake(key[:-len(suffix)])}.{suffix.upper()}'
+    return f'{block}.{_snake(key)}'
+
+
+def format_value(value):
+    """
+    Returns the design value as sent to the PandABox.
+    """
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def load_design(path=None):
+    """
+    Reads the design file and returns an ordered dictionary field -> value.
+    The UNITS fields are placed first, so that the values that follow are
+    interpreted in the right units.
+    """
+    if path:
+        with open(path) as fp:
+            design = json.load(fp)
+    else:
+        design = json.loads(resources.files(__package__).joinpath('designs')
+                            .joinpath(DEFAULT_DESIGN).read_text())
+
+    units, fields = OrderedDict(), OrderedDict()
+    for block, params in design.get('children', {}).items():
+        for key, value in params.items():
+            if key in _SKIP_KEYS or value == 'expanded' or isinstance(value, (list, dict)):
+                continue
+            name = field_name(block, key)
+            target = units if name.endswith('.UNITS') else fields
+            target[name] = format_value(value)
+
+    positions = design.get('attributes', {}).get('positions', {})
+    for idx, name in enumerate(positions.get('name', [])):
+        for key, attr in _POSITION_ATTRS:
+            if key in positions:
+                target = units if attr == 'UNITS' else fields
+                target[f'{name}.{attr}'] = format_value(positions[key][idx])
+
+    units.update(fields)
+    return units
+
+
+def parse_changes(lines):
+    """
+    Converts the '!FIELD=value' lines of a *CHANGES? reply into a dictionary,
+    table fields and fields in error are left out.
+    """
+    current = {}
+    for line in lines:
+        line = line.lstrip('!')
+        if '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        current[name] = value
+    return current
+
+
+def _same(desired, current):
+    if desired == current:
+        return True
+    try:
+        return math.isclose(float(desired), float(current), rel_tol=1e-9, abs_tol=1e-12)
+    except ValueError:
+        return False
+
+
+def diff_fields(desired, current):
+    """
+    Returns the (field, value) pairs of the desired state which differ from the
+    current one. A field whose UNITS change is always rewritten, as the box
+    rescales the stored value when the units change.
+    """
+    changed = OrderedDict()
+    for name, value in desired.items():
+        if name not in current or not _same(value, current[name]):
+            changed[name] = value
+    for name in list(changed):
+        if name.endswith('.UNITS'):
+            base = name[:-len('.UNITS')]
+            if base in desired:
+                changed[base] = desired[base]
+    return list(changed.items())
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Per-line point buffers and their handoff between the data and Tango threads.
+
+The data thread is the only writer of the lines, the Tango thread only selects
+the epoch (line index) that the next acquisition belongs to. A line is
+delimited by the END message of the data port, so that points arriving after
+ArmSingle, but before the END of the previous line, stay in the previous line.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .linestats import RunningStats, ratio
+
+POINT_DTYPE = np.dtype([('x', '<f8'),
+                        ('y', '<f8'),
+                        ('dwell', '<f8'),
+                        ('pmt', '<u8'),
+                        ('p_diode', '<u8'),
+                        ('point_n', '<u8'),
+                        ('transmission', '<f8'),
+                        ('timestamp', '<f8')])
+
+# Channels of a line record, in the order of the record
+RECORD_CHANNELS = ('x', 'y', 'dwell', 'pmt', 'p_diode', 'point_n')
+
+
+def point_dtype(extra=()):
+    """
+    Returns the point dtype with additional counter fields, e.g. for the
+    detector channels beyond the PMT and the photodiode.
+    """
+    if not extra:
+        return POINT_DTYPE
+    return np.dtype(POINT_DTYPE.descr + [(name, '<u8') for name in extra])
+
+
+class Line(object):
+    """
+    Points of one line, tagged with the line index (DetTrigCntr epoch).
+
+    The points are written into a preallocated structured array and published
+    by incrementing count afterwards. A reader that takes count first always
+    sees fully written points, also while the data thread keeps appending.
+    """
+    def __init__(self, index, capacity=1024, dtype=POINT_DTYPE):
+        self.index = index
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.count = 0
+        self.complete = False
+        self.has_timestamps = False
+        self.pmt_stats = RunningStats()
+        self.p_diode_stats = RunningStats()
+        self.interval_stats = RunningStats()
+        self.gate_offset = float('nan')
+        # Passes summed into the line
+        self.passes = 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        """
+        Returns the published points of a channel.
+        """
+        count = self.count
+        return self.data[name][:count]
+
+    def _reserve(self, size):
+        n = self.count
+        if size > len(self.data):
+            data = np.zeros(max(2 * len(self.data), size, 1024), dtype=self.data.dtype)
+            data[:n] = self.data[:n]
+            self.data = data
+
+    def append(self, x, y, dwell, pmt, p_diode, point_n, ts_trig=None, ts_start=None, extra=()):
+        n = self.count
+        self._reserve(n + 1)
+
+        if ts_trig is None:
+            ts_trig = float('nan')
+        else:
+            if n:
+                self.interval_stats.add(ts_trig - self.data['timestamp'][n - 1])
+            elif ts_start is not None:
+                self.gate_offset = ts_trig - ts_start
+            self.has_timestamps = True
+
+        self.data[n] = (x, y, dwell, pmt, p_diode, point_n, ratio(pmt, p_diode), ts_trig, *extra)
+        self.pmt_stats.add(pmt)
+        self.p_diode_stats.add(p_diode)
+        self.count = n + 1
+
+    def extend(self, x, y, dwell, pmt, p_diode, point_n, ts_trig=None, ts_start=None, extra=()):
+        """
+        Appends a block of points given as arrays, e.g. a segment of a chunk
+        of the continuous capture.
+        """
+        k = len(x)
+        if not k:
+            return
+        n = self.count
+        self._reserve(n + k)
+        block = self.data[n:n + k]
+        block['x'] = x
+        block['y'] = y
+        block['dwell'] = dwell
+        block['pmt'] = pmt
+        block['p_diode'] = p_diode
+        block['point_n'] = point_n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block['transmission'] = np.where(p_diode != 0, pmt / np.where(p_diode != 0, p_diode, 1), np.nan)
+        if ts_trig is None:
+            block['timestamp'] = np.nan
+        else:
+            block['timestamp'] = ts_trig
+            first = 0 if n else 1
+            if not n and ts_start is not None:
+                self.gate_offset = ts_trig[0] - ts_start[0]
+            self.interval_stats.add_array(np.diff(self.data['timestamp'][n - 1 + first:n + k]))
+            self.has_timestamps = True
+        for name, values in zip(self.data.dtype.names[len(POINT_DTYPE.names):], extra):
+            block[name] = values
+        self.pmt_stats.add_array(np.asarray(pmt))
+        self.p_diode_stats.add_array(np.asarray(p_diode))
+        self.count = n + k
+
+    def channels(self):
+        """
+        Returns the record channels of the line as an ordered mapping.
+        """
+        count = self.count
+        data = self.data[:count]
+        channels = OrderedDict((name, data[name]) for name in RECORD_CHANNELS)
+        if self.has_timestamps:
+            channels['timestamp'] = data['timestamp']
+        for name in data.dtype.names[len(POINT_DTYPE.names):]:
+            channels[name] = data[name]
+        return channels
+
+
+class LineEpochs(object):
+    """
+    Single-producer/single-consumer handoff of the lines.
+
+    The Tango thread (consumer) sets the armed epoch with arm(). The data
+    thread (producer) opens a new line with the armed epoch at the first point
+    of an acquisition, and publishes it as completed once all its points are
+    in, when a later line has been armed, or on END. PCAP stays armed over
+    the lines, so END usually only comes on its disarm. Both sides only
+    assign object references, so no lock is needed.
+    """
+    def __init__(self, extra=()):
+        self.dtype = point_dtype(extra)
+        self.armed = -1
+        self.current = None
+        self.completed = Line(-1, 0, self.dtype)
+
+    def arm(self, index):
+        """
+        Consumer: the next acquisition belongs to line index.
+        """
+        self.armed = index
+
+    def reset(self):
+        """
+        Consumer: forgets all lines, when the line index starts again from 0.
+        Only while no line is acquired.
+        """
+        self.current = None
+        self.completed = Line(-1, 0, self.dtype)
+        self.armed = -1
+
+    def point_line(self):
+        """
+        Producer: returns the line the next point belongs to, None if the
+        armed line has already been completed.
+        """
+        line = self.current
+        if line is not None and line is self.completed and line.index == self.armed:
+            return None
+        if line is None or line.complete:
+            line = Line(self.armed, dtype=self.dtype)
+            self.current = line
+        return line
+
+    def rearmed(self):
+        """
+        Producer: returns True if a later line has been armed while the
+        current one is still open.
+        """
+        line = self.current
+        return line is not None and not line.complete and line.index != self.armed
+
+    def pending(self):
+        """
+        Producer: returns True if there is a line for END to complete, the
+        open current line, or the armed line if none of its points came in.
+        """
+        line = self.current
+        if line is not None and not line.complete:
+            return True
+        return self.armed > self.completed.index and (line is None or line.index != self.armed)
+
+    def end(self):
+        """
+        Producer: completes the current line on END and publishes it.
+        """
+        line = self.current
+        if line is None or line.complete:
+            # END without any point
+            line = Line(self.armed, 0, self.dtype)
+            self.current = line
+        line.complete = True
+        self.completed = line
+        return line
+
+    def split(self):
+        """
+        Producer: completes the current line in the middle of an acquisition,
+        at a line boundary found in the continuous capture. The producer also
+        advances the armed epoch here, the continuous capture is armed only
+        once for all its lines. Returns the completed line, or None.
+        """
+        line = self.current
+        if line is None or line.complete:
+            return None
+        line.complete = True
+        self.completed = line
+        self.armed = line.index + 1
+        return line
+
+    def restart(self):
+        """
+        Producer: closes the current line on END without publishing it, e.g.
+        a pass of a multi-pass line. The next points open a new line, of the
+        armed epoch.
+        """
+        line = self.current
+        if line is None or line.complete:
+            line = Line(self.armed, 0, self.dtype)
+        line.complete = True
+        self.current = line
+        return line
+
+    def publish(self, line):
+        """
+        Producer: publishes a line built from the acquired ones, e.g. the
+        accumulated passes, as completed.
+        """
+        line.complete = True
+        self.current = line
+        self.completed = line
+        return line
+
+    def armed_line(self):
+        """
+        Consumer: returns the line of the armed epoch, empty until its first
+        point has arrived.
+        """
+        line = self.current
+        if line is not None and line.index == self.armed:
+            return line
+        return Line(self.armed, 0, self.dtype)
+
+
+class LineHistory(object):
+    """
+    The last completed lines, keyed by their index. The oldest lines are
+    evicted once either max_lines lines or max_bytes bytes of point buffers
+    are retained.
+    """
+    def __init__(self, max_lines=100, max_bytes=256 * 2**20):
+        self.lock = threading.Lock()
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self._lines = OrderedDict()
+        self._nbytes = 0
+
+    def add(self, line):
+        with self.lock:
+            old = self._lines.pop(line.index, None)
+            if old is not None:
+                self._nbytes -= old.data.nbytes
+            self._lines[line.index] = line
+            self._nbytes += line.data.nbytes
+            while self._lines and (len(self._lines) > self.max_lines or self._nbytes > self.max_bytes):
+                _, evicted = self._lines.popitem(last=False)
+                self._nbytes -= evicted.data.nbytes
+
+    def get(self, index):
+        """
+        Returns the retained line, or None if it has been evicted.
+        """
+        with self.lock:
+            return self._lines.get(index)
+
+    def indices(self):
+        with self.lock:
+            return list(self._lines)
+
+    def clear(self):
+        with self.lock:
+            self._lines.clear()
+            self._nbytes = 0
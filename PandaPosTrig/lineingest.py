@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Assembly of the data port points into lines.
+
+The points of every data port chunk are converted and calibrated as arrays
+and added to the lines of a LineEpochs. PCAP stays armed over the lines, so
+a line is completed once its n_points points are in, when a later line has
+been armed while it is still short, or on END. In the continuous capture the
+lines are found by the segmenter instead, and the passes of a multi-pass
+line are accumulated before the line is published.
+
+The device and the session replay share it, what they do with the lines is
+given by callbacks:
+
+    publish(line)             a completed line
+    line_end(rearm)           the end of a line, the next one is armed if rearm,
+                              before the line is published
+    next_pass()               the line is armed again for its next pass
+    notify()                  the line state has changed
+    push_event(name, value)   the PreviewImage event
+"""
+
+import time
+
+import numpy as np
+
+from . import pcap
+from .passes import VARIANCE_CHANNELS, PassAccumulator
+from .preview import PreviewMap
+from .segment import LineSegmenter
+from .timeline import STREAM, Timeline
+from .trace import TraceLevel, Tracer
+
+
+def _ignore(*args):
+    pass
+
+
+class LineIngest(object):
+    """
+    Adds the points of the data port to the lines, in the data thread.
+    """
+    def __init__(self, lines, publish, line_end=_ignore, next_pass=_ignore, notify=_ignore,
+                 push_event=_ignore, preview=None, tracer=None, timeline=None, calibration=None,
+                 pmt_column=pcap.PMT, p_diode_column=pcap.P_DIODE, extra_columns=()):
+        self.lines = lines
+        self.publish = publish
+        self.line_end = line_end
+        self.next_pass = next_pass
+        self.notify = notify
+        self.push_event = push_event
+        self.preview = PreviewMap() if preview is None else preview
+        self.tracer = Tracer() if tracer is None else tracer
+        self.timeline = Timeline() if timeline is None else timeline
+        self.calibration = calibration
+        self.pmt_column = pmt_column
+        self.p_diode_column = p_diode_column
+        self.extra_columns = list(extra_columns)
+        self.segmenter = LineSegmenter()
+        self.passes = PassAccumulator()
+        self.pass_variance = {}
+        # Points per line, 0 while unknown
+        self.n_points = 0
+        self.continuous = False
+        # The fast axis of the continuous capture is X, otherwise Y
+        self.fast_x = False
+        # 1 or -1 keeps only the segments of that direction, 0 both
+        self.segment_direction = 0
+        # First line, map row and map column of the segments of a sparse
+        # scan, None for full lines
+        self.segment_offset = None
+        # Time between the points in s, for the streaming spans of the
+        # lines without timestamps, 0 if unknown
+        self.point_period = 0.
+        # perf_counter time of the arming of the line, for the timeline
+        self.armed_at = None
+        self._first_point_at = None
+        self._last_point_at = None
+
+    def reset(self):
+        """
+        Forgets the lines and the passes, when the line index starts again
+        from 0. Only while no line is acquired.
+        """
+        self.lines.reset()
+        self.passes.reset()
+        self.segmenter.reset()
+        self.pass_variance = {}
+        self.segment_offset = None
+        self.armed_at = None
+        self._first_point_at = None
+        self._last_point_at = None
+
+    def map_position(self, index, first_line=0):
+        """
+        Returns the map row of line index and the map column of its first
+        point. The lines are the rows from first_line on, the segments of a
+        sparse scan are placed by segment_offset: their first line, row and
+        column.
+        """
+        if self.segment_offset is None:
+            return index - first_line, 0
+        first, row, column = self.segment_offset
+        return row + index - first, column
+
+    def add_points(self, rows, index):
+        """
+        Adds the points of a data port chunk to the lines they belong to,
+        index maps the captured field names to their columns. The ingest
+        worker passes the chunk already decoded, as a float64 view of its
+        ring, which is only valid during the call: every channel is copied
+        out of it, and no view of it is kept.
+        """
+        now = time.perf_counter()
+        if self.tracer.enabled(TraceLevel.DEBUG):
+            # The tracer keeps its arguments, a copy of the first point
+            self.tracer.sampled('point', 'Chunk of %d data lines received, first: %s',
+                                len(rows), np.asarray(rows[0]).tolist())
+        if isinstance(rows, np.ndarray):
+            data = rows
+        else:
+            width = len(index)
+            if any(len(row) != width for row in rows):
+                self.tracer.warning('Data port lines without %d values dropped', width)
+                rows = [row for row in rows if len(row) == width]
+                if not rows:
+                    return
+            data = np.array(rows, dtype=np.float64)
+
+        def column(name, dtype=np.float64):
+            if name not in index:
+                return np.zeros(len(data), dtype=dtype)
+            return data[:, index[name]].astype(dtype)
+
+        x = column(pcap.X_POS) / 1000
+        y = column(pcap.Y_POS) / 1000
+        if self.calibration is not None:
+            x, y = self.calibration.apply(x, y)
+        dwell = column(pcap.DWELL) / 1000
+        pmt = column(self.pmt_column, np.int64)
+        p_diode = column(self.p_diode_column, np.int64)
+        point_n = column(pcap.POINT_N, np.int64)
+        ts_trig = column(pcap.TS_TRIG) if pcap.TS_TRIG in index else None
+        ts_start = column(pcap.TS_START) if pcap.TS_START in index else None
+        extra = [column(name, np.int64) for name in self.extra_columns]
+
+        def add(line, start, stop):
+            first = len(line)
+            if not first:
+                self._first_point(now)
+            self._last_point_at = now
+            part = slice(start, stop)
+            line.extend(x[part], y[part], dwell[part], pmt[part], p_diode[part], point_n[part],
+                        ts_trig=None if ts_trig is None else ts_trig[part],
+                        ts_start=None if ts_start is None else ts_start[part],
+                        extra=[values[part] for values in extra])
+            row, offset = self.map_position(line.index)
+            self.preview.add_points(row, offset + first, pmt[part])
+            if first < self.n_points <= len(line):
+                self.notify()
+
+        def drop(start):
+            self.tracer.warning('%d points after the end of line %d dropped',
+                                len(data) - start, self.lines.armed)
+
+        if self.continuous:
+            fast, slow = (x, y) if self.fast_x else (y, x)
+            for start, stop, new_line, sign in self.segmenter.feed(fast, slow):
+                if new_line:
+                    line = self.lines.split()
+                    if line is not None:
+                        self._complete(line)
+                if self.segment_direction and sign and sign != self.segment_direction:
+                    # Flyback, or the unwanted direction of a bidirectional raster
+                    continue
+                line = self.lines.point_line()
+                if line is None:
+                    drop(start)
+                    break
+                add(line, start, stop)
+        else:
+            # A line ends with its n_points points, the rest of the chunk
+            # belongs to the next line if it has been armed meanwhile
+            n_points = self.n_points
+            start = 0
+            while start < len(data):
+                if self.lines.rearmed():
+                    # The next line has been armed before this one was full
+                    self.close_line(rearm=False)
+                line = self.lines.point_line()
+                if line is None:
+                    drop(start)
+                    break
+                stop = len(data)
+                if n_points > 0:
+                    stop = min(stop, start + max(n_points - len(line), 0))
+                if stop > start:
+                    add(line, start, stop)
+                start = stop
+                if 0 < n_points <= len(line):
+                    self.close_line()
+        if self.preview.due():
+            self.push_event('PreviewImage', self.preview.image())
+
+    def end(self):
+        """
+        Completes the current line on the END message of the data port,
+        unless it has already been completed with all its points.
+        """
+        with self.timeline.span('END', 'data'):
+            if self.continuous:
+                # The last segment of the raster, unless it has been dropped
+                line = self.lines.current
+                if line is not None and not line.complete:
+                    self._complete(self.lines.end())
+                self.segmenter.reset()
+                self._line_ended(rearm=True)
+            elif self.lines.pending():
+                self.close_line()
+
+    def close_line(self, rearm=True):
+        """
+        Completes the current line, or adds the current pass of a multi-pass
+        line. Unless rearm is False, the next pass or, through line_end, the
+        next line is armed.
+        """
+        if self.passes.passes > 1:
+            line = self._end_of_pass(rearm)
+        else:
+            line = self.lines.end()
+        # The next line is armed before the line is published, a client
+        # arming on its event finds the next line already armed
+        self.line_end(rearm and line is not None)
+        if line is not None:
+            self._complete(line)
+        self._state_changed()
+
+    def line_done(self, index):
+        """
+        Returns True once line index has ended or all its points are in.
+        """
+        if self.lines.completed.index >= index:
+            return True
+        if self.passes.passes > 1:
+            # Only the accumulated line counts
+            return False
+        line = self.lines.current
+        n_points = self.n_points
+        return line is not None and line.index == index and 0 < n_points <= len(line)
+
+    def _line_ended(self, rearm):
+        self.line_end(rearm)
+        self._state_changed()
+
+    def _state_changed(self):
+        # The waiting commands are woken up before any event is pushed
+        self.notify()
+        if self.preview.due(force=True):
+            self.push_event('PreviewImage', self.preview.image())
+
+    def _end_of_pass(self, rearm=True):
+        """
+        Adds a pass of a multi-pass line. The same line is re-armed until all
+        its passes are in, only then the accumulated line is returned, or
+        right away without rearm. Returns None until the line is complete.
+        """
+        line = self.lines.restart()
+        complete = self.passes.add(line)
+        self._stream_span(f'line {line.index} pass {self.passes.count}', line)
+        if not complete and rearm:
+            self.next_pass()
+            return None
+        self.pass_variance = {name: self.passes.variance(name) for name in VARIANCE_CHANNELS}
+        return self.lines.publish(self.passes.line())
+
+    def _complete(self, line):
+        self._stream_span(f'line {line.index}', line)
+        self.publish(line)
+
+    def _first_point(self, now):
+        """
+        Starts the streaming span of a line, after the wait for its first point.
+        """
+        if self.armed_at is not None:
+            self.timeline.add('wait first point', 'wait', self.armed_at, now)
+        self.armed_at = None
+        self._first_point_at = now
+
+    def _stream_span(self, name, line):
+        """
+        Records the streaming span of the points of line, up to the arrival
+        of its last point. The chunks arrive after their points have been
+        acquired, the span lasts from the first to the last TS_TRIG timestamp
+        if captured, otherwise len(line) points at point_period, or at least
+        from the arrival of the first point.
+        """
+        if self._first_point_at is None:
+            return
+        start, end = self._first_point_at, self._last_point_at
+        timestamps = line['timestamp'] if line.has_timestamps else ()
+        if len(timestamps) > 1 and np.isfinite(timestamps[[0, -1]]).all():
+            start = end - (timestamps[-1] - timestamps[0])
+        elif self.point_period > 0:
+            start = min(start, end - len(line) * self.point_period)
+        self.timeline.add(name, STREAM, start, end)
+        self._first_point_at = None
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Streaming per-line statistics of the 0D detector signals.
+
+"""
+
+import math
+
+import numpy as np
+
+
+class RunningStats(object):
+    """
+    Running sum, mean, standard deviation, min and max of a signal, updated
+    point by point without keeping the values.
+    """
+    __slots__ = ('count', 'sum', 'sumsq', 'min', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0
+        self.sumsq = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add_array(self, values):
+        """
+        Adds all values of a numpy array at once.
+        """
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += values.sum().item()
+        self.sumsq += np.square(values, dtype=np.float64).sum().item()
+        low, high = values.min().item(), values.max().item()
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.
+        return self.sum / self.count
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return 0.
+        return math.sqrt(max(self.sumsq / self.count - self.mean ** 2, 0.))
+
+
+def ratio(num, den):
+    """
+    Returns num/den, or NaN if den is zero.
+    """
+    if den == 0:
+        return float('nan')
+    return num / den
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Stitching of STXM map tiles into a mosaic.
+
+The tiles are placed by their measured encoder positions, not by their nominal
+offsets, on a common grid of the given pixel size. Every point is weighted by
+its distance to the tile edges, so that the overlaps blend smoothly:
+
+    mosaic = sum(w * v) / sum(w)
+
+The points of the rows a map has not written, and of the tails of short lines,
+have point_n 0 and are skipped, like points without a finite position. Every
+tile is summed by a bincount over its own bounding box, which is added to the
+grid. With workers, the tiles are summed by a process pool, which pays off
+only for large tiles given by their paths, so that every worker reads its own
+tiles. Smaller tiles are summed faster without the start-up of the pool.
+
+    from PandaPosTrig.mosaic import stitch
+    image, (x0, y0) = stitch([numpy.load(path, mmap_mode='r') for path in paths], pixel=.05)
+
+or from the command line, for the .npy maps written by the device:
+
+    python -m PandaPosTrig.mosaic mosaic.npy map_0001.npy map_0002.npy ... --pixel .05
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def edge_weights(shape, feather=.1):
+    """
+    Returns the blending weight of every point of a tile of the given shape,
+    rising linearly from the edges over feather of the tile size.
+    """
+    weights = np.ones(shape)
+    for axis, n in enumerate(shape):
+        ramp_len = max(feather * n, 1.)
+        idx = np.arange(n)
+        ramp = np.clip(np.minimum(idx + 1, n - idx) / ramp_len, 0., 1.)
+        weights *= ramp.reshape([-1 if i == axis else 1 for i in range(len(shape))])
+    return weights
+
+
+def _load(tile):
+    """
+    Opens a tile given by the path of its .npy map without a copy.
+    """
+    if isinstance(tile, (str, os.PathLike)):
+        return np.load(tile, mmap_mode='r')
+    return tile
+
+
+def _positions(tile, offset):
+    """
+    Returns the x and y of the points of a tile, with the mask of the
+    measured points: point_n > 0, the unwritten points of a map have 0, and
+    a finite position.
+    """
+    dx, dy = offset
+    x = np.ravel(tile['x']).astype(np.float64) + dx
+    y = np.ravel(tile['y']).astype(np.float64) + dy
+    valid = np.isfinite(x) & np.isfinite(y)
+    names = getattr(getattr(tile, 'dtype', None), 'names', None)
+    if 'point_n' in (names if names is not None else tile.keys()):
+        valid &= np.ravel(tile['point_n']) > 0
+    return x, y, valid
+
+
+def tile_points(tile, signal='pmt', offset=(0., 0.), feather=.1):
+    """
+    Returns the x, y, value and weight arrays of the measured points of a
+    tile, the weights by the distance to the edges of the whole tile.
+    """
+    x, y, valid = _positions(tile, offset)
+    value = np.ravel(tile[signal]).astype(np.float64)
+    valid &= np.isfinite(value)
+    weight = edge_weights(np.shape(tile[signal]), feather).ravel()
+    return x[valid], y[valid], value[valid], weight[valid]
+
+
+def _tile_bounds(tile, offset):
+    """
+    Returns the (x_min, x_max, y_min, y_max) of the measured points of a
+    tile, None if it has none.
+    """
+    x, y, valid = _positions(_load(tile), offset)
+    if not valid.any():
+        return None
+    x, y = x[valid], y[valid]
+    return x.min(), x.max(), y.min(), y.max()
+
+
+def _sum_tile(tile, signal, offset, feather, x0, y0, pixel):
+    """
+    Returns the first row and column of the bounding box of the tile on the
+    grid, with the weighted sum and the sum of the weights of its pixels.
+    """
+    x, y, value, weight = tile_points(_load(tile), signal, offset, feather)
+    if not len(x):
+        return 0, 0, None, None
+    rows = np.rint((y - y0) / pixel).astype(np.int64)
+    cols = np.rint((x - x0) / pixel).astype(np.int64)
+    row0, col0 = rows.min(), cols.min()
+    shape = (rows.max() - row0 + 1, cols.max() - col0 + 1)
+    idx = (rows - row0) * shape[1] + (cols - col0)
+    size = shape[0] * shape[1]
+    tile_sum = np.bincount(idx, weights=weight * value, minlength=size).reshape(shape)
+    tile_weight = np.bincount(idx, weights=weight, minlength=size).reshape(shape)
+    return int(row0), int(col0), tile_sum, tile_weight
+
+
+def stitch(tiles, pixel, signal='pmt', offsets=None, feather=.1, workers=1):
+    """
+    Stitches the tiles, mappings or structured arrays with 'x', 'y' and the
+    signal channel, or paths of .npy maps, into a mosaic with square pixels of
+    the given size. offsets are optional (dx, dy) corrections added to the
+    measured positions of each tile. With workers > 1 the tiles are summed by
+    a process pool, given by their paths they are read by the workers.
+    Returns the mosaic, NaN where no tile has points, and the position
+    (x0, y0) of its first pixel.
+    """
+    tiles = list(tiles)
+    if not tiles:
+        raise ValueError('No tiles to stitch')
+    if offsets is None:
+        offsets = [(0., 0.)] * len(tiles)
+    offsets = list(offsets)
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+    try:
+        tile_map = pool.map if pool is not None else map
+        bounds = [b for b in tile_map(_tile_bounds, tiles, offsets) if b is not None]
+        if not bounds:
+            raise ValueError('No measured points in the tiles')
+        x_min, x_max, y_min, y_max = np.array(bounds).T
+        x0, y0 = x_min.min(), y_min.min()
+        n = len(tiles)
+        sums = list(tile_map(_sum_tile, tiles, [signal] * n, offsets, [feather] * n,
+                             [x0] * n, [y0] * n, [pixel] * n))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    nx = int(np.rint((x_max.max() - x0) / pixel)) + 1
+    ny = int(np.rint((y_max.max() - y0) / pixel)) + 1
+    grid_sum = np.zeros((ny, nx))
+    grid_weight = np.zeros((ny, nx))
+    for row0, col0, tile_sum, tile_weight in sums:
+        if tile_sum is None:
+            continue
+        box = (slice(row0, row0 + tile_sum.shape[0]), slice(col0, col0 + tile_sum.shape[1]))
+        grid_sum[box] += tile_sum
+        grid_weight[box] += tile_weight
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        image = np.where(grid_weight > 0, grid_sum / grid_weight, np.nan)
+    return image, (x0, y0)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Stitches PandaPosTrig .npy maps into a mosaic.')
+    parser.add_argument('output', help='.npy file of the mosaic')
+    parser.add_argument('tiles', nargs='+', help='.npy maps written by StartMap')
+    parser.add_argument('--pixel', type=float, required=True, help='pixel size in microns')
+    parser.add_argument('--signal', default='pmt', help='channel to stitch')
+    parser.add_argument('--feather', type=float, default=.1, help='blending ramp, fraction of the tile size')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes, worth it only for tiles of many points')
+    args = parser.parse_args(args)
+
+    image, (x0, y0) = stitch(args.tiles, args.pixel, signal=args.signal, feather=args.feather,
+                             workers=args.workers)
+    np.save(args.output, image)
+    print(f'{image.shape[1]}x{image.shape[0]} mosaic, first pixel at x={x0:.4f} y={y0:.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Accumulation of repeated passes of a line.
+
+The points of every pass are added to the sums of the previous ones, a whole
+channel at a time. The accumulated line is the line of a single pass with
+the dwell of all passes: the positions are the means over the passes, the
+counts and the dwell their sums, so that the count rates and the transmission
+are the averages, without rounding the counts. The line keeps the number of
+passes summed into it, fewer than requested if the line has been cut short. The variance of the counts of
+every point over the passes is kept as well. Passes with fewer points, e.g.
+after a shorter move, shorten the accumulated line.
+"""
+
+import numpy as np
+
+from .linebuffer import POINT_DTYPE, Line
+
+# Channels averaged over the passes
+MEAN_CHANNELS = ('x', 'y')
+# Channels whose variance over the passes is kept
+VARIANCE_CHANNELS = ('pmt', 'p_diode')
+
+
+class PassAccumulator(object):
+    """
+    Sums the passes of one line, given by its index.
+    """
+    def __init__(self, passes=1):
+        self.passes = passes
+        self.reset()
+
+    def reset(self, index=None):
+        self.index = index
+        self.count = 0
+        self.length = 0
+        self._sums = {}
+        self._squares = {}
+        self._first = None
+
+    def add(self, line):
+        """
+        Adds a pass, a pass of another line starts a new accumulation.
+        Returns True once all passes of the line are in.
+        """
+        if line.index != self.index:
+            self.reset(line.index)
+        data = line.data[:len(line)]
+        names = [name for name in data.dtype.names
+                 if name not in ('point_n', 'transmission', 'timestamp')]
+        if not self.count:
+            self.length = len(data)
+            self._first = data.copy()
+            self._sums = {name: data[name].astype(np.float64) for name in names}
+            self._squares = {name: np.square(data[name], dtype=np.float64) for name in VARIANCE_CHANNELS}
+        else:
+            n = min(self.length, len(data))
+            self.length = n
+            for name, values in self._sums.items():
+                values = values[:n]
+                values += data[name][:n]
+                self._sums[name] = values
+            for name, values in self._squares.items():
+                values = values[:n]
+                values += np.square(data[name][:n], dtype=np.float64)
+                self._squares[name] = values
+        self.count += 1
+        return self.count >= self.passes
+
+    def variance(self, name):
+        """
+        Returns the variance over the passes of every point of the channel.
+        """
+        if not self.count:
+            return np.zeros(0)
+        mean = self._sums[name] / self.count
+        return np.maximum(self._squares[name] / self.count - np.square(mean), 0.)
+
+    def line(self):
+        """
+        Returns the accumulated line.
+        """
+        n = self.length
+        line = Line(self.index, n, self._first.dtype)
+        sums = self._sums
+
+        def total(name):
+            return np.rint(sums[name][:n]).astype(np.int64)
+
+        extra = self._first.dtype.names[len(POINT_DTYPE.names):]
+        line.extend(sums['x'] / self.count, sums['y'] / self.count, sums['dwell'],
+                    total('pmt'), total('p_diode'), self._first['point_n'][:n],
+                    extra=[total(name) for name in extra])
+        line.passes = self.count
+        return line
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" PCAP data port stream description.
+
+"""
+
+X_POS = 'INENC1.VAL'
+Y_POS = 'INENC2.VAL'
+DWELL = 'COUNTER1.OUT'
+PMT = 'COUNTER2.OUT'
+P_DIODE = 'COUNTER3.OUT'
+POINT_N = 'COUNTER4.OUT'
+TS_START = 'PCAP.TS_START'
+TS_TRIG = 'PCAP.TS_TRIG'
+
+# Column order of the pos_trig_stxm_ctrl layout, used until a header is received
+DEFAULT_COLUMNS = (X_POS, Y_POS, DWELL, PMT, P_DIODE, POINT_N)
+
+
+class PcapHeader(object):
+    """
+    Follows the header sent on the data port at the start of every
+    acquisition and keeps the column index of each captured field.
+
+    The 'fields:' section of the header lists one captured field per line,
+    e.g. ' INENC1.VAL int32 Value scale: 1 offset: 0 units: ', and is closed
+    by an empty line. A field captured more than once, e.g. 'Min Max', gets
+    one column per capture, the following ones are named FIELD.CAPTURE.
+    """
+    def __init__(self, columns=DEFAULT_COLUMNS):
+        self._in_fields = False
+        self._fields = []
+        self._set_columns(columns)
+
+    def _set_columns(self, columns):
+        self.columns = tuple(columns)
+        self.index = {name: idx for idx, name in enumerate(self.columns)}
+
+    def feed(self, line):
+        """
+        Returns True if the line belongs to the header and has been consumed.
+        """
+        if self._in_fields:
+            if line.strip() and not line.lstrip()[0] in '+-0123456789':
+                tokens = line.split()
+                name, captures = tokens[0], []
+                for token in tokens[2:]:
+                    if token.endswith(':'):
+                        break
+                    captures.append(token)
+                self._fields.append(name)
+                self._fields.extend(f'{name}.{capture}' for capture in captures[1:])
+                return True
+            self._in_fields = False
+            self._set_columns(self._fields)
+            if not line.strip():
+                return True
+        if line.strip() == 'fields:':
+            self._in_fields = True
+            self._fields = []
+            return True
+        head, sep, _ = line.partition(':')
+        return bool(sep) and head.isidentifier()
+
+
+def build_line_parser():
+    """
+    Returns the parsing expression of the data port lines, pyparsing is
+    imported here so that it is only loaded by the data thread.
+    """
+    from pyparsing import Regex, Literal, OneOrMore, restOfLine
+    num_value = Regex(r'[-+]?\d+(\.\d*)?([eE][-+]?\d+)?').setParseAction(
+        lambda val: int(val[0]) if val[0].lstrip('+-').isdigit() else float(val[0]))
+    panda_OK_reply = Literal('OK')
+    panda_END_reply = Literal('END') + restOfLine
+    pcap_point_values = OneOrMore(num_value)
+    return panda_OK_reply | pcap_point_values | panda_END_reply
+
+
+class DataPortStream(object):
+    """
+    Parses the data port stream, as received in chunks that may end in the
+    middle of a line. Every point is passed to on_point(values, index), with
+    index mapping the captured field names to their columns, and every END
+    message to on_end(). The device and the session replay share it.
+
+    With on_points, the consecutive points of a chunk are passed at once to
+    on_points(rows, index) instead, so that they can be processed as an array.
+    """
+    def __init__(self, on_point, on_end, tracer=None, on_points=None):
+        from pyparsing import ParseException
+        self._parse_exception = ParseException
+        self.parser = build_line_parser()
+        self.header = PcapHeader()
+        self.on_point = on_point
+        self.on_end = on_end
+        self.on_points = on_points
+        self.tracer = tracer
+        self.partial = ''
+        self._rows = []
+        self._rows_index = None
+
+    def _warning(self, fmt, *args):
+        if self.tracer is not None:
+            self.tracer.warning(fmt, *args)
+
+    def _flush(self):
+        if self._rows:
+            rows, self._rows = self._rows, []
+            self.on_points(rows, self._rows_index)
+
+    def feed(self, text):
+        # A chunk may end in the middle of a line, which is completed by the next one
+        *lines, self.partial = (self.partial + text).split('\n')
+
+        for line in lines:
+            if self.header.feed(line):
+                continue
+            try:
+                res = self.parser.parseString(line)
+            except ValueError as val_err:
+                self._warning('Value conversion error during panda reply parsing: %s', val_err)
+                continue
+            except self._parse_exception as pe:
+                self._warning('Cannot parse the data port line %r: %s', line, pe)
+                continue
+
+            if isinstance(res[0], (int, float)):
+                if self.on_points is None:
+                    self.on_point(list(res), self.header.index)
+                else:
+                    if not self._rows:
+                        # A new header replaces the index, the rows keep theirs
+                        self._rows_index = self.header.index
+                    self._rows.append(list(res))
+                continue
+            self._flush()
+            if res[0] == 'END':
+                if self.tracer is not None:
+                    self.tracer.info('END message on the data port:%s', res[1])
+                self.on_end()
+            else:
+                self._warning('Not an array element: %s', res)
+        self._flush()
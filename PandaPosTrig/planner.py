@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Planning of the fly scan lines from the stage limits and the detector timing.
+
+The stage has to be at constant velocity when it crosses the trigger position,
+so it starts the line a run-up distance before it. The run-up covers the
+acceleration ramp, the settling time and the delay between the trigger and the
+first point. PCOMP only waits for START once the position has been PRE_START
+away from it, so PRE_START has to be above the position noise and below the
+run-up margin. All positions are in microns and times in seconds.
+
+    from PandaPosTrig.planner import plan_scan
+    plan = plan_scan(0, 10, 100, .009, .001, n_lines=101, acceleration=1e4)
+    print(plan.summary())
+
+Sparse scans only cover the region of interest of a mask, e.g. thresholded
+from a coarse preview, with one or more segments per line. Each segment is
+a line of its own, with its trigger position and number of points:
+
+    mask = mask_from_image(preview, threshold=.8 * preview.max(), shape=(101, 100))
+    sparse = plan_sparse(mask, 0, 10, .009, .001, acceleration=1e4)
+    print(sparse.summary())
+"""
+
+import math
+
+import numpy as np
+
+
+def ramp_time(velocity, acceleration):
+    """
+    Returns the time to accelerate from rest to velocity.
+    """
+    return velocity / acceleration
+
+
+def ramp_distance(velocity, acceleration):
+    """
+    Returns the distance covered while accelerating from rest to velocity.
+    """
+    return velocity ** 2 / (2 * acceleration)
+
+
+def move_time(distance, max_velocity, acceleration):
+    """
+    Returns the duration of a point to point move with a trapezoidal (or, for
+    short moves, triangular) velocity profile.
+    """
+    distance = abs(distance)
+    if 2 * ramp_distance(max_velocity, acceleration) >= distance:
+        return 2 * math.sqrt(distance / acceleration)
+    return 2 * ramp_time(max_velocity, acceleration) \
+        + (distance - 2 * ramp_distance(max_velocity, acceleration)) / max_velocity
+
+
+class ScanPlan(object):
+    """
+    Velocity, run-up margin, PCOMP PRE_START and time estimate of a scan.
+    """
+    def __init__(self, velocity, trig_pos, margin, pre_start, line_time, flyback_time,
+                 line_overhead, n_lines, n_points, exptime):
+        self.velocity = velocity
+        self.trig_pos = trig_pos
+        self.margin = margin
+        self.pre_start = pre_start
+        self.line_time = line_time
+        self.flyback_time = flyback_time
+        self.line_overhead = line_overhead
+        self.n_lines = n_lines
+        self.n_points = n_points
+        self.exptime = exptime
+
+    @property
+    def total_time(self):
+        return self.n_lines * (self.line_time + self.flyback_time + self.line_overhead)
+
+    @property
+    def efficiency(self):
+        """
+        Fraction of the scan time spent integrating the detectors.
+        """
+        if self.total_time == 0:
+            return 0.
+        return self.n_lines * self.n_points * self.exptime / self.total_time
+
+    def summary(self):
+        return (f'velocity {self.velocity:.4g} um/s, margin {self.margin:.4g} um, '
+                f'PRE_START {self.pre_start:.4g} um, trigger at {self.trig_pos:.4g} um\n'
+                f'line {1000 * self.line_time:.1f} ms, flyback {1000 * self.flyback_time:.1f} ms, '
+                f'overhead {1000 * self.line_overhead:.1f} ms\n'
+                f'total {self.total_time:.1f} s for {self.n_lines} lines, '
+                f'efficiency {100 * self.efficiency:.1f} %')
+
+
+def plan_scan(start, end, n_points, exptime, latency, n_lines=1, acceleration=1e4,
+              fast=1000., max_velocity=None, settle_time=0., trig_latency=0.,
+              noise=.05, line_overhead=0.):
+    """
+    Plans the lines of a fly scan from start to end with n_points points of
+    exptime integration and latency dead time each.
+
+    acceleration and fast are the stage acceleration and flyback velocity,
+    max_velocity its velocity limit. settle_time is the time the velocity
+    needs to settle after the ramp, trig_latency the delay from the line
+    trigger to the first point, noise the position noise and line_overhead
+    the fixed time per line, e.g. the Y step and arming.
+    """
+    if n_points < 1:
+        raise ValueError('At least one point per line is needed')
+    if acceleration <= 0:
+        raise ValueError('The acceleration has to be positive')
+    period = exptime + latency
+    length = abs(end - start)
+    direction = 1 if end >= start else -1
+    velocity = length / (n_points * period)
+    if max_velocity is not None and velocity > max_velocity:
+        raise ValueError(f'The scan velocity {velocity:.4g} um/s is above the stage limit '
+                         f'{max_velocity:.4g} um/s, increase the dwell time or the number of points')
+
+    # The first point starts trig_latency after the trigger
+    trig_pos = start - direction * velocity * trig_latency
+    run_up = ramp_distance(velocity, acceleration) + velocity * (settle_time + trig_latency)
+    pre_start = 2 * noise
+    margin = max(run_up, pre_start) + noise
+
+    # From rest at start - margin to rest after end
+    if velocity > 0:
+        cruise = (margin - ramp_distance(velocity, acceleration)) / velocity
+    else:
+        cruise = 0.
+    line_time = ramp_time(velocity, acceleration) + cruise + n_points * period \
+        + ramp_time(velocity, acceleration)
+    flyback = length + margin + ramp_distance(velocity, acceleration)
+    flyback_time = move_time(flyback, fast, acceleration)
+    return ScanPlan(velocity, trig_pos, margin, pre_start, line_time, flyback_time,
+                    line_overhead, n_lines, n_points, exptime)
+
+
+def mask_from_image(image, threshold, shape, below=True):
+    """
+    Returns the boolean mask of the given (lines, points) shape of a coarse
+    image, e.g. the PreviewImage, resampled to the nearest pixel. With below,
+    the pixels under the threshold, the absorbing sample of a transmission
+    image, are in the region of interest, otherwise those above it.
+    """
+    image = np.asarray(image)
+    n_lines, n_points = shape
+    rows = np.arange(n_lines) * image.shape[0] // n_lines
+    cols = np.arange(n_points) * image.shape[1] // n_points
+    resampled = image[np.ix_(rows, cols)]
+    return resampled < threshold if below else resampled > threshold
+
+
+def roi_segments(mask, min_gap=1, pad=0):
+    """
+    Returns, for every line of the mask, the (start, stop) point ranges of
+    its region of interest. Every range is widened by pad points on both
+    sides, and ranges less than min_gap points apart are merged, as every
+    segment costs a run-up and an arming.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    n_lines, n_points = mask.shape
+    if pad > 0:
+        padded = mask.copy()
+        for shift in range(1, pad + 1):
+            padded[:, shift:] |= mask[:, :-shift]
+            padded[:, :-shift] |= mask[:, shift:]
+        mask = padded
+    edges = np.diff(np.pad(mask.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+
+    # A range continues the previous one on the same line across a short gap
+    merged = np.zeros(len(starts), dtype=bool)
+    merged[1:] = (rows[1:] == rows[:-1]) & (starts[1:] - stops[:-1] < min_gap)
+    segments = [[] for _ in range(n_lines)]
+    for row, start, stop, merge in zip(rows.tolist(), starts.tolist(), stops.tolist(), merged.tolist()):
+        if merge:
+            segments[row][-1] = (segments[row][-1][0], stop)
+        else:
+            segments[row].append((start, stop))
+    return segments
+
+
+class SparsePlan(object):
+    """
+    Segments of every line of a sparse scan, each with its ScanPlan, and the
+    time of the full scan for comparison.
+    """
+    def __init__(self, lines, n_points, full_time):
+        self.lines = lines
+        self.n_points = n_points
+        self.full_time = full_time
+
+    @property
+    def n_segments(self):
+        return sum(len(segments) for segments in self.lines)
+
+    @property
+    def roi_fraction(self):
+        """
+        Fraction of the points of the full frame that are scanned.
+        """
+        if not self.lines:
+            return 0.
+        scanned = sum(stop - start for segments in self.lines for start, stop, _ in segments)
+        return scanned / (len(self.lines) * self.n_points)
+
+    @property
+    def total_time(self):
+        return sum(plan.total_time for segments in self.lines for _, _, plan in segments)
+
+    def summary(self):
+        return (f'{self.n_segments} segments in {len(self.lines)} lines, '
+                f'{100 * self.roi_fraction:.1f} % of the points\n'
+                f'total {self.total_time:.1f} s, full frame {self.full_time:.1f} s')
+
+
+def plan_sparse(mask, start, end, exptime, latency, min_gap=1, pad=0, **kwargs):
+    """
+    Plans the segments of a sparse scan of the lines of the mask, from start
+    to end, see roi_segments. The keyword arguments are passed to plan_scan.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    n_lines, n_points = mask.shape
+    step = (end - start) / n_points
+    lines = [[(seg_start, seg_stop,
+               plan_scan(start + seg_start * step, start + seg_stop * step, seg_stop - seg_start,
+                         exptime, latency, **kwargs))
+              for seg_start, seg_stop in segments]
+             for segments in roi_segments(mask, min_gap=min_gap, pad=pad)]
+    full_time = plan_scan(start, end, n_points, exptime, latency, n_lines=n_lines, **kwargs).total_time
+    return SparsePlan(lines, n_points, full_time)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Sampling of the encoder positions for the AbsX/AbsY events.
+
+The positions are queried in one pipelined request per sample, on a control
+connection of their own, so that the sampler neither waits for nor delays the
+control path of the acquisition. Every sample is kept in a ring buffer and
+passed to on_sample(timestamp, x, y), with the raw encoder values. The
+sampler reconnects by itself if the connection is lost.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from . import pcap
+
+
+class PositionMonitor(object):
+    """
+    Samples the fields at rate Hz in a thread, keeping the last size samples.
+    A rate of zero pauses the sampling.
+    """
+    def __init__(self, connect, on_sample, rate=100., size=10000, fields=(pcap.X_POS, pcap.Y_POS)):
+        self.connect = connect
+        self.on_sample = on_sample
+        self.rate = rate
+        self.lock = threading.Lock()
+        self._request = bytes(''.join(f'{field}?\n' for field in fields), 'ascii')
+        self._n_fields = len(fields)
+        self._history = np.zeros((max(size, 1), 1 + len(fields)))
+        self._count = 0
+
+    def _query(self, sock, buff):
+        """
+        Returns the values of the fields and the received bytes not yet used.
+        """
+        sock.sendall(self._request)
+        values = []
+        while True:
+            *lines, buff = buff.split(b'\n')
+            # 'OK =value'
+            values.extend(int(line.partition(b'=')[2]) for line in lines)
+            if len(values) >= self._n_fields:
+                return values, buff
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('PandABox closed the position monitor connection')
+            buff += chunk
+
+    def _add(self, timestamp, values):
+        with self.lock:
+            self._history[self._count % len(self._history)] = (timestamp, *values)
+            self._count += 1
+
+    def history(self):
+        """
+        Returns the samples in time order, one row of (time, values...) each.
+        """
+        with self.lock:
+            size = len(self._history)
+            if self._count <= size:
+                return self._history[:self._count].copy()
+            start = self._count % size
+            return np.concatenate((self._history[start:], self._history[:start]))
+
+    def run(self, stop_event):
+        sock = None
+        buff = b''
+        deadline = time.perf_counter()
+        while not stop_event.is_set():
+            try:
+                rate = float(self.rate)
+                if rate <= 0:
+                    stop_event.wait(.1)
+                    deadline = time.perf_counter()
+                    continue
+                if sock is None:
+                    sock = self.connect()
+                    buff = b''
+                values, buff = self._query(sock, buff)
+            except Exception:
+                if sock is not None:
+                    sock.close()
+                    sock = None
+                stop_event.wait(1.)
+                continue
+            timestamp = time.time()
+            self._add(timestamp, values)
+            self.on_sample(timestamp, *values)
+
+            # Fixed rate, the missed samples are skipped if the query is slower
+            deadline = max(deadline + 1. / rate, time.perf_counter())
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                stop_event.wait(delay)
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Decimated live preview of the running STXM map.
+
+"""
+
+import threading
+import time
+
+import numpy as np
+
+# Maximum preview size, the max_dim of the PreviewImage attribute
+MAX_SIZE = 1024
+
+
+class PreviewMap(object):
+    """
+    Keeps a downsampled, binned copy of the running map.
+
+    Every point is accumulated into the preview bin given by its line and point
+    index, the preview value of a bin is the mean of all points that fell into it.
+    The preview shape is limited to size x size, so that its cost does not depend
+    on the scan size, and to MAX_SIZE.
+    """
+    def __init__(self, size=256, max_rate=5.):
+        self.lock = threading.Lock()
+        self.size = min(max(int(size), 1), MAX_SIZE)
+        self.max_rate = max_rate
+        self._last_push = 0.
+        self._dirty = False
+        self.reset(self.size, self.size)
+
+    def reset(self, n_lines, n_points):
+        """
+        Clears the preview and sets the full map dimensions, an unknown
+        dimension (<= 0) is taken as size.
+        """
+        with self.lock:
+            self.n_lines = int(n_lines) if n_lines > 0 else self.size
+            self.n_points = int(n_points) if n_points > 0 else self.size
+            shape = (min(self.n_lines, self.size), min(self.n_points, self.size))
+            self._sum = np.zeros(shape, dtype=np.float64)
+            self._cnt = np.zeros(shape, dtype=np.uint32)
+            self._dirty = True
+
+    def add_point(self, line_idx, point_idx, value):
+        """
+        Adds a single map point to its preview bin.
+        """
+        with self.lock:
+            rows, cols = self._sum.shape
+            row = (line_idx % self.n_lines) * rows // self.n_lines
+            col = min(max(point_idx, 0), self.n_points - 1) * cols // self.n_points
+            self._sum[row, col] += value
+            self._cnt[row, col] += 1
+            self._dirty = True
+
+    def add_points(self, line_idx, first_point_idx, values):
+        """
+        Adds consecutive points of a line, starting at first_point_idx.
+        """
+        with self.lock:
+            rows, cols = self._sum.shape
+            row = (line_idx % self.n_lines) * rows // self.n_lines
+            points = np.arange(first_point_idx, first_point_idx + len(values))
+            col = np.clip(points, 0, self.n_points - 1) * cols // self.n_points
+            np.add.at(self._sum[row], col, values)
+            np.add.at(self._cnt[row], col, 1)
+            self._dirty = True
+
+    def image(self):
+        """
+        Returns the preview image, empty bins are zero.
+        """
+        with self.lock:
+            return np.divide(self._sum, self._cnt,
+                             out=np.zeros_like(self._sum),
+                             where=self._cnt > 0)
+
+    def due(self, force=False):
+        """
+        Returns True if the preview has changed since the last event and the
+        maximum event rate allows to push a new one.
+        """
+        now = time.time()
+        if not self._dirty:
+            return False
+        if not force and self.max_rate > 0 and now - self._last_push < 1. / self.max_rate:
+            return False
+        self._last_push = now
+        self._dirty = False
+        return True
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Packed binary line records, as sent in the DevEncoded LineRecord attribute.
+
+A record is a small header followed by the channel arrays, one after the other:
+
+    header   '<4sBBHqI' magic b'PPTR', version, compression, number of channels,
+             line index (DetTrigCntr), number of points
+    channels '<16s4s' per channel, its name and numpy dtype string, e.g. '<u8'
+    body     the channel arrays, optionally compressed
+
+With DELTA_ZLIB, the integer channels are delta encoded before the body is
+compressed, which makes slowly varying counters compress well.
+
+On the client side a record is unpacked with:
+
+    from PandaPosTrig.record import unpack_line
+    line_index, data = unpack_line(*panda.LineRecord)
+    data['pmt'], data['x'], ...
+"""
+
+import enum
+import struct
+import zlib
+
+import numpy as np
+
+FORMAT = 'pandapostrig-line'
+MAGIC = b'PPTR'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sBBHqI')
+_CHANNEL = struct.Struct('<16s4s')
+
+
+class RecordCompression(enum.IntEnum):
+    """Python enumerated type for LineRecordCompression attribute."""
+    NONE = 0
+    ZLIB = 1
+    DELTA_ZLIB = 2
+
+
+def pack_line(line_index, channels, compression=RecordCompression.NONE):
+    """
+    Packs the channels, an ordered mapping name -> array, of a line into a
+    record. Returns the (format, data) pair of a DevEncoded value.
+    """
+    compression = RecordCompression(compression)
+    arrays = [(name, np.ascontiguousarray(values)) for name, values in channels.items()]
+    n_points = min((len(values) for _, values in arrays), default=0)
+
+    parts = [_HEADER.pack(MAGIC, VERSION, compression, len(arrays), line_index, n_points)]
+    body = []
+    for name, values in arrays:
+        values = values[:n_points]
+        dtype = values.dtype.newbyteorder('<')
+        parts.append(_CHANNEL.pack(name.encode(), dtype.str.encode()))
+        values = values.astype(dtype, copy=False)
+        if compression == RecordCompression.DELTA_ZLIB and dtype.kind in 'iu':
+            values = np.diff(values, prepend=dtype.type(0))
+        body.append(values.tobytes())
+    body = b''.join(body)
+    if compression != RecordCompression.NONE:
+        body = zlib.compress(body)
+    parts.append(body)
+    return FORMAT, b''.join(parts)
+
+
+def unpack_line(fmt, data):
+    """
+    Unpacks a record, returns the line index and a numpy structured array with
+    one field per channel.
+    """
+    if fmt != FORMAT:
+        raise ValueError(f'Unknown line record format: {fmt}')
+    magic, version, compression, n_channels, line_index, n_points = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a PandaPosTrig line record')
+    offset = _HEADER.size
+    fields = []
+    for _ in range(n_channels):
+        name, dtype = _CHANNEL.unpack_from(data, offset)
+        fields.append((name.rstrip(b'\0').decode(), np.dtype(dtype.rstrip(b'\0').decode())))
+        offset += _CHANNEL.size
+    body = data[offset:]
+    if compression != RecordCompression.NONE:
+        body = zlib.decompress(body)
+
+    out = np.empty(n_points, dtype=fields)
+    pos = 0
+    for name, dtype in fields:
+        values = np.frombuffer(body, dtype=dtype, count=n_points, offset=pos)
+        if compression == RecordCompression.DELTA_ZLIB and dtype.kind in 'iu':
+            values = np.cumsum(values, dtype=dtype)
+        out[name] = values
+        pos += n_points * dtype.itemsize
+    return line_index, out
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" STXM scan orchestration on top of the PandaPosTrig device.
+
+The stages of consecutive lines are overlapped: while the data of line k is
+fetched from the device and written to the HDF5 file in a background thread,
+the stages already move to line k+1 and the trigger is armed during the
+flyback. The scan time per line is then bounded by the slowest stage instead
+of the sum of all of them. Completion is signalled by change events where the
+devices push them, with polling as a fallback.
+
+    from PandaPosTrig.scan import StxmScan
+    scan = StxmScan()
+    scan.do_stxm(0, 10, 0, 10, Nx=100, Ny=100, exptime=.009, latency=.001)
+    print(scan.timer.report())
+
+do_sparse_stxm only scans the region of interest of a mask, segment by
+segment, and writes every segment at its offset into the full frame.
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+from tango import DeviceProxy, DevFailed, EventType
+
+from .planner import plan_scan, plan_sparse, roi_segments
+from .record import RecordCompression, unpack_line
+
+log = logging.getLogger(__name__)
+
+SLEEP = .01
+FAST = 1000
+MARGIN = 1.
+# Events may get lost, the attribute is read directly at least this often
+EVENT_FALLBACK = .5
+# Time allowed beyond twice the motion time of a line for its completion
+LINE_TIMEOUT = 10.
+
+
+class StageTimer(object):
+    """
+    Accumulates the time spent in every stage of the scan.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.totals[name] += elapsed
+                self.counts[name] += 1
+
+    def report(self):
+        with self.lock:
+            return '\n'.join(f'{name:8s} total {total:8.3f} s, '
+                             f'mean {1000 * total / self.counts[name]:8.2f} ms '
+                             f'({self.counts[name]} times)'
+                             for name, total in self.totals.items())
+
+
+class AttributeWaiter(object):
+    """
+    Waits until an attribute value fulfils a condition, on the change events
+    of the attribute if the device pushes them, by polling otherwise.
+    """
+    def __init__(self, proxy, attr, poll=SLEEP):
+        self.proxy = proxy
+        self.attr = attr
+        self.poll = poll
+        self._cond = threading.Condition()
+        self._value = None
+        self._event_id = None
+        try:
+            self._event_id = proxy.subscribe_event(attr, EventType.CHANGE_EVENT, self._push)
+        except DevFailed:
+            log.info(f'No change events for {proxy.name()}/{attr}, polling it')
+
+    def _push(self, event):
+        if event.err or event.attr_value is None:
+            return
+        with self._cond:
+            self._value = event.attr_value.value
+            self._cond.notify_all()
+
+    def reset(self):
+        """
+        Forgets the last event, e.g. before starting a motion.
+        """
+        with self._cond:
+            self._value = None
+
+    def wait(self, predicate, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poll = self.poll if self._event_id is None else EVENT_FALLBACK
+        with self._cond:
+            while not predicate(self._value):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f'Timeout waiting for {self.proxy.name()}/{self.attr}')
+                if self._event_id is None or not self._cond.wait(poll):
+                    if self._event_id is None:
+                        self._cond.release()
+                        try:
+                            time.sleep(poll)
+                        finally:
+                            self._cond.acquire()
+                    self._value = self.proxy.read_attribute(self.attr).value
+
+    def close(self):
+        if self._event_id is not None:
+            self.proxy.unsubscribe_event(self._event_id)
+            self._event_id = None
+
+
+class StxmScan(object):
+    """
+    Pipelined STXM map acquisition with the PandaPosTrig device and the PI
+    X and Y stages.
+    """
+    def __init__(self,
+                 panda='B318A-EA01/CTL/PandaPosTrig',
+                 pi_x='B318A-EA01/CTL/PI_X',
+                 pi_y='B318A-EA01/CTL/PI_Y',
+                 fast=FAST,
+                 margin=MARGIN,
+                 compression=RecordCompression.DELTA_ZLIB,
+                 acceleration=None,
+                 max_velocity=None,
+                 settle_time=0.,
+                 trig_latency=0.):
+        self.panda = DeviceProxy(panda)
+        self.pi_x = DeviceProxy(pi_x)
+        self.pi_y = DeviceProxy(pi_y)
+        self.fast = fast
+        self.margin = margin
+        self.compression = compression
+        # Stage limits for the planner, the fixed margin is used without them
+        self.acceleration = acceleration
+        self.max_velocity = max_velocity
+        self.settle_time = settle_time
+        self.trig_latency = trig_latency
+        self.timer = StageTimer()
+        self._x_on_target = AttributeWaiter(self.pi_x, 'OnTarget')
+        self._y_on_target = AttributeWaiter(self.pi_y, 'OnTarget')
+        self._line_done = AttributeWaiter(self.panda, 'PrevLineIndex')
+        self._segment_settings = {}
+
+    def close(self):
+        for waiter in (self._x_on_target, self._y_on_target, self._line_done):
+            waiter.close()
+
+    def plan(self, start, end, N, exptime, latency, n_lines=1):
+        """
+        Returns the plan of the lines, or None without stage acceleration.
+        """
+        if self.acceleration is None:
+            return None
+        return plan_scan(start, end, N, exptime, latency, n_lines=n_lines,
+                         acceleration=self.acceleration, fast=self.fast,
+                         max_velocity=self.max_velocity, settle_time=self.settle_time,
+                         trig_latency=self.trig_latency)
+
+    @staticmethod
+    def velocity(start, end, N, exptime, latency, plan=None):
+        """
+        Returns the scan velocity of a line, that of the plan if there is one.
+        """
+        if plan is not None:
+            return plan.velocity
+        return abs(start - end) / (N * (exptime + latency))
+
+    def setup(self, start, N, exptime, latency, plan=None):
+        """
+        Sets the trigger and the time pulses, which are the same for all lines,
+        after resetting the trigger counter of the previous scan.
+        """
+        with self.timer.stage('setup'):
+            self.panda.ResetTrigCntr()
+            # The lines of a previous scan are done, until the reset index arrives
+            self._line_done.wait(lambda idx: idx is not None and idx < 0, LINE_TIMEOUT)
+            self.panda.TrigAxis = 'X'  # triger axis X or Y for horizontal and vertical respectively
+            if plan is not None:
+                self.panda.TrigPreStart = plan.pre_start
+                start = plan.trig_pos
+            self.panda.TrigXPos = float(start)  # position in microns
+            self.panda.DetTimePulseStep = 1e3 * (exptime + latency)
+            self.panda.DetTimePulseWidth = 1e3 * exptime
+            self.panda.DetTimePulseN = N
+            self.panda.TimePulsesEnable = True
+            self.panda.LineRecordCompression = self.compression
+
+    def setup_segment(self, start, N, plan=None, offset=None):
+        """
+        Sets the trigger position and the number of points of a segment of a
+        sparse scan, only the changed settings are written. offset, the map
+        row and column of the segment, places it in the preview and the map.
+        """
+        settings = [('TrigXPos', float(start if plan is None else plan.trig_pos)),
+                    ('DetTimePulseN', int(N))]
+        if plan is not None:
+            settings.append(('TrigPreStart', plan.pre_start))
+        with self.timer.stage('setup'):
+            if offset is not None:
+                self.panda.SegmentOffset = [int(v) for v in offset]
+            for name, value in settings:
+                if self._segment_settings.get(name) != value:
+                    self.panda.write_attribute(name, value)
+                    self._segment_settings[name] = value
+
+    def prepare_line(self, x_start, y_val=None, margin=None, direction=1):
+        """
+        Moves to the run-up start of the next line, margin before x_start in
+        the scan direction (1 or -1), and arms the trigger during the flyback.
+        Returns the index of the armed line.
+        """
+        if margin is None:
+            margin = self.margin
+        with self.timer.stage('move'):
+            self._x_on_target.reset()
+            self.pi_x.Velocity = self.fast
+            self.pi_x.Position = x_start - direction * margin
+            if y_val is not None:
+                self._y_on_target.reset()
+                self.pi_y.Position = y_val
+        with self.timer.stage('arm'):
+            self.panda.ArmSingle()
+            line_index = self.panda.DetTrigCntr - 1
+        with self.timer.stage('move'):
+            self._x_on_target.wait(bool)
+            if y_val is not None:
+                self._y_on_target.wait(bool)
+        return line_index
+
+    def fly_line(self, x_end, vel, line_index, timeout=None):
+        """
+        Does the controlled movement and waits until the line is complete,
+        by default for twice the motion time and LINE_TIMEOUT.
+        """
+        with self.timer.stage('acquire'):
+            if timeout is None:
+                timeout = LINE_TIMEOUT
+                if vel > 0:
+                    timeout += 2 * abs(x_end - self.pi_x.Position) / vel
+            self.pi_x.Velocity = vel
+            self.pi_x.Position = x_end
+            self._line_done.wait(lambda idx: idx is not None and idx >= line_index, timeout)
+
+    def fetch_line(self, line_index):
+        """
+        Returns all channels of a completed line with a single read.
+        """
+        with self.timer.stage('fetch'):
+            _, data = unpack_line(*self.panda.ReadLine(line_index))
+        return data
+
+    def do_x_line(self, start=0, end=10, N=100, exptime=.009, latency=.001):
+        """
+        Acquires a single line and returns its data.
+        """
+        plan = self.plan(start, end, N, exptime, latency)
+        self.setup(start, N, exptime, latency, plan)
+        line_index = self.prepare_line(start, margin=plan and plan.margin,
+                                       direction=1 if end >= start else -1)
+        vel = self.velocity(start, end, N, exptime, latency, plan)
+        log.info(f'Scanning at velocity {vel:e}')
+        self.fly_line(end, vel, line_index)
+        return self.fetch_line(line_index)
+
+    def do_stxm(self, x_start, x_end, y_start, y_end, Nx, Ny, exptime, latency,
+                filename='/tmp/data.h5', line_timeout=None):
+        """
+        Acquires a map of Ny + 1 lines of Nx points and writes it to filename.
+        """
+        plan = self.plan(x_start, x_end, Nx, exptime, latency, n_lines=Ny + 1)
+        vel = self.velocity(x_start, x_end, Nx, exptime, latency, plan)
+        direction = 1 if x_end >= x_start else -1
+        if plan is not None:
+            log.info(f'Scan plan:\n{plan.summary()}')
+        self.setup(x_start, Nx, exptime, latency, plan)
+        lines = queue.Queue()
+        errors = []
+
+        with h5py.File(filename, 'w') as fp:
+            # create datasets for later
+            shape = (Ny + 1, Nx)
+            dsets = {'x': fp.create_dataset('x', shape=shape),
+                     'y': fp.create_dataset('y', shape=shape),
+                     'pmt': fp.create_dataset('pmt', shape=shape),
+                     'p_diode': fp.create_dataset('diode', shape=shape)}
+
+            def writer():
+                while True:
+                    item = lines.get()
+                    try:
+                        if item is None:
+                            return
+                        y_i, line_index = item
+                        data = self.fetch_line(line_index)
+                        with self.timer.stage('write'):
+                            n = min(len(data), Nx)
+                            for name, dset in dsets.items():
+                                dset[y_i, :n] = data[name][:n]
+                            fp.flush()
+                    except Exception as e:
+                        errors.append(e)
+                        log.error(f'Problem writing line {item}: {e}')
+                    finally:
+                        lines.task_done()
+
+            t_writer = threading.Thread(target=writer, daemon=True)
+            t_writer.start()
+            try:
+                for y_i, y_val in enumerate(np.linspace(y_start, y_end, Ny + 1)):
+                    line_index = self.prepare_line(x_start, y_val, margin=plan and plan.margin,
+                                                   direction=direction)
+                    self.fly_line(x_end, vel, line_index, timeout=line_timeout)
+                    # The data is fetched and written while the next line is prepared
+                    lines.put((y_i, line_index))
+            finally:
+                lines.put(None)
+                t_writer.join()
+        log.info(f'Scan stage timing:\n{self.timer.report()}')
+        if errors:
+            raise errors[0]
+
+    def do_sparse_stxm(self, x_start, x_end, y_start, y_end, mask, exptime, latency,
+                       filename='/tmp/data.h5', min_gap=1, pad=0, line_timeout=None):
+        """
+        Acquires only the region of interest of the boolean mask, of shape
+        (Ny + 1, Nx), see planner.roi_segments for min_gap and pad. Every
+        segment is acquired as a line of its own and written at its offset
+        into the full frame in filename, the points outside of the region of
+        interest are NaN.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        n_lines, Nx = mask.shape
+        step = (x_end - x_start) / Nx
+        direction = 1 if step >= 0 else -1
+        if self.acceleration is None:
+            lines_plan = [[(start, stop, None) for start, stop in segments]
+                          for segments in roi_segments(mask, min_gap=min_gap, pad=pad)]
+        else:
+            sparse = plan_sparse(mask, x_start, x_end, exptime, latency, min_gap=min_gap, pad=pad,
+                                 acceleration=self.acceleration, fast=self.fast,
+                                 max_velocity=self.max_velocity, settle_time=self.settle_time,
+                                 trig_latency=self.trig_latency)
+            log.info(f'Sparse scan plan:\n{sparse.summary()}')
+            lines_plan = sparse.lines
+        self.setup(x_start, Nx, exptime, latency)
+        self._segment_settings = {'TrigXPos': float(x_start), 'DetTimePulseN': Nx}
+        lines = queue.Queue()
+        errors = []
+
+        with h5py.File(filename, 'w') as fp:
+            shape = (n_lines, Nx)
+            dsets = {name: fp.create_dataset(dset_name, shape=shape, fillvalue=np.nan)
+                     for name, dset_name in (('x', 'x'), ('y', 'y'), ('pmt', 'pmt'), ('p_diode', 'diode'))}
+            fp.create_dataset('mask', data=mask)
+
+            def writer():
+                while True:
+                    item = lines.get()
+                    try:
+                        if item is None:
+                            return
+                        y_i, seg_start, seg_stop, line_index = item
+                        data = self.fetch_line(line_index)
+                        with self.timer.stage('write'):
+                            n = min(len(data), seg_stop - seg_start)
+                            for name, dset in dsets.items():
+                                dset[y_i, seg_start:seg_start + n] = data[name][:n]
+                            fp.flush()
+                    except Exception as e:
+                        errors.append(e)
+                        log.error(f'Problem writing segment {item}: {e}')
+                    finally:
+                        lines.task_done()
+
+            t_writer = threading.Thread(target=writer, daemon=True)
+            t_writer.start()
+            try:
+                for y_i, y_val in enumerate(np.linspace(y_start, y_end, n_lines)):
+                    for seg_start, seg_stop, plan in lines_plan[y_i]:
+                        seg_x_start = x_start + seg_start * step
+                        self.setup_segment(seg_x_start, seg_stop - seg_start, plan,
+                                           offset=(y_i, seg_start))
+                        line_index = self.prepare_line(seg_x_start, y_val, margin=plan and plan.margin,
+                                                       direction=direction)
+                        vel = self.velocity(seg_x_start, x_start + seg_stop * step, seg_stop - seg_start,
+                                            exptime, latency, plan)
+                        self.fly_line(x_start + seg_stop * step, vel, line_index, timeout=line_timeout)
+                        # The data is fetched and written while the next segment is prepared
+                        lines.put((y_i, seg_start, seg_stop, line_index))
+            finally:
+                lines.put(None)
+                t_writer.join()
+        log.info(f'Scan stage timing:\n{self.timer.report()}')
+        if errors:
+            raise errors[0]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Memory-mapped on-disk accumulation of complete scan maps.
+
+A map is a .npy file holding a structured array of shape (lines, points), with
+one field per line record channel. The counters keep their integer dtype, only
+the float channels, e.g. the positions, can be stored with a smaller dtype. The completed lines are written straight
+into the mapped file, then their pages are flushed and released, so that the
+resident memory stays bounded also for maps of many GB. A finished map is
+opened for analysis without a copy:
+
+    data = numpy.load('/data/map_0001.npy', mmap_mode='r')
+    pmt = data['pmt']
+"""
+
+import mmap
+import threading
+
+import numpy as np
+
+
+def map_dtype(dtype, float_dtype=None):
+    """
+    Returns dtype with its float fields converted to float_dtype, the
+    integer counters are kept exact.
+    """
+    dtype = np.dtype(dtype)
+    if float_dtype is None:
+        return dtype
+    float_dtype = np.dtype(float_dtype)
+    if float_dtype.kind != 'f':
+        raise ValueError(f'{float_dtype} is not a float dtype')
+    return np.dtype([(name, float_dtype if dtype[name].kind == 'f' else dtype[name])
+                     for name in dtype.names])
+
+
+class ScanMap(object):
+    """
+    A (n_lines, n_points) map of the fields of dtype, backed by the file at
+    path. With float_dtype, e.g. '<f4', the float fields are stored with it.
+    """
+    def __init__(self, path, n_lines, n_points, dtype, float_dtype=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dtype = map_dtype(dtype, float_dtype)
+        self.shape = (n_lines, n_points)
+        self.lines_written = 0
+
+        with open(path, 'wb') as fp:
+            np.lib.format.write_array_header_2_0(fp, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                      'fortran_order': False,
+                                                      'shape': self.shape})
+            self._offset = fp.tell()
+            # The file is sparse until the lines are written
+            fp.truncate(self._offset + n_lines * n_points * self.dtype.itemsize)
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self.data = np.ndarray(self.shape, dtype=self.dtype, buffer=self._mmap, offset=self._offset)
+
+    def add_line(self, row, line, column=0):
+        """
+        Writes the points of a Line into a row of the map from column on, e.g.
+        a segment of a sparse scan, and flushes it. Points beyond the map width
+        and rows outside of the map are dropped.
+        """
+        n_lines, n_points = self.shape
+        if not 0 <= row < n_lines or not 0 <= column < n_points:
+            return False
+        n = min(len(line), n_points - column)
+        with self.lock:
+            if self.data is None:
+                return False
+            values = self.data[row]
+            for name in self.dtype.names:
+                values[name][column:column + n] = line[name][:n]
+            self._flush_row(row)
+            self.lines_written += 1
+        return True
+
+    def _flush_row(self, row):
+        row_bytes = self.shape[1] * self.dtype.itemsize
+        start = self._offset + row * row_bytes
+        aligned = start - start % mmap.ALLOCATIONGRANULARITY
+        length = start + row_bytes - aligned
+        self._mmap.flush(aligned, length)
+        # The written pages are on disk now, they are read back only if needed
+        if hasattr(self._mmap, 'madvise'):
+            self._mmap.madvise(mmap.MADV_DONTNEED, aligned, length)
+
+    def close(self):
+        with self.lock:
+            if self.data is None:
+                return
+            self.data = None
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Software line segmentation of a continuously captured raster.
+
+With PCAP armed once for the whole raster, the lines are found in the point
+stream itself. A new line starts
+
+    - at a turnaround of the fast axis, where its direction of motion, taken
+      over window points and ignoring moves below deadband, changes sign
+    - when the slow axis has moved more than slow_step from the start of the
+      current line, without a turnaround
+
+The slow axis steps to the next line at every turnaround, of a snake raster
+while the fast axis stands, of a flyback raster during the flyback. That step
+does not start another line: the first slow move after a turnaround, one
+within window points before it and the moves following a step within 2 window
+points only move the slow reference. A turnaround found within 2 window points
+after a slow step, e.g. late at a chunk border, continues the line started by
+the step.
+
+Both are computed on numpy arrays, a whole chunk of points at a time, the
+state needed across chunk borders is kept by the segmenter.
+"""
+
+import numpy as np
+
+
+class LineSegmenter(object):
+    """
+    Splits chunks of (fast, slow) positions into line segments.
+    """
+    def __init__(self, slow_step=1., deadband=.05, window=4):
+        self.slow_step = slow_step
+        self.deadband = deadband
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.sign = 0
+        self._fast_tail = np.empty(0)
+        self._slow_ref = None
+        # Points fed so far, and the positions of the last slow step of a
+        # turnaround and of the last line started by a slow step
+        self._count = 0
+        self._last_step = None
+        self._last_split = None
+        # The slow step of the last turnaround is still expected
+        self._turned = False
+
+    def _directions(self, fast):
+        """
+        Returns the direction of motion of the fast axis at every point, zero
+        moves take the direction of the previous points.
+        """
+        history = np.concatenate((self._fast_tail, fast))
+        lag = len(self._fast_tail)
+        ref = np.empty_like(fast)
+        idx = np.arange(len(fast)) + lag - self.window
+        valid = idx >= 0
+        ref[valid] = history[idx[valid]]
+        ref[~valid] = history[0]
+        step = fast - ref
+        sign = np.where(np.abs(step) > self.deadband, np.sign(step), 0.)
+        # Forward fill of the zero directions
+        last = np.where(sign != 0, np.arange(len(sign)), -1)
+        np.maximum.accumulate(last, out=last)
+        filled = np.where(last >= 0, sign[np.maximum(last, 0)], self.sign)
+        self._fast_tail = history[-self.window:]
+        return filled
+
+    def feed(self, fast, slow):
+        """
+        Returns the segments of the chunk as (start, stop, new_line, sign)
+        tuples, new_line is False for the segment continuing the line of the
+        previous chunk, sign the direction of the fast axis.
+        """
+        fast = np.asarray(fast, dtype=np.float64)
+        slow = np.asarray(slow, dtype=np.float64)
+        n = len(fast)
+        if not n:
+            return []
+        directions = self._directions(fast)
+        previous = np.concatenate(([self.sign], directions[:-1]))
+        turns = []
+        for turn in np.flatnonzero((directions != previous) & (previous != 0)):
+            # The direction changes window points late, the line starts at
+            # the extremum of the fast axis before
+            low = max(turn - self.window, turns[-1] + 1 if turns else 0)
+            around = fast[low:turn + 1]
+            extremum = around.argmin() if directions[turn] > 0 else around.argmax()
+            directions[low + extremum:turn] = directions[turn]
+            turns.append(low + int(extremum))
+
+        # Slow axis steps, searched between the turnarounds, there are only
+        # a few lines per chunk
+        ref = slow[0] if self._slow_ref is None else self._slow_ref
+        # Positions relative to the start of this chunk
+        last_step = None if self._last_step is None else self._last_step - self._count
+        last_split = None if self._last_split is None else self._last_split - self._count
+        turned = self._turned
+
+        def near(index, position):
+            return index is not None and position - index <= 2 * self.window
+
+        starts = []
+        continued = set()
+        pos = 0
+        for turn in turns + [n]:
+            while True:
+                moved = np.flatnonzero(np.abs(slow[pos:turn] - ref) > self.slow_step)
+                if not len(moved):
+                    break
+                start = pos + int(moved[0])
+                ref = slow[start]
+                pos = start + 1
+                if (turned or near(last_step, start) or near(last_split, start)
+                        or (turn < n and turn - start <= self.window)):
+                    # The slow step of a turnaround
+                    turned = False
+                    last_step = start
+                    continue
+                starts.append(start)
+                last_split = start
+            if turn < n:
+                starts.append(turn)
+                ref = slow[turn]
+                pos = turn + 1
+                if near(last_split, turn):
+                    # The turnaround of the line started by the slow step
+                    continued.add(turn)
+                turned = not (near(last_step, turn) or near(last_split, turn))
+        self._slow_ref = ref
+        self._turned = turned
+        self._last_step = None if last_step is None else last_step + self._count
+        self._last_split = None if last_split is None else last_split + self._count
+        self._count += n
+        self.sign = directions[-1]
+
+        new_lines = set(starts) - continued
+        edges = [0] + starts + [n]
+        return [(start, stop, start in new_lines, directions[start])
+                for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Recording and replay of the PandABox socket traffic.
+
+A session file holds the raw bytes sent and received on the data and control
+ports, each chunk with its time:
+
+    header   '<4sB' magic b'PPTS', version
+    chunks   '<dBI' time (s since the epoch), channel, length, then the bytes
+
+The file is gzip compressed if its name ends with '.gz'. The replay feeds the
+data port chunks through the same DataPortStream and LineIngest as the
+device, at the original timing or as fast as possible:
+
+    python -m PandaPosTrig.session /tmp/beamtime.ppts.gz [--speed 1]
+"""
+
+import argparse
+import gzip
+import re
+import struct
+import threading
+import time
+
+from .linebuffer import LineEpochs, LineHistory
+from .lineingest import LineIngest
+from . import pcap
+
+MAGIC = b'PPTS'
+VERSION = 1
+
+DATA_RX = 0
+DATA_TX = 1
+CTRL_RX = 2
+CTRL_TX = 3
+CHANNEL_NAMES = {DATA_RX: 'data<', DATA_TX: 'data>', CTRL_RX: 'ctrl<', CTRL_TX: 'ctrl>'}
+
+_HEADER = struct.Struct('<4sB')
+_CHUNK = struct.Struct('<dBI')
+_PULSES = re.compile(r'PULSE1\.PULSES=(\d+)')
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+
+class SessionRecorder(object):
+    """
+    Appends the chunks of all sockets, from any thread, to a session file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._file = _open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+
+    def record(self, channel, data):
+        timestamp = time.time()
+        with self.lock:
+            if self._file is not None:
+                self._file.write(_CHUNK.pack(timestamp, channel, len(data)))
+                self._file.write(data)
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_session(path):
+    """
+    Yields the (time, channel, bytes) chunks of a session file.
+    """
+    with _open(path, 'rb') as fp:
+        magic, version = _HEADER.unpack(fp.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a PandaPosTrig session recording')
+        while True:
+            head = fp.read(_CHUNK.size)
+            if len(head) < _CHUNK.size:
+                return
+            timestamp, channel, length = _CHUNK.unpack(head)
+            yield timestamp, channel, fp.read(length)
+
+
+class ReplaySink(object):
+    """
+    Collects the replayed points into lines through the LineIngest of the
+    device, the next line is armed at the end of every line. The points per
+    line, n_points, follow the PULSE1.PULSES writes of the session.
+    """
+    def __init__(self, history_lines=100, n_points=0):
+        self.lines = LineEpochs()
+        self.history = LineHistory(max_lines=history_lines)
+        self.ingest = LineIngest(self.lines, self._publish, line_end=self._line_end)
+        self.ingest.n_points = n_points
+        self.lines.arm(0)
+        self.n_points = 0
+        self.n_lines = 0
+
+    def _publish(self, line):
+        self.history.add(line)
+        self.n_lines += 1
+
+    def _line_end(self, rearm):
+        if rearm:
+            self.lines.arm(self.lines.completed.index + 1)
+
+    def on_points(self, rows, index):
+        self.n_points += len(rows)
+        self.ingest.add_points(rows, index)
+
+    def on_end(self):
+        self.ingest.end()
+
+    def on_ctrl(self, data):
+        for n_points in _PULSES.findall(data):
+            self.ingest.n_points = int(n_points)
+
+
+def replay(path, on_points, on_end, speed=None, tracer=None, on_ctrl=None):
+    """
+    Feeds the data port chunks of a session through a DataPortStream, and
+    the requests sent to the control port to on_ctrl. With speed, e.g. 1 for
+    the original timing, the chunks are paced by their recorded times,
+    otherwise they are fed as fast as possible. Returns the number of bytes
+    fed and the elapsed time.
+    """
+    stream = pcap.DataPortStream(None, on_end, tracer=tracer, on_points=on_points)
+    n_bytes = 0
+    first = None
+    start = time.perf_counter()
+    for timestamp, channel, data in read_session(path):
+        if channel == CTRL_TX and on_ctrl is not None:
+            on_ctrl(data.decode(errors='replace'))
+            continue
+        if channel != DATA_RX:
+            continue
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        stream.feed(data.decode())
+        n_bytes += len(data)
+    return n_bytes, time.perf_counter() - start
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replays a PandaPosTrig session recording.')
+    parser.add_argument('path', help='session file')
+    parser.add_argument('--points-per-line', type=int, default=0,
+                        help='points per line until the session sets PULSE1.PULSES, lines end on END if 0')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='replay at this multiple of the original timing, as fast as possible if omitted')
+    args = parser.parse_args(args)
+
+    sink = ReplaySink(n_points=args.points_per_line)
+    n_bytes, elapsed = replay(args.path, sink.on_points, sink.on_end, speed=args.speed,
+                              on_ctrl=sink.on_ctrl)
+    print(f'{sink.n_points} points in {sink.n_lines} lines, {n_bytes} bytes in {elapsed:.3f} s')
+    if elapsed > 0:
+        print(f'{sink.n_points / elapsed:.0f} points/s, {n_bytes / elapsed / 2**20:.2f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Timeline of a scan, exported as a Chrome/Perfetto trace.
+
+Spans, e.g. the arming of a line or the streaming of its points, are kept in
+a ring buffer as (name, category, thread, start, duration), with times from
+time.perf_counter. Recording a span is a deque append, so the spans stay in
+the acquisition paths. The export is the JSON trace event format, opened by
+chrome://tracing or https://ui.perfetto.dev:
+
+    {"traceEvents": [{"name": "ArmSingle", "cat": "command", "ph": "X",
+                      "ts": <us>, "dur": <us>, "pid": 1, "tid": <thread>}, ...]}
+
+The acquisition efficiency is the fraction of the time spent streaming the
+points of the lines, the rest is dead time of the scan.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Category of the spans counted as acquisition time
+STREAM = 'stream'
+
+
+class Timeline(object):
+    """
+    Ring buffer of the last size spans.
+    """
+    def __init__(self, size=100000):
+        # deque.append is atomic, the spans are added without a lock
+        self.spans = deque(maxlen=size)
+        # The names of the threads are added, rarely, under the lock
+        self.lock = threading.Lock()
+        self._threads = {}
+
+    def add(self, name, category, start, end=None):
+        """
+        Adds a span between perf_counter times, an instant without end.
+        """
+        thread = threading.current_thread()
+        if self._threads.get(thread.ident) != thread.name:
+            with self.lock:
+                self._threads[thread.ident] = thread.name
+        self.spans.append((name, category, thread.ident, start,
+                           None if end is None else end - start))
+
+    @contextmanager
+    def span(self, name, category):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter())
+
+    def clear(self):
+        self.spans.clear()
+
+    def _since(self, seconds):
+        spans = list(self.spans)
+        if seconds > 0:
+            start = time.perf_counter() - seconds
+            spans = [span for span in spans if span[3] + (span[4] or 0.) >= start]
+        return spans
+
+    def export(self, seconds=0.):
+        """
+        Returns the spans of the last seconds (all for seconds <= 0) as a
+        Chrome trace JSON string.
+        """
+        with self.lock:
+            threads = list(self._threads.items())
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': ident, 'args': {'name': thread}}
+                  for ident, thread in threads]
+        for name, category, ident, start, duration in self._since(seconds):
+            event = {'name': name, 'cat': category, 'pid': 1, 'tid': ident,
+                     'ts': round(start * 1e6, 3)}
+            if duration is None:
+                event.update(ph='i', s='t')
+            else:
+                event.update(ph='X', dur=round(duration * 1e6, 3))
+            events.append(event)
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+    def efficiency(self, seconds):
+        """
+        Returns the fraction of the last seconds, or of the time since the
+        first span if shorter, spent in the streaming spans.
+        """
+        spans = self._since(seconds)
+        if not spans:
+            return 0.
+        now = time.perf_counter()
+        start = max(now - seconds, min(span[3] for span in spans))
+        if now <= start:
+            return 0.
+        streaming = sum(min(span_start + duration, now) - max(span_start, start)
+                        for _, category, _, span_start, duration in spans
+                        if category == STREAM and duration is not None)
+        return min(max(streaming / (now - start), 0.), 1.)
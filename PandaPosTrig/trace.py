@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Low-overhead tracing of the control and data port traffic.
+
+The messages are kept unformatted, as a %-style format string and its
+arguments, in a ring buffer and only formatted when the buffer is dumped. A
+message below the trace level costs one comparison, so the tracing calls can
+stay in the per-point and per-line paths. The hottest call sites are sampled,
+only every n-th of their messages is recorded. Warnings and errors are also
+passed on to the logging module.
+"""
+
+import enum
+import logging
+import threading
+import time
+from collections import deque
+
+
+class TraceLevel(enum.IntEnum):
+    """Python enumerated type for TraceLevel attribute."""
+    OFF = 0
+    ERROR = 1
+    WARNING = 2
+    INFO = 3
+    DEBUG = 4
+
+
+_LOGGING_LEVELS = {TraceLevel.ERROR: logging.ERROR,
+                   TraceLevel.WARNING: logging.WARNING}
+
+
+class Tracer(object):
+    """
+    Ring buffer of the last size trace records.
+    """
+    def __init__(self, size=10000, level=TraceLevel.OFF, sample=1, logger=logging):
+        # deque.append is atomic, the records are added without a lock
+        self.records = deque(maxlen=size)
+        self.level = level
+        self.sample = sample
+        self.logger = logger
+        self._sampled = {}
+
+    def enabled(self, level):
+        """
+        Returns True if the messages of level are recorded, for the call
+        sites which have to build their arguments.
+        """
+        return level <= self.level
+
+    def _record(self, level, fmt, args):
+        self.records.append((time.time(), level, threading.current_thread().name, fmt, args))
+
+    def trace(self, level, fmt, *args):
+        if level in _LOGGING_LEVELS:
+            self.logger.log(_LOGGING_LEVELS[level], fmt, *args)
+        if level <= self.level:
+            self._record(level, fmt, args)
+
+    def error(self, fmt, *args):
+        self.trace(TraceLevel.ERROR, fmt, *args)
+
+    def warning(self, fmt, *args):
+        self.trace(TraceLevel.WARNING, fmt, *args)
+
+    def info(self, fmt, *args):
+        if TraceLevel.INFO <= self.level:
+            self._record(TraceLevel.INFO, fmt, args)
+
+    def debug(self, fmt, *args):
+        if TraceLevel.DEBUG <= self.level:
+            self._record(TraceLevel.DEBUG, fmt, args)
+
+    def sampled(self, site, fmt, *args):
+        """
+        Records a debug message of the call site only every sample-th time.
+        """
+        if TraceLevel.DEBUG <= self.level:
+            count = self._sampled.get(site, 0)
+            self._sampled[site] = count + 1
+            if count % self.sample == 0:
+                self._record(TraceLevel.DEBUG, fmt, args)
+
+    def clear(self):
+        self.records.clear()
+        self._sampled.clear()
+
+    def dump(self, n=0):
+        """
+        Returns the last n records (all for n <= 0) as formatted lines.
+        """
+        records = list(self.records)
+        if n > 0:
+            records = records[-n:]
+        lines = []
+        for timestamp, level, thread, fmt, args in records:
+            try:
+                message = fmt % args if args else fmt
+            except (TypeError, ValueError) as e:
+                message = f'{fmt} {args} ({e})'
+            lines.append(time.strftime('%H:%M:%S', time.localtime(timestamp))
+                         + f'.{int(timestamp % 1 * 1e6):06d} {TraceLevel(level).name:7s} [{thread}] {message}')
+        return lines
@@ -11,10 +11,13 @@ setup(
     url="https://gitlab.maxiv.lu.se/softimax/tangods-softimax-pandapostrig",
     packages=find_packages(exclude=["tests", "*.tests.*", "tests.*", "scripts"]),
     include_package_data=True,
-    python_requires=">=3.6",
+    package_data={"PandaPosTrig": ["designs/*.json"]},
+    python_requires=">=3.9",
     install_requires=[
         "pytango",
         "pyparsing",
+        "numpy",
     ],
+    extras_require={"scan": ["h5py"]},
     entry_points={"console_scripts": ["PandaPosTrig = PandaPosTrig.PandaPosTrig:main",]},
 )
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Line epochs and history, and their handoff between two threads. """
+
+import threading
+import time
+
+import numpy as np
+
+from PandaPosTrig.linebuffer import Line, LineEpochs, LineHistory
+
+N_LINES = 200
+N_POINTS = 50
+
+
+def fill(line, n, start=0):
+    points = np.arange(start, start + n)
+    line.extend(points * 1., points * 0., np.ones(n), points, np.ones(n, dtype=np.int64), points + 1)
+
+
+def test_epochs_arm_and_end():
+    lines = LineEpochs()
+    assert lines.completed.index == -1
+    lines.arm(0)
+    line = lines.point_line()
+    assert line.index == 0
+    fill(line, 3)
+    assert lines.armed_line() is line
+    assert lines.end() is line
+    assert lines.completed is line and line.complete
+    # The completed line does not take more points
+    assert lines.point_line() is None
+    lines.arm(1)
+    assert lines.point_line().index == 1
+
+
+def test_epochs_rearmed_and_pending():
+    lines = LineEpochs()
+    lines.arm(0)
+    fill(lines.point_line(), 2)
+    assert lines.pending() and not lines.rearmed()
+    lines.arm(1)
+    assert lines.rearmed()
+    assert lines.end().index == 0
+    # END of an armed line without points publishes it empty
+    assert lines.pending()
+    line = lines.end()
+    assert (line.index, len(line)) == (1, 0)
+
+
+def test_epochs_reset():
+    lines = LineEpochs()
+    for index in range(3):
+        lines.arm(index)
+        fill(lines.point_line(), 4)
+        lines.end()
+    lines.reset()
+    assert lines.completed.index == -1 and lines.current is None
+    lines.arm(0)
+    line = lines.point_line()
+    assert line.index == 0 and len(line) == 0
+
+
+def test_history_eviction():
+    history = LineHistory(max_lines=3)
+    for index in range(5):
+        line = Line(index)
+        fill(line, 10)
+        history.add(line)
+    assert history.indices() == [2, 3, 4]
+    assert history.get(1) is None
+    assert len(history.get(4)) == 10
+    # The byte limit evicts as well
+    history = LineHistory(max_bytes=1)
+    history.add(Line(0))
+    history.add(Line(1))
+    assert history.indices() == []
+    history = LineHistory()
+    history.add(Line(0))
+    history.clear()
+    assert history.indices() == []
+
+
+def test_spsc_handoff():
+    """
+    The consumer arms every line once the previous one is completed, the
+    producer fills the armed lines in small chunks, every line is seen once,
+    in order and with all its points.
+    """
+    lines = LineEpochs()
+    history = LineHistory(max_lines=N_LINES)
+    done = threading.Condition()
+    errors = []
+
+    def producer():
+        try:
+            point = 0
+            while lines.completed.index < N_LINES - 1:
+                line = lines.point_line() if lines.armed >= 0 else None
+                if line is None:
+                    # The next line is not armed yet
+                    time.sleep(1e-4)
+                    continue
+                n = min(7, N_POINTS - len(line))
+                fill(line, n, point)
+                point += n
+                if len(line) >= N_POINTS:
+                    history.add(lines.end())
+                    with done:
+                        done.notify_all()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    for index in range(N_LINES):
+        lines.arm(index)
+        with done:
+            assert done.wait_for(lambda: lines.completed.index >= index, timeout=5.)
+        # A line read by the consumer is complete
+        line = history.get(index)
+        assert line.complete and len(line) == N_POINTS
+    thread.join(5.)
+    assert not errors
+    assert history.indices() == list(range(N_LINES))
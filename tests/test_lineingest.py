@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Lines of the data port chunks, as the device collects them. """
+
+import logging
+
+import numpy as np
+import pytest
+
+from PandaPosTrig import pcap
+from PandaPosTrig.linebuffer import LineEpochs, LineHistory
+from PandaPosTrig.lineingest import LineIngest
+
+N_POINTS = 10
+
+INDEX = {pcap.X_POS: 0, pcap.Y_POS: 1, pcap.DWELL: 2, pcap.PMT: 3, pcap.P_DIODE: 4, pcap.POINT_N: 5}
+
+
+def chunk(n, start=0):
+    """
+    n data port lines, the PMT counts number the points from start.
+    """
+    points = np.arange(start, start + n, dtype=np.float64)
+    return np.stack([points * 1000, np.zeros(n), np.full(n, 1000.), points, np.ones(n), points + 1], axis=1)
+
+
+class Device(object):
+    """
+    The device side of the ingest: ArmSingle, ResetTrigCntr and, in the
+    double-buffered mode, the arming of the next line at the end of a line.
+    A client arming on every published line is given by arm_on_publish.
+    """
+    def __init__(self, n_points=N_POINTS, double_buffer=False, arm_on_publish=False):
+        self.lines = LineEpochs()
+        self.history = LineHistory()
+        self.ingest = LineIngest(self.lines, self._publish, line_end=self._line_end)
+        self.ingest.n_points = n_points
+        self.double_buffer = double_buffer
+        self.arm_on_publish = arm_on_publish
+        self.trig_cntr = 0
+        self.pre_armed = False
+        self.events = []
+
+    def arm_single(self):
+        if self.pre_armed:
+            self.pre_armed = False
+            return
+        self.trig_cntr += 1
+        self.lines.arm(self.trig_cntr - 1)
+
+    def reset_trig_cntr(self):
+        self.trig_cntr = 0
+        self.pre_armed = False
+        self.ingest.reset()
+        self.history.clear()
+
+    def _line_end(self, rearm):
+        self.events.append(('line_end', self.lines.completed.index))
+        if rearm and self.double_buffer:
+            self.trig_cntr += 1
+            self.lines.arm(self.trig_cntr - 1)
+            self.pre_armed = True
+
+    def _publish(self, line):
+        self.events.append(('publish', line.index))
+        self.history.add(line)
+        if self.arm_on_publish:
+            self.arm_single()
+
+    def feed(self, n, start=0, size=None):
+        size = size or n
+        for first in range(start, start + n, size):
+            self.ingest.add_points(chunk(min(size, start + n - first), first), INDEX)
+
+    def published(self):
+        return [(index, len(self.history.get(index))) for index in self.history.indices()]
+
+
+@pytest.mark.parametrize('size', [25, 10, 7, 1])
+def test_split_at_n_points(size):
+    # The double-buffered mode arms the next line at the end of every line
+    device = Device(double_buffer=True)
+    device.arm_single()
+    device.feed(25, size=size)
+    assert device.published() == [(0, N_POINTS), (1, N_POINTS)]
+    assert list(device.history.get(1)['pmt']) == list(range(N_POINTS, 2 * N_POINTS))
+    line = device.lines.armed_line()
+    assert (line.index, len(line)) == (2, 5)
+
+
+def test_dropped_points_warning(caplog):
+    device = Device()
+    device.arm_single()
+    with caplog.at_level(logging.WARNING):
+        device.feed(N_POINTS + 2)
+    assert device.published() == [(0, N_POINTS)]
+    assert '2 points after the end of line 0 dropped' in caplog.text
+
+
+def test_end():
+    device = Device()
+    device.arm_single()
+    device.feed(4)
+    device.ingest.end()
+    # A second END does not publish the line again
+    device.ingest.end()
+    assert device.published() == [(0, 4)]
+    # END of an armed line without any point publishes it empty
+    device.arm_single()
+    device.ingest.end()
+    assert device.published() == [(0, 4), (1, 0)]
+    # END after a full line is only the disarm
+    device.arm_single()
+    device.feed(N_POINTS)
+    device.ingest.end()
+    assert device.published() == [(0, 4), (1, 0), (2, N_POINTS)]
+
+
+def test_arm_completes_short_line():
+    device = Device()
+    device.arm_single()
+    device.feed(4)
+    device.arm_single()
+    device.feed(N_POINTS, start=4)
+    assert device.published() == [(0, 4), (1, N_POINTS)]
+
+
+def test_reset_and_rescan():
+    device = Device()
+    for _ in range(3):
+        device.arm_single()
+        device.feed(N_POINTS)
+    assert device.ingest.line_done(0)
+    device.reset_trig_cntr()
+    assert device.lines.completed.index == -1
+    assert not device.ingest.line_done(0)
+    assert device.published() == []
+    # The first line of the new scan is done only with all its points
+    device.arm_single()
+    device.feed(4, start=100)
+    assert not device.ingest.line_done(0)
+    device.feed(N_POINTS - 4, start=104)
+    assert device.ingest.line_done(0)
+    assert device.history.get(0)['pmt'][0] == 100
+
+
+def test_double_buffer_pre_arm_order():
+    # The client arms on every published line, the line has already been
+    # pre-armed then and no line index is skipped
+    device = Device(double_buffer=True, arm_on_publish=True)
+    device.arm_single()
+    device.feed(3 * N_POINTS, size=4)
+    assert device.published() == [(0, N_POINTS), (1, N_POINTS), (2, N_POINTS)]
+    assert device.events[:4] == [('line_end', 0), ('publish', 0), ('line_end', 1), ('publish', 1)]
+    assert device.lines.armed == 3
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Accumulation of the passes of a multi-pass line. """
+
+import numpy as np
+
+from PandaPosTrig import pcap
+from PandaPosTrig.linebuffer import Line, LineEpochs
+from PandaPosTrig.lineingest import LineIngest
+from PandaPosTrig.passes import PassAccumulator
+
+N_PASSES = 3
+N_POINTS = 5
+
+INDEX = {pcap.X_POS: 0, pcap.Y_POS: 1, pcap.DWELL: 2, pcap.PMT: 3, pcap.P_DIODE: 4, pcap.POINT_N: 5}
+
+
+def one_pass(k, index=0, n=N_POINTS):
+    """
+    Pass k of a line, the positions move by k/10 and the counts grow with k.
+    """
+    points = np.arange(n)
+    line = Line(index)
+    line.extend(points + k / 10, np.full(n, 2. + k / 10), np.full(n, .01),
+                points * (k + 1), np.full(n, 10 + k), points + 1)
+    return line
+
+
+def test_three_passes():
+    passes = PassAccumulator(N_PASSES)
+    assert [passes.add(one_pass(k)) for k in range(N_PASSES)] == [False, False, True]
+    line = passes.line()
+    points = np.arange(N_POINTS)
+    assert line.index == 0 and line.passes == N_PASSES
+    # The counts and the dwell are summed
+    assert list(line['pmt']) == list(points * 6)
+    assert list(line['p_diode']) == [33] * N_POINTS
+    assert np.allclose(line['dwell'], .03)
+    # The positions are the means
+    assert np.allclose(line['x'], points + .1)
+    assert np.allclose(line['y'], 2.1)
+    assert list(line['point_n']) == list(points + 1)
+    assert np.allclose(passes.variance('pmt'), np.var([points * (k + 1) for k in range(N_PASSES)], axis=0))
+
+
+def test_short_pass_and_new_line():
+    passes = PassAccumulator(N_PASSES)
+    passes.add(one_pass(0))
+    passes.add(one_pass(1, n=3))
+    # A shorter pass shortens the accumulated line
+    line = passes.line()
+    assert len(line) == 3 and line.passes == 2
+    # A pass of another line starts a new accumulation
+    assert not passes.add(one_pass(0, index=1))
+    assert passes.index == 1 and passes.count == 1
+
+
+def test_ingest_publishes_accumulated_line():
+    lines = LineEpochs()
+    published = []
+    next_pass = []
+    ingest = LineIngest(lines, published.append, next_pass=lambda: next_pass.append(lines.armed))
+    ingest.n_points = N_POINTS
+    ingest.passes.passes = N_PASSES
+    lines.arm(0)
+    for k in range(N_PASSES):
+        points = np.arange(N_POINTS, dtype=np.float64)
+        rows = np.stack([points * 1000, np.zeros(N_POINTS), np.full(N_POINTS, 10.),
+                         points * (k + 1), np.ones(N_POINTS), points + 1], axis=1)
+        ingest.add_points(rows, INDEX)
+        # Only the accumulated line counts as done
+        assert ingest.line_done(0) == (k == N_PASSES - 1)
+    # The same line is armed again for the passes after the first
+    assert next_pass == [0] * (N_PASSES - 1)
+    assert len(published) == 1
+    line = published[0]
+    assert line.index == 0 and line.passes == N_PASSES
+    # PrevLinePasses of the device
+    assert lines.completed.passes == N_PASSES
+    assert list(line['pmt']) == list(np.arange(N_POINTS) * 6)
+    assert np.allclose(line['dwell'], .03)
+    assert set(ingest.pass_variance) == {'pmt', 'p_diode'}
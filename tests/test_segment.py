@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the PandaPosTrig project
+#
+#
+# Distributed under the terms of the GPL license.
+# See LICENSE.txt for more info.
+
+""" Line segmentation of synthetic continuous rasters. """
+
+import numpy as np
+import pytest
+
+from PandaPosTrig.segment import LineSegmenter
+
+N_LINES = 5
+N_POINTS = 100
+Y_STEP = 2.
+
+
+def snake_raster():
+    """
+    A bidirectional raster, the slow axis steps while the fast axis stands
+    at the turnaround.
+    """
+    fast, slow = [], []
+    for k in range(N_LINES):
+        x = np.linspace(0., 10., N_POINTS)
+        fast.append(x if k % 2 == 0 else x[::-1])
+        slow.append(np.full(N_POINTS, k * Y_STEP))
+        if k < N_LINES - 1:
+            # Turnaround: the fast axis stands while the slow axis steps
+            fast.append(np.full(4, fast[-1][-1]))
+            slow.append(np.array([k, k, k + 1, k + 1]) * Y_STEP)
+    return np.concatenate(fast), np.concatenate(slow)
+
+
+def flyback_raster(n_flyback=10):
+    """
+    A unidirectional raster, the slow axis steps during the flyback.
+    """
+    fast, slow = [], []
+    for k in range(N_LINES):
+        fast.append(np.linspace(0., 10., N_POINTS))
+        slow.append(np.full(N_POINTS, k * Y_STEP))
+        if k < N_LINES - 1:
+            fast.append(np.linspace(10., 0., n_flyback + 2)[1:-1])
+            slow.append(np.where(np.arange(n_flyback) < n_flyback // 2, k, k + 1) * Y_STEP)
+    return np.concatenate(fast), np.concatenate(slow)
+
+
+def segment(fast, slow, chunk):
+    """
+    Feeds the raster in chunks, returns the (n_points, sign) of every line,
+    the sign of the most points of the line.
+    """
+    segmenter = LineSegmenter(slow_step=1.)
+    lines = []
+    for first in range(0, len(fast), chunk):
+        part = slice(first, first + chunk)
+        for start, stop, new_line, sign in segmenter.feed(fast[part], slow[part]):
+            if new_line or not lines:
+                lines.append({})
+            lines[-1][sign] = lines[-1].get(sign, 0) + stop - start
+    return [(sum(line.values()), max(line, key=line.get)) for line in lines]
+
+
+@pytest.mark.parametrize('chunk', [10000, 37, 7, 1])
+def test_snake_raster(chunk):
+    lines = segment(*snake_raster(), chunk)
+    assert len(lines) == N_LINES
+    # The direction of the first points is not known yet
+    assert [sign for _, sign in lines[1:]] == [-1, 1] * (N_LINES // 2)
+    # The turnaround points belong to the neighbouring lines
+    for n_points, _ in lines:
+        assert N_POINTS - 1 <= n_points <= N_POINTS + 4
+
+
+@pytest.mark.parametrize('chunk', [10000, 37, 7, 1])
+def test_flyback_raster(chunk):
+    lines = segment(*flyback_raster(), chunk)
+    # Every flyback is a single line of its own
+    assert len(lines) == 2 * N_LINES - 1
+    assert [sign for _, sign in lines[1:]] == [-1, 1] * (N_LINES - 1)
+    # A turnaround found at a chunk border moves the line end by up to
+    # window points
+    window = LineSegmenter().window
+    for n_points, sign in lines:
+        if sign >= 0:
+            assert N_POINTS - 2 * window <= n_points <= N_POINTS + 1
+        else:
+            assert n_points <= 10 + 2 * window
+
+
+def test_slow_step_without_turnaround():
+    # The fast axis keeps its direction, only the slow axis marks the lines
+    fast = np.linspace(0., 30., 3 * N_POINTS)
+    slow = np.repeat(np.arange(3) * Y_STEP, N_POINTS)
+    lines = segment(fast, slow, 37)
+    assert [n_points for n_points, _ in lines] == [N_POINTS] * 3